@@ -0,0 +1,336 @@
+"""
+bootstrap.py
+
+Shared start up for the vsphere-tools scripts
+
+Importing pyVmomi, and so vsphere_tools, is most of the run time of a quick
+command like power.py query, and all of it for --help or a bad argument.
+When run as scripts, they get vsphere_tools through lazy_import, so it's
+only really imported once something in it is used - by which point there's
+a vCenter to talk to.
+
+Working out the server and user from the ini file, and connecting, is done
+here once rather than in each script.  Nothing in here imports pyVmomi
+until connect() is called.
+
+With --from-file, the VMs (and anything to do differently for each of them)
+come from a file or stdin, read by read_vm_list(), and each VM's result is
+printed as a line of JSON as it finishes.
+
+With --daemon, a script doesn't connect at all: forward() hands its command
+line to daemon.py over a Unix socket, and copies back what it prints.
+
+With --profile, profiling() counts the SOAP calls a command makes, and how
+long they took, and prints that to stderr at the end, optionally along with
+a cProfile and a tracemalloc report.
+"""
+
+import argparse
+import configparser
+import contextlib
+import importlib
+import importlib.util
+import io
+import json
+import os
+import shlex
+import socket
+import sys
+from pathlib import Path
+
+# where daemon.py listens
+SOCKET_PATH = str(Path.home()) + os.path.sep + '.vsphere-tools' + \
+    os.path.sep + 'daemon.sock'
+
+
+def lazy_import(name):
+    """
+    Import a module, putting off actually loading it until one of its
+    attributes is first used
+
+    name - the module name, eg vsphere_tools
+    return - the module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named " + name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def read_config(args):
+    """
+    When no VC was given with -s, fill in args.vc and args.user from the
+    DC-<DC> section of the ini file
+
+    args - the parsed args, with vc, dc, user and configfile
+    return - args
+    """
+    if args.vc not in (None, "NONE"):
+        return args
+    if args.dc == "NONE":
+        raise Exception("No VC and no DC specified.")
+    args.vc, args.user, _ = config_targets(args.configfile, [args.dc])[0]
+    return args
+
+
+def config_targets(configfile, dcs=None):
+    """
+    The vCenters of DC-<DC> sections of the ini file
+
+    configfile - the ini file
+    dcs - the DCs to use, default every [DC-*] section
+    return - list of (server, user, section), one per server and user, as
+             several DCs may live on one vCenter, which covers them all
+    """
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    if dcs:
+        sections = ["DC-" + dc_name.upper() for dc_name in dcs]
+    else:
+        sections = [section for section in config.sections()
+                    if section.startswith("DC-")]
+    targets = []
+    for section in sections:
+        if section not in config or \
+                config[section].get("SERVER", "NONE") == "NONE":
+            raise Exception("No server/DC matching command line options "
+                            "found")
+        server = config[section].get("SERVER")
+        user = config[section].get("USERNAME", "FOO")
+        if (server, user) not in [target[:2] for target in targets]:
+            targets.append((server, user, section))
+    return targets
+
+
+def tools():
+    """
+    The vsphere_tools package, imported as it would be by the scripts
+    """
+    if __package__:
+        return importlib.import_module(__package__ + '.vsphere_tools')
+    return importlib.import_module('vsphere_tools')
+
+
+def connect(args):
+    """
+    Work out where to connect from the args and ini file, and connect
+
+    args - the parsed args, with vc, dc, user, password, port, configfile
+           and reuse_session
+    return - the ServiceInstance
+    """
+    read_config(args)
+    return tools().connect_vc(args.vc, args.user, args.password, args.port,
+                              args.reuse_session)
+
+
+def flag(value):
+    """
+    Convert a yes/no, true/false or 1/0 setting from a VM list
+    """
+    if value.lower() in ('yes', 'true', '1'):
+        return True
+    if value.lower() in ('no', 'false', '0'):
+        return False
+    raise ValueError("expected yes or no, not " + value)
+
+
+def choice(*values):
+    """
+    Make a converter for a VM list setting that must be one of values
+    """
+    def convert(value):
+        if value not in values:
+            raise ValueError("expected one of %s, not %s" %
+                             (", ".join(values), value))
+        return value
+    return convert
+
+
+def read_source(source, stdin=None):
+    """
+    The text of a --from-file file, or of stdin for -
+    """
+    if source == '-':
+        return (stdin or sys.stdin).read()
+    with open(source) as source_file:
+        return source_file.read()
+
+
+def read_vm_list(source, params, stdin=None):
+    """
+    Read the VMs to work on for --from-file
+
+    Each line is a VM name, optionally followed by key=value settings for
+    just that VM, eg: web01 operation=off force=yes.  Names with spaces in
+    need quoting.  Blank lines and anything after a # are ignored.
+
+    source - the file name, or - for stdin
+    params - {key: (args dest, function converting the value)} for the
+             settings allowed
+    stdin - the stream to read for -, default sys.stdin
+    return - list of (vmname, {args dest: value}), in the order listed
+    """
+    entries = []
+    seen = set()
+    for number, line in enumerate(read_source(source, stdin).splitlines(),
+                                  1):
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError as err:
+            raise Exception("%s line %d: %s" % (source, number, err))
+        if not fields:
+            continue
+        name = fields[0]
+        if name in seen:
+            raise Exception("%s line %d: VM %s is listed more than once" %
+                            (source, number, name))
+        seen.add(name)
+        settings = {}
+        for field in fields[1:]:
+            key, _, value = field.partition('=')
+            if key not in params or not value:
+                raise Exception("%s line %d: expected one of %s as "
+                                "key=value, not %s" %
+                                (source, number, ", ".join(params), field))
+            dest, convert = params[key]
+            try:
+                settings[dest] = convert(value)
+            except ValueError as err:
+                raise Exception("%s line %d: %s: %s" %
+                                (source, number, key, err))
+        entries.append((name, settings))
+    return entries
+
+
+def vm_args(args, settings):
+    """
+    A copy of the command line args, with one VM's settings from
+    read_vm_list applied
+    """
+    return argparse.Namespace(**dict(vars(args), **settings))
+
+
+def print_result(**record):
+    """
+    Print one VM's result as a line of JSON, straight away
+    """
+    print(json.dumps(record), flush=True)
+
+
+def forward(script, argv, socket_path=SOCKET_PATH, stdin=None):
+    """
+    Have the daemon run a script, copying its output to ours as it comes
+
+    script - the script's name, eg power
+    argv - the script's command line, without the program name
+    socket_path - where the daemon is listening
+    stdin - text to give the script as its --from-file list, if any
+    return - the script's exit status
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as err:
+        sock.close()
+        raise Exception("No vsphere-tools daemon at %s: %s" %
+                        (socket_path, err))
+    with sock, sock.makefile('rw', encoding='utf-8') as stream:
+        request = {'script': script, 'argv': argv}
+        if stdin is not None:
+            request['stdin'] = stdin
+        stream.write(json.dumps(request) + '\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    raise Exception("The vsphere-tools daemon went away mid-command")
+
+
+def add_profile_args(parser):
+    """
+    Add --profile, and its cProfile and tracemalloc options, to a script's
+    argument parser
+    """
+    parser.add_argument('--profile',
+                        help='print the SOAP calls made to the VC, by \
+                            method, object type and caller, with their \
+                            times and sizes, to stderr at the end',
+                        action='store_true', dest='profile', default=False)
+    parser.add_argument('--profile-python',
+                        help='with --profile, also print the N functions \
+                            with the most cumulative time, in the \
+                            command\'s own thread',
+                        action='store', type=int, metavar='N',
+                        dest='profile_python', default=0)
+    parser.add_argument('--profile-memory',
+                        help='with --profile, also print the N lines that \
+                            allocated the most memory still in use',
+                        action='store', type=int, metavar='N',
+                        dest='profile_memory', default=0)
+
+
+@contextlib.contextmanager
+def profiling(args, stream=None):
+    """
+    Profile what's run in the with block, if asked to with --profile
+
+    args - the parsed args, with profile, profile_python and profile_memory
+    stream - where the reports go, default sys.stderr
+    return - the CallTracer, or None when not profiling
+    """
+    if not getattr(args, 'profile', False):
+        yield None
+        return
+    # pstats alone is a noticeable part of start up, so none of these are
+    # imported unless they're wanted
+    import cProfile  # pylint: disable=import-outside-toplevel
+    import pstats  # pylint: disable=import-outside-toplevel
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+    profiler = None
+    if getattr(args, 'profile_python', 0):
+        profiler = cProfile.Profile()
+    top_memory = getattr(args, 'profile_memory', 0)
+    # only stop tracemalloc if it was started here
+    own_tracemalloc = top_memory and not tracemalloc.is_tracing()
+    if own_tracemalloc:
+        tracemalloc.start()
+    tracer = tools().CallTracer()
+    tracer.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield tracer
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        tracer.stop()
+        snapshot = tracemalloc.take_snapshot() if top_memory else None
+        if own_tracemalloc:
+            tracemalloc.stop()
+        stream = stream or sys.stderr
+        stream.write('\n'.join(tracer.summary()) + '\n')
+        if profiler is not None:
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats(
+                'cumulative').print_stats(args.profile_python)
+            stream.write(report.getvalue())
+        if snapshot is not None:
+            stream.write('\nmemory still allocated, by line\n')
+            for stat in snapshot.statistics('lineno')[:top_memory]:
+                stream.write(str(stat) + '\n')
+        stream.flush()
@@ -3,34 +3,35 @@
 Canary-test
 
 Takes a VM and moves it between hosts, testing for connectivity to help with
-verification that all is well post updates
+verification that all is well post updates.  With several canary VMs, they
+move at once, sharing the hosts out between them.
 
 """
 
-import atexit
-import time
-import ssl
 import argparse
-import getpass
-import configparser
 import os
+import sys
+import threading
 from pathlib import Path
-from pyvim import connect
-from pyvim.connect import Disconnect
-from pyVmomi import vim  # pylint: disable=no-name-in-module
 # If called as a script, we assume vsphere tools is a subdir, and voila.
 # VScode does something odd here, resulting in an import-error
 # If not called as a script, we're assuming it's called from the root 
 # directory, and import accordingly.
+# Run as a script, vsphere_tools (and pyVmomi with it) is only loaded once
+# it's first used, keeping --help and bad arguments quick.
 if __name__ == '__main__':
-    import vsphere_tools # pylint: disable=import-error
+    import bootstrap # pylint: disable=import-error
+    vsphere_tools = bootstrap.lazy_import('vsphere_tools')
 else:
+    from scripts import bootstrap
     from scripts import vsphere_tools
 
 
-def get_args():
+def get_args(argv=None):
     """
     Get and parse the args.
+
+    argv - the command line to parse, default sys.argv
     """
     parser = argparse.ArgumentParser()
 
@@ -47,55 +48,424 @@ def get_args():
     parser.add_argument('-p', help='password', action='store', dest='password')
     parser.add_argument('-q', help='Quiet mode', action='store_false',
                         dest='verbose', default=True)
-    parser.add_argument('-v', help='VM to be canary, by vmname',
-                        action='store', dest='vmname', default=None)
+    parser.add_argument('--reuse-session',
+                        help='reuse the session from the last run, and keep \
+                            this one for the next',
+                        action='store_true', dest='reuse_session',
+                        default=False)
+    parser.add_argument('--daemon',
+                        help='have the running daemon.py do this, using its \
+                            session and VM name cache',
+                        action='store_true', dest='daemon', default=False)
+    parser.add_argument('-v', help='VM to be canary, by vmname; give it \
+                        more than once for several canaries at once',
+                        action='append', dest='vmname', default=None)
+    parser.add_argument('--max-incoming',
+                        help='the most canaries moving to any one host at \
+                            once', action='store', type=int,
+                        dest='max_incoming', default=1)
     parser.add_argument('-w',
                         help='boolean for wait for keypress between moves',
                         action='store_true', dest='waitbetween', default=False)
+    parser.add_argument('--probe', help='how to ping the canary: icmp, tcp \
+                        connects to --probe-port, or auto for icmp where \
+                        allowed', choices=['auto', 'icmp', 'tcp'],
+                        action='store', dest='probe', default='auto')
+    parser.add_argument('--probe-port', help='the port for tcp probes',
+                        action='store', type=int, dest='probe_port',
+                        default=22)
+    parser.add_argument('--probe-count', help='probes for each ping',
+                        action='store', type=int, dest='probe_count',
+                        default=3)
+    parser.add_argument('--probe-timeout',
+                        help='seconds to wait for each probe reply',
+                        action='store', type=float, dest='probe_timeout',
+                        default=1.0)
+    parser.add_argument('--monitor-interval',
+                        help='milliseconds between probes of the canary \
+                            during each vmotion, to measure the outage; \
+                            0 not to', action='store', type=float,
+                        dest='monitor_interval', default=25)
+    parser.add_argument('--max-outage',
+                        help='fail a move that leaves the canary \
+                            unreachable for longer than this many \
+                            milliseconds', action='store', type=float,
+                        dest='max_outage')
+    parser.add_argument('--settle',
+                        help='seconds the canary must answer every probe \
+                            after a move before the next one starts',
+                        action='store', type=float, dest='settle',
+                        default=2.0)
+    parser.add_argument('--ready-timeout',
+                        help='seconds to wait for the canary to settle \
+                            after a move before failing it', action='store',
+                        type=float, dest='ready_timeout', default=60.0)
+    parser.add_argument('--results',
+                        help='write a JSON Lines record of each move\'s \
+                            timings to this file', action='store',
+                        dest='results')
+    parser.add_argument('--compare',
+                        help='compare the timings in two --results files \
+                            host by host, instead of testing',
+                        action='store', nargs=2, metavar=('OLD', 'NEW'),
+                        dest='compare')
+    parser.add_argument('--regression',
+                        help='with --compare, the percent slower a median \
+                            may get before it is flagged', action='store',
+                        type=float, dest='regression', default=20.0)
     parser.add_argument('hosts',
                         help='list of hosts to travel across, by DNS name',
-                        action='store', nargs='+')
+                        action='store', nargs='*')
+
+    bootstrap.add_profile_args(parser)
+    args = parser.parse_args(argv)
+    if not args.hosts and args.compare is None:
+        parser.error("give the hosts to move the canary to, or --compare")
+    return args
+
+
+class CanaryScheduler(object):
+    """
+    Hands hosts out to canaries as they become free, so that every host is
+    visited by one of them, and no host has more than max_incoming
+    vmotions coming in at once.  Thread safe.
+    """
+
+    def __init__(self, hosts, max_incoming=1, writer=None):
+        """
+        hosts - the host objects to visit, in the order to try them
+        max_incoming - the most canaries moving to any one host at once
+        writer - optional RowWriter each host's hop record (see
+                 vsphere_tools.hop_record) is written to as it's tested
+        """
+        self.writer = writer
+        self.pending = list(hosts)
+        self.throttle = vsphere_tools.Throttle({'host': max_incoming})
+        for host in hosts:
+            self.throttle.set_keys(host, [('host', host)])
+        self.locations = {}
+        self.retired = set()
+        self.results = []
+        self.condition = threading.Condition()
+
+    def add_canary(self, name, host):
+        """
+        Say where a canary is starting from
+        """
+        with self.condition:
+            self.locations[name] = host
+
+    def _pick(self, name):
+        current = self.locations.get(name)
+        for host in self.pending:
+            if host != current and self.throttle.allows(host):
+                return host
+        # Only the host this canary is already on (or full ones) are left.
+        # Leave it for another canary, unless every other one is on it too.
+        if current in self.pending and self.throttle.allows(current) and \
+                all(location == current for other, location in
+                    self.locations.items()
+                    if other != name and other not in self.retired):
+            return current
+        return None
+
+    def next_host(self, name):
+        """
+        Wait for a host the canary can move to
+
+        name - the canary
+        return - the host, or None once there are none left for it
+        """
+        with self.condition:
+            while self.pending:
+                host = self._pick(name)
+                if host is not None:
+                    self.pending.remove(host)
+                    self.throttle.acquire(host)
+                    return host
+                self.condition.wait()
+            return None
+
+    def finish(self, name, host, stats=None, error=None, tested=True,
+               timings=None, moved=None):
+        """
+        Record how a canary's move to host went
+
+        stats - the MonitorStats of the move, if it was watched
+        error - what went wrong, None if it passed
+        tested - False if the host wasn't really tried, and should go back
+                 to another canary
+        timings - what do_a_vmotion measured of the move
+        moved - whether the canary is now on host, which it can be even
+                though the move failed, eg its outage was too long or it
+                didn't settle.  Default, if it was tested and passed.
+        """
+        if moved is None:
+            moved = tested and error is None
+        with self.condition:
+            self.throttle.release(host)
+            if not tested:
+                self.pending.insert(0, host)
+            else:
+                self.results.append((host.name, name, stats, error))
+                if self.writer is not None:
+                    self.writer.write(vsphere_tools.hop_record(
+                        host.name, name, timings, stats, error))
+                    self.writer.flush()
+            if moved:
+                self.locations[name] = host
+            self.condition.notify_all()
+
+    def retire(self, name):
+        """
+        Take a canary out of the running
+        """
+        with self.condition:
+            self.retired.add(name)
+            self.condition.notify_all()
 
-    return parser.parse_args()
+    def working(self):
+        """
+        return - the canaries still in the running
+        """
+        with self.condition:
+            return [name for name in self.locations
+                    if name not in self.retired]
 
 
-def canary_test(vc_obj, hosts, canary_id, verbose=True):
+def run_canary(canary, scheduler, verbose=True, probe_options=None,
+               monitor=None, max_outage=None, ready=None):
     """
-    With the connection and canary VM, do pings to verify health,
-    and vmotions to test.
+    Move one canary to each host the scheduler gives it, until there are
+    none left.  A failed move is recorded against the host, and the canary
+    carries on if it still answers; if not, it drops out, and a host it
+    never got to goes back for another canary.  Each move starts as soon
+    as the last one has settled, see vsphere_tools.wait_until_ready.
+
+    canary - (name, vm object, address to ping)
+    scheduler - the CanaryScheduler
+    """
+    name, vm_obj, pingaddr = canary
+    try:
+        move_canary(name, vm_obj, pingaddr, scheduler, verbose,
+                    probe_options, monitor, max_outage, ready)
+    finally:
+        # so no other canary waits on this one for a host
+        scheduler.retire(name)
+
+
+def move_canary(name, vm_obj, pingaddr, scheduler, verbose, probe_options,
+                monitor, max_outage, ready):
+    """
+    The body of run_canary
+    """
+    # pylint: disable=too-many-arguments
+    while True:
+        host = scheduler.next_host(name)
+        if host is None:
+            return
+        timings = {}
+        try:
+            stats = vsphere_tools.do_a_vmotion(vm_obj, host, pingaddr,
+                                               verbose,
+                                               probe_options=probe_options,
+                                               monitor=monitor,
+                                               ready=ready, timings=timings)
+        except Exception as err:  # pylint: disable=broad-except
+            healthy = vsphere_tools.ping(pingaddr, **(probe_options or {}))
+            moved = vm_obj.runtime.host == host
+            scheduler.finish(name, host, error=err,
+                             tested=healthy or moved, timings=timings,
+                             moved=moved)
+            if verbose:
+                print("%s: moving to %s failed: %s" % (name, host.name, err))
+            if not healthy:
+                if verbose:
+                    print("%s: not answering, dropping out" % name)
+                return
+            continue
+        error = None
+        if stats is not None and max_outage is not None and \
+                stats.longest_outage() > max_outage:
+            error = Exception("the canary was unreachable for %.0f ms, over "
+                              "the %.0f ms limit" %
+                              (stats.longest_outage() * 1000,
+                               max_outage * 1000))
+        # the relocate went through even if the outage was too long
+        scheduler.finish(name, host, stats, error, timings=timings,
+                         moved=True)
+        if verbose:
+            print("%s: moved to %s%s" % (name, host.name,
+                                          "" if error is None else
+                                          ", but " + str(error)))
+
+
+def canary_test(vc_obj, hosts, canary_id, verbose=True, probe_options=None,
+                monitor=None, max_outage=None, max_incoming=1, ready=None,
+                results=None, cache=None):
+    """
+    With the connection and canary VMs, do pings to verify health,
+    and vmotions to test.  Canaries move at once, each to the next host
+    that no canary has visited yet.
     :param vc: The active VC connection.
     :param hosts: The list of hosts to migrate between
-    :param canary_id: The identifier for the canary VM, either DNS, or IP
+    :param canary_id: The identifier for the canary VM, either DNS, or IP,
+                      or a list of them for several canaries
     :param verbose: Print out status as it happens.  Default to true
-    :return: Boolean for happiness.  Will also raise exceptions for
-             terrible things.
+    :param probe_options: How to ping the canary, as vsphere_tools.ping's
+                          options, eg {'method': 'tcp', 'port': 443}
+    :param monitor: ProbeMonitor options to watch the canary with during
+                    each vmotion, eg {'interval': 0.025}, None not to
+    :param max_outage: with monitor, the longest outage in seconds a move
+                       may cause before it counts as a failure
+    :param max_incoming: the most canaries moving to one host at once
+    :param ready: vsphere_tools.wait_until_ready options for telling when
+                  a canary has settled after a move, eg {'settle': 5}
+    :param results: optional RowWriter to write each host's hop record to
+    :param cache: optional warm InventoryCache to find the canaries in, eg
+                  the daemon's
+    :return: list of (host name, canary, MonitorStats or None, error or
+             None), one per host tested.  Raises an exception naming the
+             hosts that failed or couldn't be tested, once all the others
+             have been.
     """
+    canary_ids = [canary_id] if isinstance(canary_id, str) else \
+        list(canary_id)
+    vm_objs, missing = vsphere_tools.resolve_vms(vc_obj, canary_ids,
+                                                 cache=cache)
+    if missing:
+        raise Exception("Cannot find VMs named " + ", ".join(missing))
+    canaries = []
+    for this_id in canary_ids:
+        vm_obj = vm_objs[this_id]
+        if vm_obj.guest.ipAddress is None:
+            pingaddr = this_id
+        else:
+            pingaddr = vm_obj.guest.ipAddress
+        if verbose:
+            print("* Found VM : " + vm_obj.name)
+        canaries.append((this_id, vm_obj, pingaddr))
 
-    vm_obj = vsphere_tools.get_obj(vc_obj.RetrieveContent(),
-                                   [vim.VirtualMachine], canary_id)
-    if vm_obj.guest.ipAddress is None:
-        pingaddr = canary_id
-    else:
-        pingaddr = vm_obj.guest.ipAddress
+    hostobj = vsphere_tools.find_hosts(vc_obj, hosts)
+    if verbose:
+        for newhost in hostobj:
+            print("* Found host: " + newhost.name)
 
+    scheduler = CanaryScheduler(hostobj, max_incoming, results)
+    for name, vm_obj, _ in canaries:
+        scheduler.add_canary(name, vm_obj.runtime.host)
+    crashed = vsphere_tools.run_parallel(
+        lambda canary: run_canary(canary, scheduler, verbose, probe_options,
+                                  monitor, max_outage, ready),
+        [(name, (name, vm_obj, pingaddr))
+         for name, vm_obj, pingaddr in canaries], len(canaries))
+
+    failed = ["%s (%s)" % (host_name, error)
+              for host_name, _, _, error in scheduler.results
+              if error is not None]
+    untested = [host.name for host in scheduler.pending]
     if verbose:
-        print("* Found VM : " + vm_obj.name)
+        print("---------")
+        print("* Results by host:")
+        for host_name, name, stats, error in scheduler.results:
+            print("  %s - %s - %s%s" % (
+                host_name, name, "ok" if error is None else
+                "FAILED: %s" % error,
+                "" if stats is None else " - %s" % stats))
+        for host_name in untested:
+            print("  %s - not tested, no canary left to try it" % host_name)
+    for name, error in crashed.items():
+        if error is not None:
+            print("%s stopped: %s" % (name, error), file=sys.stderr)
+    if failed or untested:
+        raise Exception("Canary test failed for hosts: %s%s" % (
+            ", ".join(failed) or "none",
+            "; not tested: " + ", ".join(untested) if untested else ""))
+    return scheduler.results
 
-    hostobj = []
-    for host in hosts:
-        newhost = vsphere_tools.find_host(vc_obj, host)
-        if verbose:
-            print("* Found host: " + newhost.name)
-        hostobj.append(newhost)
 
-    for host in hostobj:
-        vsphere_tools.do_a_vmotion(vm_obj, host, pingaddr, verbose)
-        if hostobj.index(host) != len(hostobj)-1:
-            if verbose:
-                print("waiting for 10 seconds between moves")
-            time.sleep(10)
-        if verbose:
-            print("---------")
+def probe_options(args):
+    """
+    The ping options from the args
+    """
+    return {'method': args.probe, 'port': args.probe_port,
+            'count': args.probe_count, 'timeout': args.probe_timeout}
+
+
+def compare_runs(old, new, regression=20.0):
+    """
+    Print the timings of two --results files side by side, host by host
+
+    old, new - the files
+    regression - percent a median may go up by before it's flagged
+    return - the (host, metric) pairs flagged
+    """
+    old_hops = vsphere_tools.read_hops(old)
+    new_hops = vsphere_tools.read_hops(new)
+    print("%-24s %-12s %5s %10s %10s %5s %10s %10s %8s" % (
+        'host', 'metric', 'old n', 'median', 'stdev', 'new n', 'median',
+        'stdev', 'change'))
+
+    def number(value):
+        return '-' if value is None else '%.2f' % value
+
+    flagged = []
+    for host, metric, before, after, change in vsphere_tools.compare_hops(
+            old_hops, new_hops):
+        slower = change is not None and change * 100 > regression
+        if slower:
+            flagged.append((host, metric))
+        print("%-24s %-12s %5d %10s %10s %5d %10s %10s %8s%s" % (
+            host, metric, before['n'], number(before['median']),
+            number(before['stdev']), after['n'], number(after['median']),
+            number(after['stdev']),
+            '-' if change is None else '%+.0f%%' % (change * 100),
+            ' SLOWER' if slower else ''))
+    old_failed = vsphere_tools.hop_failures(old_hops)
+    new_failed = vsphere_tools.hop_failures(new_hops)
+    for host in sorted(set(old_failed) | set(new_failed)):
+        before = old_failed.get(host, (0, 0))
+        after = new_failed.get(host, (0, 0))
+        if before[0] or after[0]:
+            print("%s: %d/%d moves failed before, %d/%d now" %
+                  (host, before[0], before[1], after[0], after[1]))
+    return flagged
+
+
+def run(args, si_obj, cache=None):
+    """
+    Do the vmotions and testing, once connected
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - a warm InventoryCache to find the canaries in, eg the daemon's
+    """
+    if args.compare is not None:
+        compare_runs(args.compare[0], args.compare[1], args.regression)
+        return
+    monitor = None
+    if args.monitor_interval > 0:
+        monitor = {'interval': args.monitor_interval / 1000.0}
+    max_outage = None
+    if args.max_outage is not None:
+        if monitor is None:
+            raise Exception("--max-outage needs --monitor-interval")
+        max_outage = args.max_outage / 1000.0
+    if not args.vmname:
+        raise Exception("No canary VM given, use -v")
+    results = None
+    if args.results is not None:
+        results = vsphere_tools.get_writer('jsonl', args.results,
+                                           vsphere_tools.HOP_COLUMNS)
+    try:
+        canary_test(si_obj, args.hosts, args.vmname, args.verbose,
+                    probe_options(args), monitor, max_outage,
+                    args.max_incoming,
+                    {'settle': args.settle, 'timeout': args.ready_timeout},
+                    results=results, cache=cache)
+    finally:
+        if results is not None:
+            results.close()
 
 
 def main():
@@ -103,46 +473,18 @@ def main():
     Collect the args, vet them, and then do the vmotion and testing.
     """
     args = get_args()
-    # setup inifile
-    configfile = configparser.ConfigParser()
-
-    if not configfile.read(args.configfile):
-        use_config = False
-    else:
-        use_config = True
-
-    if args.vc is None:
-        if args.dc == "NONE":
-            raise Exception("No VC and no DC specified.")
-        if use_config:
-            server = configfile["DC-"+args.dc.upper()].get("SERVER", "NONE")
-        if server != "NONE":
-            args.vc = server
-            if use_config:
-                args.user = configfile["DC-"+args.dc.upper()].get("USERNAME",
-                                                                  "FOO")
-        else:
-            raise Exception("No server/DC matching command line options found")
-
-    if args.password:
-        password = args.password
-    else:
-        password = getpass.getpass(
-            prompt='Enter password for host %s and user %s: ' %
-            (args.vc, args.user))
-
+    if args.compare is not None:
+        # nothing to connect to
+        run(args, None)
+        return
+    if args.daemon:
+        sys.exit(bootstrap.forward('canarytest', sys.argv[1:]))
     if args.verbose:
         print("* Prework")
 
-    context = None
-    # pylint: disable=protected-access
-    context = ssl._create_unverified_context()
-    si_obj = connect.Connect(host=args.vc, user=args.user, pwd=password,
-                             sslContext=context)
-
-    atexit.register(Disconnect, si_obj)
-
-    canary_test(si_obj, args.hosts, args.vmname, args.verbose)
+    with bootstrap.profiling(args):
+        si_obj = bootstrap.connect(args)
+        run(args, si_obj)
 
 
 if __name__ == '__main__':
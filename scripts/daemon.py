@@ -0,0 +1,399 @@
+#!/usr/local/bin/python3
+"""
+daemon.py
+
+Keeps a logged in session, and a warm VM name cache, for each vCenter in the
+ini file, and runs power.py, snapshots.py, canarytest.py and lookup.py
+commands sent to it over a Unix socket by those scripts' --daemon option.
+A command run that way skips the login and the inventory scan, and starts
+working on the VMs straight away.
+
+The protocol is one JSON object per line.  The client sends
+{"script": name, "argv": [args]}, plus "stdin": text for a --from-file list,
+and gets back {"stdout": text} and {"stderr": text} as the script prints,
+then {"exit": status}.
+"""
+
+import argparse
+import contextvars
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+if __name__ == '__main__':
+    # The scripts import from scripts. when they aren't run directly
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+from scripts import bootstrap, canarytest, lookup, power, snapshots
+from scripts import vsphere_tools
+
+# the scripts the daemon will run, by the name the clients send
+SCRIPTS = {'power': power, 'snapshots': snapshots, 'canarytest': canarytest,
+           'lookup': lookup}
+# seconds between bringing the caches up to date, which also keeps the
+# sessions from timing out
+REFRESH_INTERVAL = 300
+
+# the client of the command being run, if any.  A context variable rather
+# than a thread local, so that run_parallel's worker threads, which run in a
+# copy of the submitting thread's context, print to the same client.
+REQUEST = contextvars.ContextVar('REQUEST', default=None)
+
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout or sys.stderr, sending what's printed while
+    running a command back to that command's client
+    """
+
+    def __init__(self, default, name):
+        """
+        default - where output from anything else goes, eg sys.stdout
+        name - the message key it's sent to clients under, stdout or stderr
+        """
+        self.default = default
+        self.name = name
+
+    def write(self, text):
+        """
+        Write text to the current command's client, or the default stream
+        """
+        client = REQUEST.get()
+        if client is None:
+            return self.default.write(text)
+        client.send({self.name: text})
+        return len(text)
+
+    def flush(self):
+        """
+        Clients are sent each write as it happens
+        """
+        if REQUEST.get() is None:
+            self.default.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+def install_output():
+    """
+    Route sys.stdout and sys.stderr through ThreadOutput
+
+    return - the (stdout, stderr) being replaced
+    """
+    previous = (sys.stdout, sys.stderr)
+    sys.stdout = ThreadOutput(previous[0], 'stdout')
+    sys.stderr = ThreadOutput(previous[1], 'stderr')
+    return previous
+
+
+def exit_status(code):
+    """
+    The exit status for a SystemExit code, as the interpreter would work it
+    out
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+class Target(object):
+    """
+    One logged in vCenter, with its VM name cache kept up to date, and its
+    AddressIndex once lookup.py has needed it
+    """
+
+    def __init__(self, si_obj, section):
+        """
+        si_obj - the connection to the VC
+        section - the cache section (see cache_section) for the VC
+        """
+        self.si_obj = si_obj
+        self.cache = vsphere_tools.InventoryCache(si_obj, section)
+        self.address_index = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Bring the cache, and the address index if there is one, up to date,
+        rebuilding the cache if its collector is gone
+        """
+        with self.lock:
+            if not self.cache.update():
+                self.cache.rebuild()
+            if self.address_index is not None:
+                self.address_index.update()
+
+    def addresses(self):
+        """
+        The AddressIndex of the VC, built the first time it's asked for and
+        brought up to date each time after
+        """
+        with self.lock:
+            if self.address_index is None:
+                self.address_index = vsphere_tools.AddressIndex(
+                    self.si_obj.RetrieveContent())
+            else:
+                self.address_index.update()
+            return self.address_index
+
+    def resolve(self, names):
+        """
+        Resolve VM names from the cache, as InventoryCache.resolve
+        """
+        with self.lock:
+            return self.cache.resolve(names)
+
+
+class Daemon(object):
+    """
+    The sessions and caches, and running commands with them
+    """
+
+    def __init__(self, scripts=None, reuse=False):
+        """
+        scripts - {name: module}, each with get_args(argv) and
+                  run(args, si_obj, cache), default SCRIPTS
+        reuse - reuse saved sessions, as --reuse-session
+        """
+        self.scripts = SCRIPTS if scripts is None else scripts
+        self.reuse = reuse
+        self.targets = {}
+        self.lock = threading.Lock()
+
+    def add_target(self, server, user, password=None, port=443,
+                   section=None):
+        """
+        Log in to a VC and warm up its cache
+
+        section - the cache section, default the server name
+        return - the Target
+        """
+        si_obj = vsphere_tools.connect_vc(server, user, password, port,
+                                          self.reuse)
+        target = Target(si_obj, section or server)
+        with self.lock:
+            self.targets[(server, user, port)] = target
+        return target
+
+    def target(self, args):
+        """
+        The Target a command's args are for, logging in with the command's
+        password if there isn't one yet
+        """
+        bootstrap.read_config(args)
+        with self.lock:
+            target = self.targets.get((args.vc, args.user, args.port))
+        if target is not None:
+            return target
+        if args.password is None:
+            raise Exception("The daemon has no session for %s@%s:%d, and "
+                            "no password was given" %
+                            (args.user, args.vc, args.port))
+        return self.add_target(args.vc, args.user, args.password, args.port,
+                               vsphere_tools.cache_section(args.dc,
+                                                           args.vc))
+
+    def run(self, name, argv, stdin=None):
+        """
+        Run a script's command line
+
+        name - the script, eg power
+        argv - its command line, without the program name
+        stdin - the client's --from-file list, read by the client, since
+                the file (or stdin) is only there for it
+        return - the exit status
+        """
+        if name not in self.scripts:
+            raise Exception("Unknown script " + name)
+        module = self.scripts[name]
+        args = module.get_args(argv)
+        if stdin is not None:
+            args.from_file = '-'
+            args.stdin = io.StringIO(stdin)
+        target = self.target(args)
+        with bootstrap.profiling(args):
+            module.run(args, target.si_obj, target)
+        return 0
+
+    def refresh(self):
+        """
+        Bring every cache up to date.  A VC that has logged the daemon out is
+        dropped, to be logged in to again by the next command with a password.
+        """
+        with self.lock:
+            targets = list(self.targets.items())
+        for key, target in targets:
+            try:
+                target.refresh()
+            except vim.fault.NotAuthenticated:
+                print("Session for %s@%s:%d has gone, dropping it" %
+                      (key[1], key[0], key[2]), file=sys.stderr)
+                with self.lock:
+                    self.targets.pop(key, None)
+            except Exception as err:  # pylint: disable=broad-except
+                print("Refreshing %s failed: %s" % (key[0], err),
+                      file=sys.stderr)
+
+    def refresh_loop(self, interval=REFRESH_INTERVAL):
+        """
+        refresh() every interval seconds, forever
+        """
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Run one command from a client
+    """
+
+    def setup(self):
+        super().setup()
+        # a command's worker threads may all be printing at once
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        """
+        Send the client a message.  A client that has gone away doesn't stop
+        the command.
+        """
+        try:
+            with self.send_lock:
+                self.wfile.write((json.dumps(message) + '\n').encode(
+                    'utf-8'))
+                self.wfile.flush()
+        except OSError:
+            pass
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        token = REQUEST.set(self)
+        try:
+            request = json.loads(line.decode('utf-8'))
+            status = self.server.daemon.run(request['script'],
+                                            request.get('argv', []),
+                                            request.get('stdin'))
+        except SystemExit as err:
+            status = exit_status(err.code)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        finally:
+            REQUEST.reset(token)
+        self.send({'exit': status})
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """
+    The socket server, running each command in its own thread
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        """
+        socket_path - where to listen; only the user can connect to it
+        daemon - the Daemon to run commands with
+        """
+        self.daemon = daemon
+        os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+        remove_stale_socket(socket_path)
+        umask = os.umask(0o177)
+        try:
+            socketserver.ThreadingUnixStreamServer.__init__(
+                self, socket_path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket left behind by a daemon that's no longer running
+    """
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+        return
+    finally:
+        sock.close()
+    raise Exception("A daemon is already listening on " + socket_path)
+
+
+def get_args():
+    """
+    Get and parse the args.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-f', help='The config file to use', action='store',
+                        dest='configfile', default=str(Path.home()) +
+                        os.path.sep + 'vsphere-tools.ini')
+    parser.add_argument('--dc', help="DC to log in to at start up, may be \
+                        given more than once; default every DC in the ini \
+                        file", action='append', dest='dc')
+    parser.add_argument('-o', help='the port to connect to', action='store',
+                        default=443, type=int, dest='port')
+    parser.add_argument('-p', help='password, the same for every VC',
+                        action='store', dest='password')
+    parser.add_argument('--reuse-session',
+                        help='reuse saved sessions, and keep new ones',
+                        action='store_true', dest='reuse_session',
+                        default=False)
+    parser.add_argument('--socket', help='the Unix socket to listen on',
+                        action='store', dest='socket',
+                        default=bootstrap.SOCKET_PATH)
+    parser.add_argument('--refresh',
+                        help='seconds between cache updates/keepalives',
+                        action='store', type=int, dest='refresh',
+                        default=REFRESH_INTERVAL)
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Log in to every VC, then serve commands until killed
+    """
+    args = get_args()
+    daemon = Daemon(reuse=args.reuse_session)
+    for server, user, section in bootstrap.config_targets(args.configfile,
+                                                          args.dc):
+        print("* Logging in to %s as %s" % (server, user))
+        daemon.add_target(server, user, args.password, args.port, section)
+
+    install_output()
+    threading.Thread(target=daemon.refresh_loop, args=(args.refresh,),
+                     daemon=True).start()
+    server = Server(args.socket, daemon)
+    print("* Listening on " + args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/local/bin/python3
+"""
+lookup.py
+
+Finds the VMs (and hosts) behind IP addresses and DNS names, eg from
+monitoring alerts.  Every VM's guest addresses and host name are fetched in
+one go, and the lookups answered locally, so thousands of them cost the same
+as one.  Each result is printed as a line of JSON, with the names of every
+match, so an IP more than one VM claims shows up as a collision.
+"""
+
+import argparse
+from pathlib import Path
+import ipaddress
+import os
+import sys
+# If called as a script, we assume vsphere tools is a subdir, and voila.
+# Run as a script, vsphere_tools (and pyVmomi with it) is only loaded once
+# it's first used, keeping --help and bad arguments quick.
+if __name__ == '__main__':
+    import bootstrap # pylint: disable=import-error
+    vsphere_tools = bootstrap.lazy_import('vsphere_tools')
+else:
+    from scripts import bootstrap
+    from scripts import vsphere_tools
+
+
+def get_args(argv=None):
+    """
+    Get and parse the args.
+
+    argv - the command line to parse, default sys.argv
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-f', help='The config file to use', action='store',
+                        dest='configfile', default=str(Path.home()) +
+                        os.path.sep + 'vsphere-tools.ini')
+    parser.add_argument('--dc', help="DC to use for ini file parsing",
+                        dest="dc", default="NONE")
+    parser.add_argument('-s', help='The VC to connect to', action='store',
+                        dest='vc', default="NONE")
+    parser.add_argument('-o', help='the port to connect to', action='store',
+                        default=443, type=int, dest='port')
+    parser.add_argument('-u', help='user name', action='store', dest='user')
+    parser.add_argument('-p', help='password', action='store', dest='password')
+    parser.add_argument('--reuse-session',
+                        help='reuse the session from the last run, and keep \
+                            this one for the next',
+                        action='store_true', dest='reuse_session',
+                        default=False)
+    parser.add_argument('--daemon',
+                        help='have the running daemon.py do this, using its \
+                            session and address index',
+                        action='store_true', dest='daemon', default=False)
+    parser.add_argument('--from-file',
+                        help='read the addresses and names, one per line, \
+                            from this file (- for stdin)',
+                        action='store', dest='from_file')
+    parser.add_argument('--collisions',
+                        help='list every IP address more than one VM has',
+                        action='store_true', dest='collisions', default=False)
+    parser.add_argument('address', help='IP addresses or DNS names to look \
+                        up', action='store', nargs='*')
+    bootstrap.add_profile_args(parser)
+    args = parser.parse_args(argv)
+    if not args.address and args.from_file is None and not args.collisions:
+        parser.error("give addresses, --from-file or --collisions")
+    return args
+
+
+def read_addresses(source, stdin=None):
+    """
+    The addresses of a --from-file list, skipping blank lines and anything
+    after a #
+    """
+    return [line.split('#')[0].strip()
+            for line in bootstrap.read_source(source, stdin).splitlines()
+            if line.split('#')[0].strip()]
+
+
+def is_ip(address):
+    """
+    True if address is an IP address rather than a name
+    """
+    try:
+        ipaddress.ip_address(address.split('%')[0])
+    except ValueError:
+        return False
+    return True
+
+
+def lookup(index, address):
+    """
+    Look one address or name up
+
+    index - the AddressIndex
+    return - the result record: the query, the names of the VMs/hosts
+             found, and whether more than one VM has that IP
+    """
+    by_ip = is_ip(address)
+    found = index.find_ip(address) if by_ip else index.find_name(address)
+    return {'query': address,
+            'matches': sorted(str(index.name_of(obj)) for obj in found),
+            'collision': by_ip and len(found) > 1}
+
+
+def run(args, si_obj, cache=None):
+    """
+    Do the lookups, once connected
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - the daemon's Target, whose warm AddressIndex is used if given
+    """
+    addresses = list(args.address)
+    if args.from_file is not None:
+        addresses += read_addresses(args.from_file,
+                                    getattr(args, 'stdin', None))
+    if cache is not None:
+        index = cache.addresses()
+    else:
+        index = vsphere_tools.AddressIndex(si_obj.RetrieveContent())
+    try:
+        for address in addresses:
+            bootstrap.print_result(**lookup(index, address))
+        if args.collisions:
+            for address, objs in sorted(index.collisions().items()):
+                bootstrap.print_result(ip=address, vms=sorted(
+                    str(index.name_of(obj)) for obj in objs))
+    finally:
+        if cache is None:
+            index.close()
+
+
+def main():
+    """
+    Collect the args, connect, and look the addresses up
+    """
+    args = get_args()
+    if args.daemon:
+        addresses = None
+        if args.from_file is not None:
+            addresses = bootstrap.read_source(args.from_file)
+        sys.exit(bootstrap.forward('lookup', sys.argv[1:], stdin=addresses))
+
+    with bootstrap.profiling(args):
+        si_obj = bootstrap.connect(args)
+        run(args, si_obj)
+
+
+if __name__ == '__main__':
+    main()
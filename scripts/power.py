@@ -5,29 +5,35 @@ power.py
 Used to manage (on, off) power state for a vm
 """
 
-import atexit
-import ssl
 import argparse
-import getpass
-import configparser
 from pathlib import Path
 import os
-from pyvim import connect
-from pyvim.connect import Disconnect
-from pyVmomi import vim  # pylint: disable=no-name-in-module
+import sys
 # If called as a script, we assume vsphere tools is a subdir, and voila.
 # VScode does something odd here, resulting in an import-error
 # If not called as a script, we're assuming it's called from the root 
 # directory, and import accordingly.
+# Run as a script, vsphere_tools (and pyVmomi with it) is only loaded once
+# it's first used, keeping --help and bad arguments quick.
 if __name__ == '__main__':
-    import vsphere_tools # pylint: disable=import-error
+    import bootstrap # pylint: disable=import-error
+    vsphere_tools = bootstrap.lazy_import('vsphere_tools')
 else:
+    from scripts import bootstrap
     from scripts import vsphere_tools
 
+# what can be set for each VM in a --from-file list: key: (dest, convert)
+VM_SETTINGS = {
+    'operation': ('operation', bootstrap.choice('on', 'off', 'reboot',
+                                                'query')),
+    'force': ('hardware', bootstrap.flag)}
 
-def get_args():
+
+def get_args(argv=None):
     """
     Get and parse the args.
+
+    argv - the command line to parse, default sys.argv
     """
     parser = argparse.ArgumentParser()
 
@@ -44,14 +50,203 @@ def get_args():
     parser.add_argument('-p', help='password', action='store', dest='password')
     parser.add_argument('-q', help='Quiet mode', action='store_false',
                         dest='verbose', default=True)
+    parser.add_argument('--reuse-session',
+                        help='reuse the session from the last run, and keep \
+                            this one for the next',
+                        action='store_true', dest='reuse_session',
+                        default=False)
+    parser.add_argument('--daemon',
+                        help='have the running daemon.py do this, using its \
+                            session and VM name cache',
+                        action='store_true', dest='daemon', default=False)
+    parser.add_argument('--cache', help='use the on-disk VM name cache',
+                        action='store_true', dest='cache', default=False)
     parser.add_argument('operation', help='Operation, on, off, reboot, or \
         query the status', choices=['on', 'off', 'reboot', 'query'],
                         default='query', action='store')
     parser.add_argument('vmname', help='The name of the VM to operate on',
-                        action='store', nargs="+")
+                        action='store', nargs="*")
+    parser.add_argument('--from-file',
+                        help='read the VMs, one per line, from this file \
+                            (- for stdin) instead, and print each result \
+                            as a line of JSON',
+                        action='store', dest='from_file')
     parser.add_argument('--force', help="do a hard shutdown/restart",
                         action="store_true", dest="hardware", default=False)
-    return parser.parse_args()
+    parser.add_argument('--parallel', help='number of VMs to work on at once',
+                        action='store', type=int, dest='parallel', default=1)
+    bootstrap.add_profile_args(parser)
+    args = parser.parse_args(argv)
+    if bool(args.vmname) == (args.from_file is not None):
+        parser.error("give either VM names or --from-file")
+    if args.from_file is not None:
+        # stdout is for the results
+        args.verbose = False
+    return args
+
+
+def power_operation(vm_obj, args, verbose):
+    """
+    Do the requested power operation to one VM
+
+    vm_obj - the VM
+    args - the parsed command line args
+    verbose - print out statements
+    """
+    if args.operation == "on":
+        vsphere_tools.vm_poweron(vm_obj, verbose)
+    elif args.operation == "off":
+        vsphere_tools.vm_poweroff(vm_obj, args.hardware, verbose)
+    elif args.operation == "reboot":
+        vsphere_tools.vm_reboot(vm_obj, args.hardware, verbose)
+    elif args.operation == "query":
+        print("%s is %s" % (vm_obj.name, vm_obj.runtime.powerState))
+    else:
+        raise Exception(
+            "only supporting on, and off, and query, and yet somehow, \
+                you got to this error")
+
+
+def start_power_task(vm_obj, args):
+    """
+    Start the requested power operation on one VM without waiting for it
+
+    vm_obj - the VM
+    args - the parsed command line args
+    return - the task started, or None if there's nothing to wait for
+    """
+    if args.operation == "on":
+        return vm_obj.PowerOnVM_Task()
+    if args.operation == "off" and args.hardware:
+        return vm_obj.PowerOffVM_Task()
+    if args.operation == "reboot" and args.hardware:
+        return vm_obj.ResetVM_Task()
+    power_operation(vm_obj, args, False)
+    return None
+
+
+def power_parallel(vm_objs, args, vm_args=None, stream=False):
+    """
+    Do the requested power operation to up to args.parallel VMs at once,
+    waiting on all the running tasks together and reporting on each as it
+    finishes.  A failure doesn't stop the rest,
+    but an exception naming all the failed VMs is raised at the end.
+
+    vm_objs - {vmname: vm object}
+    args - the parsed command line args
+    vm_args - optional {vmname: args} for VMs with their own settings
+    stream - report each VM as a line of JSON
+    """
+    vm_args = vm_args or {}
+    args_for = dict((vm_obj, vm_args.get(name, args))
+                    for name, vm_obj in vm_objs.items())
+
+    def report(name, error):
+        if stream:
+            result = {'vm': name,
+                      'operation': args_for[vm_objs[name]].operation,
+                      'status': 'ok' if error is None else 'failed'}
+            if error is not None:
+                result['error'] = str(error)
+            bootstrap.print_result(**result)
+        elif error is not None:
+            print("* %s failed: %s" % (name, error))
+        elif args.verbose:
+            print("* %s done" % name)
+
+    if args.verbose:
+        print("* Working on %d VMs, %d at a time" % (len(vm_objs),
+                                                     args.parallel))
+    results = vsphere_tools.run_tasks(
+        lambda vm_obj: start_power_task(vm_obj, args_for[vm_obj]),
+        list(vm_objs.items()), args.parallel, report)
+    failed = [name for name, error in results.items() if error is not None]
+    if failed:
+        raise Exception("Power %s failed for %d of %d VMs: %s" %
+                        ("operations" if vm_args else args.operation,
+                         len(failed), len(results),
+                         ", ".join(failed)))
+
+
+def run_from_file(args, si_obj, cache=None):
+    """
+    Perform the power operations on the VMs of a --from-file list, with one
+    lookup for all of them, printing a line of JSON for each as it's done.
+    VMs that are missing or fail don't stop the rest, but an exception is
+    raised at the end if there were any.
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - a warm InventoryCache to find the VMs in, eg the daemon's
+    """
+    entries = bootstrap.read_vm_list(args.from_file, VM_SETTINGS,
+                                     getattr(args, 'stdin', None))
+    section = None
+    if args.cache:
+        section = vsphere_tools.cache_section(args.dc, args.vc)
+    vm_objs, missing = vsphere_tools.resolve_vms(
+        si_obj, [name for name, _ in entries], section, cache)
+    for name in missing:
+        bootstrap.print_result(vm=name, status='missing')
+
+    vm_args = dict((name, bootstrap.vm_args(args, settings))
+                   for name, settings in entries if name in vm_objs)
+    queries = [name for name in vm_args
+               if vm_args[name].operation == 'query']
+    if queries:
+        # every power state in one go
+        states = dict(
+            (vm_obj, props.get('runtime.powerState')) for vm_obj, props in
+            vsphere_tools.collect_object_properties(
+                si_obj.RetrieveContent(),
+                [vm_objs[name] for name in queries],
+                ['runtime.powerState']))
+        for name in queries:
+            bootstrap.print_result(vm=name, operation='query', status='ok',
+                                   power_state=str(states.get(
+                                       vm_objs[name])))
+    changes = dict((name, vm_objs[name]) for name in vm_args
+                   if name not in queries)
+    errors = []
+    if missing:
+        errors.append("Cannot find VMs named " + ", ".join(missing))
+    if changes:
+        try:
+            power_parallel(changes, args, vm_args, stream=True)
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(str(err))
+    if errors:
+        raise Exception("; ".join(errors))
+
+
+def run(args, si_obj, cache=None):
+    """
+    Perform the power operation on the VMs, once connected
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - a warm InventoryCache to find the VMs in, eg the daemon's
+    """
+    if args.from_file is not None:
+        run_from_file(args, si_obj, cache)
+        return
+    if args.verbose:
+        print("* Finding VMs to work with: %s" % ", ".join(args.vmname))
+    section = None
+    if args.cache:
+        section = vsphere_tools.cache_section(args.dc, args.vc)
+    vm_objs, missing = vsphere_tools.resolve_vms(si_obj, args.vmname,
+                                                 section, cache)
+    if missing:
+        raise Exception("Cannot find VMs named " + ", ".join(missing))
+    if args.verbose:
+        print("* Found them all")
+
+    if args.parallel > 1:
+        power_parallel(vm_objs, args)
+    else:
+        for this_vm in args.vmname:
+            power_operation(vm_objs[this_vm], args, args.verbose)
 
 
 def main():
@@ -61,63 +256,18 @@ def main():
         (default) or forced
     """
     args = get_args()
+    if args.daemon:
+        vm_list = None
+        if args.from_file is not None:
+            vm_list = bootstrap.read_source(args.from_file)
+        sys.exit(bootstrap.forward('power', sys.argv[1:], stdin=vm_list))
 
     if args.verbose:
         print("* Prework")
 
-    # setup inifile
-    configfile = configparser.ConfigParser()
-    configfile.read(args.configfile)
-
-    if args.vc == "NONE":
-        if args.dc == "NONE":
-            raise Exception("No VC and no DC specified.")
-        server = configfile["DC-"+args.dc.upper()].get("SERVER", "NONE")
-        if server != "NONE":
-            args.vc = server
-            args.user = configfile["DC-"+args.dc.upper()].get(
-                "USERNAME", "FOO")
-        else:
-            raise Exception("No server/DC matching command line options found")
-
-    if args.password:
-        password = args.password
-    else:
-        password = getpass.getpass(
-            prompt='Enter password for host %s and user %s: ' %
-            (args.vc, args.user))
-
-    context = None
-    # pylint: disable=protected-access
-    context = ssl._create_unverified_context()
-    si_obj = connect.Connect(host=args.vc, user=args.user, pwd=password,
-                             sslContext=context)
-
-    atexit.register(Disconnect, si_obj)
-
-    for this_vm in args.vmname:
-        if args.verbose:
-            print("* Finding VM to work with: %s" % this_vm)
-        vm_obj = vsphere_tools.get_obj(si_obj.RetrieveContent(),
-                                       [vim.VirtualMachine],
-                                       this_vm)
-        if vm_obj is not None:
-            if args.verbose:
-                print("** Found it")
-        else:
-            raise Exception("Cannot find VM named "+this_vm)
-        if args.operation == "on":
-            vsphere_tools.vm_poweron(vm_obj, args.verbose)
-        elif args.operation == "off":
-            vsphere_tools.vm_poweroff(vm_obj, args.hardware, args.verbose)
-        elif args.operation == "reboot":
-            vsphere_tools.vm_reboot(vm_obj, args.hardware, args.verbose)
-        elif args.operation == "query":
-            print("%s is %s" % (vm_obj.name, vm_obj.runtime.powerState))
-        else:
-            raise Exception(
-                "only supporting on, and off, and query, and yet somehow, \
-                    you got to this error")
+    with bootstrap.profiling(args):
+        si_obj = bootstrap.connect(args)
+        run(args, si_obj)
 
 
 if __name__ == '__main__':
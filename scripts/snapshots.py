@@ -5,29 +5,37 @@ snapshots.py
 Used to manage (create, delete, list) snapshots for a vm
 """
 
-import ssl
 import argparse
-import getpass
-import atexit
-import configparser
 import os
+import sys
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from pyvim import connect
-from pyvim.connect import Disconnect
-from pyVmomi import vim  # pylint: disable=no-name-in-module
 # If called as a script, we assume vsphere tools is a subdir, and voila.
 # VScode does something odd here, resulting in an import-error
 # If not called as a script, we're assuming it's called from the root 
 # directory, and import accordingly.
+# Run as a script, vsphere_tools (and pyVmomi with it) is only loaded once
+# it's first used, keeping --help and bad arguments quick.
 if __name__ == '__main__':
-    import vsphere_tools # pylint: disable=import-error
+    import bootstrap # pylint: disable=import-error
+    vsphere_tools = bootstrap.lazy_import('vsphere_tools')
 else:
+    from scripts import bootstrap
     from scripts import vsphere_tools
 
+# what can be set for each VM in a --from-file list: key: (dest, convert)
+VM_SETTINGS = {
+    'operation': ('operation', bootstrap.choice('create', 'delete', 'revert',
+                                                'list')),
+    'snapname': ('snapname', str),
+    'older_than': ('older_than', float)}
 
-def get_args():
+
+def get_args(argv=None):
     """
     Get and parse the args.
+
+    argv - the command line to parse, default sys.argv
     """
     parser = argparse.ArgumentParser()
 
@@ -44,73 +52,302 @@ def get_args():
     parser.add_argument('-p', help='password', action='store', dest='password')
     parser.add_argument('-q', help='Quiet mode', action='store_false',
                         dest='verbose', default=True)
+    parser.add_argument('--reuse-session',
+                        help='reuse the session from the last run, and keep \
+                            this one for the next',
+                        action='store_true', dest='reuse_session',
+                        default=False)
+    parser.add_argument('--daemon',
+                        help='have the running daemon.py do this, using its \
+                            session and VM name cache',
+                        action='store_true', dest='daemon', default=False)
+    parser.add_argument('--cache', help='use the on-disk VM name cache',
+                        action='store_true', dest='cache', default=False)
     parser.add_argument('operation', help='Operation',
                         choices=['create', 'delete', 'revert', 'list'],
                         default='list', action='store')
     parser.add_argument('vmname', help='The name of the VM to operate on',
-                        action='store', nargs="+")
+                        action='store', nargs="*")
+    parser.add_argument('--from-file',
+                        help='read the VMs, one per line, from this file \
+                            (- for stdin) instead, and print each result \
+                            as a line of JSON',
+                        action='store', dest='from_file')
     parser.add_argument('--snapname',
                         help='for create/delete/revert operations,\
                              the name of the snapshot',
                         action='store', dest='snapname')
+    parser.add_argument('--older-than',
+                        help='for delete operations, delete every snapshot \
+                            older than this many days instead of snapname',
+                        action='store', type=float, dest='older_than')
+    parser.add_argument('--parallel',
+                        help='number of VMs to work on at once for \
+                            create/delete/revert operations',
+                        action='store', type=int, dest='parallel', default=1)
+    parser.add_argument('--per-datastore',
+                        help='with --parallel, the most snapshot operations \
+                            to run at once on any one datastore',
+                        action='store', type=int, dest='per_datastore',
+                        default=2)
+    parser.add_argument('--per-host',
+                        help='with --parallel, the most snapshot operations \
+                            to run at once on any one host',
+                        action='store', type=int, dest='per_host', default=4)
 
-    return parser.parse_args()
+    bootstrap.add_profile_args(parser)
+    args = parser.parse_args(argv)
+    if bool(args.vmname) == (args.from_file is not None):
+        parser.error("give either VM names or --from-file")
+    if args.from_file is not None:
+        # stdout is for the results
+        args.verbose = False
+    return args
 
 
-def main():
+def list_snapshots(si_obj, vm_objs, order=None):
     """
-    main:
-        Get cli args, decide which snapshot operation to do on them, and
-        do it.
-        Operations are: create, delete, revert, list
+    Print the snapshots of all the VMs, fetching every snapshot tree in one
+    go.  The trees come back in whatever order the VC likes, so each VM's
+    snapshots are printed as soon as every VM before it has been.
+
+    si_obj - a connection to a vCenter
+    vm_objs - {vmname: vm object}
+    order - the VM names in the order to print them, default vm_objs'
     """
-    args = get_args()
+    order = [name for name in dict.fromkeys(order or vm_objs)
+             if name in vm_objs]
+    trees = {}
 
-    if args.verbose:
-        print("* Prework")
+    def print_tree(vm_name, snaptree):
+        if not snaptree:
+            print("VM: %s; No Snapshots exist" % (vm_name))
+            return
+        for item in vsphere_tools.iter_snapshots(snaptree, vm_name):
+            print(item, flush=True)
 
-    # setup inifile
-    configfile = configparser.ConfigParser()
-    configfile.read(args.configfile)
-
-    if args.vc == "NONE":
-        if args.dc == "NONE":
-            raise Exception("No VC and no DC specified.")
-        server = configfile["DC-"+args.dc.upper()].get("SERVER", "NONE")
-        if server != "NONE":
-            args.vc = server
-            args.user = configfile["DC-"+args.dc.upper()].get("USERNAME",
-                                                              "FOO")
-        else:
-            raise Exception("No server/DC matching command line options found")
+    for vm_name, snaptree in vsphere_tools.fetch_snapshot_trees(
+            si_obj.RetrieveContent(), list(vm_objs.values())):
+        trees[vm_name] = snaptree
+        while order and order[0] in trees:
+            name = order.pop(0)
+            print_tree(name, trees.pop(name))
+    # anything the VC named differently
+    for vm_name, snaptree in trees.items():
+        print_tree(vm_name, snaptree)
 
-    if args.password:
-        password = args.password
-    else:
-        password = getpass.getpass(
-            prompt='Enter password for host %s and user %s: ' %
-            (args.vc, args.user))
 
-    context = None
-    # pylint: disable=protected-access
-    context = ssl._create_unverified_context()
-    si_obj = connect.Connect(host=args.vc, user=args.user, pwd=password,
-                             sslContext=context)
+def snapshot_trees(si_obj, vm_objs):
+    """
+    Build the SnapshotTree of every VM from one property collection
 
-    atexit.register(Disconnect, si_obj)
+    si_obj - a connection to a vCenter
+    vm_objs - {vmname: vm object}
+    return - {vmname: SnapshotTree}
+    """
+    return dict((vm_name, vsphere_tools.SnapshotTree(snaptree, vm_name))
+                for vm_name, snaptree in vsphere_tools.fetch_snapshot_trees(
+                    si_obj.RetrieveContent(), list(vm_objs.values())))
 
-    for this_vm in args.vmname:
-        if args.verbose:
-            print("** Finding VM to work with: %s" % this_vm)
-        vm_obj = vsphere_tools.get_obj(si_obj.RetrieveContent(),
-                                       [vim.VirtualMachine],
-                                       this_vm)
-        if vm_obj is not None:
-            if args.verbose:
-                print("** Found it")
+
+def older_than_cutoff(args):
+    """
+    The creation time before which --older-than deletes snapshots
+    """
+    return datetime.now(timezone.utc) - timedelta(days=args.older_than)
+
+
+def snapshot_parallel(si_obj, vm_objs, missing, args, vm_args=None,
+                      stream=False):
+    """
+    Do the requested snapshot operation to up to args.parallel VMs at once,
+    with no more than args.per_datastore on a datastore or args.per_host on
+    a host at any one time.  Each VM is reported on as it finishes, and
+    missing or failed VMs don't stop the rest - an exception naming them all
+    is raised at the end.
+
+    si_obj - a connection to a vCenter
+    vm_objs - {vmname: vm object} for the VMs that were found
+    missing - list of VM names that weren't found
+    args - the parsed command line args
+    vm_args - optional {vmname: args} for VMs with their own settings
+    stream - report each VM (or snapshot, for --older-than) as a line of
+             JSON
+    """
+    vm_args = vm_args or {}
+    args_for = dict((vm_obj, vm_args.get(name, args))
+                    for name, vm_obj in vm_objs.items())
+
+    def delete_old(this_args):
+        return this_args.operation == "delete" and \
+            this_args.older_than is not None
+
+    if not vm_args and args.snapname is None and not delete_old(args):
+        raise Exception("snapshot name required for %s operations." %
+                        args.operation)
+    results = {}
+    # what each item is, for stream: {item name: (vmname, args, snapshot)}
+    labels = {}
+
+    def report(name, error):
+        results[name] = error
+        if stream:
+            vm_name, this_args, snapname = labels.get(name, (name, args,
+                                                             None))
+            result = {'vm': vm_name, 'operation': this_args.operation,
+                      'snapshot': snapname,
+                      'status': 'ok' if error is None else 'failed'}
+            if error is not None:
+                result['error'] = str(error)
+            bootstrap.print_result(**result)
+        elif error is not None:
+            print("* %s failed: %s" % (name, error))
+        elif args.verbose:
+            print("* %s snapshot %s done" % (name, args.operation))
+
+    for this_vm in missing:
+        report(this_vm, Exception("VM was not found"))
+
+    trees = {}
+    need_trees = dict((name, vm_obj) for name, vm_obj in vm_objs.items()
+                      if args_for[vm_obj].operation != "create")
+    if need_trees:
+        trees = snapshot_trees(si_obj, need_trees)
+    throttle = vsphere_tools.Throttle({'datastore': args.per_datastore,
+                                       'host': args.per_host, 'vm': 1})
+    placement = vsphere_tools.vm_placement(si_obj.RetrieveContent(),
+                                           list(vm_objs.values()))
+
+    items = []
+    # snapshots being deleted for --older-than, one item per snapshot and
+    # only one at a time on any one VM
+    old_snapshots = set()
+    tree_for = {}
+    for name, vm_obj in vm_objs.items():
+        this_args = args_for[vm_obj]
+        if delete_old(this_args):
+            for node in trees[name].older_than(older_than_cutoff(this_args)):
+                item_name = "%s/%s (%s)" % (name, node.name, node.create_time)
+                throttle.set_keys(item_name, placement.get(vm_obj, []) +
+                                  [('vm', vm_obj)])
+                items.append((item_name, node))
+                old_snapshots.add(node)
+                labels[item_name] = (name, this_args, node.name)
         else:
+            throttle.set_keys(name, placement.get(vm_obj, []))
+            items.append((name, vm_obj))
+            tree_for[vm_obj] = trees.get(name)
+            labels[name] = (name, this_args, this_args.snapname)
+
+    def start(obj):
+        if obj in old_snapshots:
+            return obj.snapshot.RemoveSnapshot_Task(False)
+        return vsphere_tools.start_snapshot_task(
+            obj, args_for[obj].operation, args_for[obj].snapname,
+            tree=tree_for[obj])
+
+    if args.verbose:
+        print("* Snapshot %s on %d VMs, %d at a time" %
+              (args.operation, len(vm_objs), args.parallel))
+    vsphere_tools.run_tasks(start, items, args.parallel, report,
+                            throttle=throttle)
+
+    failed = [name for name, error in results.items() if error is not None]
+    if failed:
+        raise Exception("Snapshot %s failed for %d of %d VMs: %s" %
+                        ("operations" if vm_args else args.operation,
+                         len(failed), len(results), ", ".join(failed)))
+
+
+def run_from_file(args, si_obj, cache=None):
+    """
+    Do the snapshot operations on the VMs of a --from-file list, with one
+    lookup for all of them, printing a line of JSON for each as it's done.
+    VMs that are missing or fail don't stop the rest, but an exception is
+    raised at the end if there were any.
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - a warm InventoryCache to find the VMs in, eg the daemon's
+    """
+    entries = bootstrap.read_vm_list(args.from_file, VM_SETTINGS,
+                                     getattr(args, 'stdin', None))
+    section = None
+    if args.cache:
+        section = vsphere_tools.cache_section(args.dc, args.vc)
+    vm_objs, missing = vsphere_tools.resolve_vms(
+        si_obj, [name for name, _ in entries], section, cache)
+    for name in missing:
+        bootstrap.print_result(vm=name, status='missing')
+
+    vm_args = dict((name, bootstrap.vm_args(args, settings))
+                   for name, settings in entries if name in vm_objs)
+    lists = dict((name, vm_objs[name]) for name in vm_args
+                 if vm_args[name].operation == 'list')
+    trees = snapshot_trees(si_obj, lists) if lists else {}
+    # in the order listed, not the order the VC sent them in
+    for name, tree in ((name, trees[name]) for name in lists
+                       if name in trees):
+        bootstrap.print_result(
+            vm=name, operation='list', status='ok',
+            snapshots=[{'name': node.name, 'description': node.description,
+                        'created': str(node.create_time),
+                        'parent': None if node.parent is None
+                                  else node.parent.name}
+                       for node in tree.walk()])
+    changes = dict((name, vm_objs[name]) for name in vm_args
+                   if name not in lists)
+    errors = []
+    if missing:
+        errors.append("Cannot find VMs named " + ", ".join(missing))
+    if changes:
+        try:
+            snapshot_parallel(si_obj, changes, [], args, vm_args,
+                              stream=True)
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(str(err))
+    if errors:
+        raise Exception("; ".join(errors))
+
+
+def run(args, si_obj, cache=None):
+    """
+    Do the snapshot operation on the VMs, once connected
+
+    args - the parsed command line args
+    si_obj - the connection to the VC
+    cache - a warm InventoryCache to find the VMs in, eg the daemon's
+    """
+    if args.from_file is not None:
+        run_from_file(args, si_obj, cache)
+        return
+    if args.verbose:
+        print("** Finding VMs to work with: %s" % ", ".join(args.vmname))
+    section = None
+    if args.cache:
+        section = vsphere_tools.cache_section(args.dc, args.vc)
+    vm_objs, missing = vsphere_tools.resolve_vms(si_obj, args.vmname,
+                                                 section, cache)
+    if args.parallel > 1 and args.operation != "list":
+        snapshot_parallel(si_obj, vm_objs, missing, args)
+        return
+    if missing:
+        for this_vm in missing:
             print("VM %s was not found" % (this_vm))
-            exit()
+        exit()
+    if args.verbose:
+        print("** Found them all")
+
+    if args.operation == "list":
+        list_snapshots(si_obj, vm_objs, args.vmname)
+        return
+
+    trees = {}
+    if args.operation in ["delete", "revert"]:
+        trees = snapshot_trees(si_obj, vm_objs)
+
+    for this_vm in args.vmname:
+        vm_obj = vm_objs[this_vm]
 
         if args.operation == "create":
             if args.snapname is None:
@@ -123,7 +360,15 @@ def main():
                                           args.verbose)
             if args.verbose:
                 print("* Snapshot created")
-        if args.operation == "delete":
+        if args.operation == "delete" and args.older_than is not None:
+            if args.verbose:
+                print("* Deleting snapshots older than %s days from VM %s" %
+                      (args.older_than, this_vm))
+            removed = vsphere_tools.delete_old_snapshots(
+                trees[this_vm], older_than_cutoff(args), args.verbose)
+            if args.verbose:
+                print("* %d snapshots deleted" % len(removed))
+        elif args.operation == "delete":
             if args.snapname is None:
                 raise Exception(
                     "snapshot name required for delete operations.")
@@ -131,7 +376,7 @@ def main():
                 print("* Deleting snapshot %s from VM %s" % (args.snapname,
                                                              vm_obj.name))
             vsphere_tools.delete_snapshot(vm_obj, args.snapname,
-                                          args.verbose)
+                                          args.verbose, trees.get(this_vm))
             if args.verbose:
                 print("* Snapshot deleted")
         if args.operation == "revert":
@@ -142,18 +387,34 @@ def main():
                 print("* Reverting VM %s to snapshot %s" %
                       (vm_obj.name, args.snapname))
             vsphere_tools.revert_snapshot(vm_obj, args.snapname,
-                                          args.verbose)
+                                          args.verbose, trees.get(this_vm))
             if args.verbose:
                 print("* VM %s reverted to snapshot %s" %
                       (vm_obj.name, args.snapname))
-        if args.operation == "list":
-            if vm_obj.snapshot is None:
-                print("VM: %s; No Snapshots exist" % (vm_obj.name))
-            else:
-                snaplist = vsphere_tools.list_snapshots(
-                    vm_obj.snapshot.rootSnapshotList)
-                for item in snaplist:
-                    print(item)
+
+
+
+def main():
+    """
+    main:
+        Get cli args, decide which snapshot operation to do on them, and
+        do it.
+        Operations are: create, delete, revert, list
+    """
+    args = get_args()
+    if args.daemon:
+        vm_list = None
+        if args.from_file is not None:
+            vm_list = bootstrap.read_source(args.from_file)
+        sys.exit(bootstrap.forward('snapshots', sys.argv[1:],
+                                   stdin=vm_list))
+
+    if args.verbose:
+        print("* Prework")
+
+    with bootstrap.profiling(args):
+        si_obj = bootstrap.connect(args)
+        run(args, si_obj)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+#!/usr/local/bin/python3
+"""
+startup_benchmark.py
+
+Times the cold start of the scripts, the way a shell loop would run them -
+a fresh python process each time.  Nothing here talks to a vCenter: each
+command stops before connecting, so what's measured is interpreter start,
+imports and argument handling.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name: command line, run from the scripts directory
+COMMANDS = {
+    'python -c pass': ['-c', 'pass'],
+    'power.py --help': ['power.py', '--help'],
+    'power.py query (no VC)': ['power.py', '-f', os.devnull, 'query', 'vm'],
+    'snapshots.py --help': ['snapshots.py', '--help'],
+    'import vsphere_tools': ['-c', 'import vsphere_tools'],
+}
+
+
+def get_args():
+    """
+    Get and parse the args.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', help='runs of each command', action='store',
+                        type=int, dest='runs', default=20)
+    parser.add_argument('-i', help='the python interpreter to time',
+                        action='store', dest='python',
+                        default=sys.executable)
+    parser.add_argument('command', help='commands to time, default all: ' +
+                        ', '.join(COMMANDS), action='store', nargs='*')
+
+    return parser.parse_args()
+
+
+def time_command(python, command, runs):
+    """
+    Run a command runs times in a new process
+
+    return - list of wall clock times in seconds
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([python] + command, cwd=SCRIPT_DIR,
+                       stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=False)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    """
+    Time each command and print min/median/mean in milliseconds
+    """
+    args = get_args()
+    names = args.command or list(COMMANDS)
+    unknown = [name for name in names if name not in COMMANDS]
+    if unknown:
+        raise Exception("Unknown commands: " + ", ".join(unknown))
+
+    print("%-26s %8s %8s %8s" % ('command', 'min', 'median', 'mean'))
+    for name in names:
+        times = time_command(args.python, COMMANDS[name], args.runs)
+        print("%-26s %8.1f %8.1f %8.1f" % (
+            name, min(times) * 1000, statistics.median(times) * 1000,
+            statistics.mean(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,67 +3,263 @@
 Module for doing stats collection from VC's
 """
 
-import atexit
-import getpass
+import os
+import sys
+import threading
 import time
-import ssl
 
 from argparse import ArgumentParser
-from pyvim import connect
-from pyvim.connect import Disconnect
+from pathlib import Path
 from pyVmomi import vim, vmodl # pylint: disable=no-name-in-module
-
-def iterate_vmtree(item, vm_data):
+# If called as a script, we assume vsphere tools is a subdir, and voila.
+# If not called as a script, we're assuming it's called from the root
+# directory, and import accordingly.
+if __name__ == '__main__':
+    import bootstrap # pylint: disable=import-error
+    import vsphere_tools # pylint: disable=import-error
+    from vsphere_tools.stats import AllocationTable, group_stats # pylint: disable=import-error
+else:
+    from scripts import bootstrap
+    from scripts import vsphere_tools
+    from scripts.vsphere_tools.stats import AllocationTable, group_stats
+
+# What get_vminfo needs from each VM, fetched in one go per cluster
+VM_PROPERTIES = ['name', 'config.hardware.numCPU',
+                 'config.hardware.memoryMB', 'runtime.powerState']
+# The columns written out for each VM, and their types for Parquet.  As
+# before the writers, memory is in whole GB.
+VM_COLUMNS = ['cluster', 'name', 'num_cpu', 'memory_gb', 'power_state']
+VM_TYPES = {'cluster': 'string', 'name': 'string', 'num_cpu': 'int64',
+            'memory_gb': 'int64', 'power_state': 'string'}
+# Usage counters sampled with --perf, and how each is summed up per cluster:
+# counter: (stat name, 'mean'/'sum'/'max', scale)
+USAGE_COUNTERS = {
+    'cpu.usage.average': ('cpuUsagePct', 'mean', 0.01),
+    'mem.active.average': ('memActiveMB', 'sum', 1/1024.0),
+    'net.usage.average': ('netUsageKBps', 'sum', 1),
+    'disk.maxTotalLatency.latest': ('diskLatencyMaxMS', 'max', 1)}
+# Each vCenter is collected from in its own thread; keep their lines whole
+OUTPUT_LOCK = threading.Lock()
+
+def collect_vms(content, compute_resource, vm_data, group, writer,
+                running=None):
     """
-        Work to iterate through trees and collect on only VMs info
-        input - a resource pool
+        Collect info on every VM in a cluster, through all its resource
+        pools, with a single (paged) property collection.  Rows go to
+        the writer as each page comes back.
+        input - the cluster/compute resource, the AllocationTable and
+                the group (vcenter.dc.cluster) to add the VMs to, and the writer
+        running - optional list to add (group, VM) to for powered on VMs
     """
 
-#   if there's a sub pool, iterate it too.
-    for pool in item.resourcePool:
-        vm_data = iterate_vmtree(pool, vm_data)
+    for vmachine, vm_props in vsphere_tools.collect_resource_vms(
+            content, compute_resource, VM_PROPERTIES):
+        vm_data = get_vminfo(vm_props, vm_data, group, writer)
+        if running is not None and \
+                vm_props['runtime.powerState'] == 'poweredOn':
+            running.append((group, vmachine))
+
+    return vm_data
+
+def get_vminfo(vm_props, vm_data, group, writer, key=None):
+    """
+    Get the info from VM
 
-    for vmachine in item.vm:
-        vm_data = get_vminfo(vmachine, vm_data)
+    Input: the VM's VM_PROPERTIES, as collected, and optionally a key
+           (the VM's moid) to replace its previous row with
+    Output: writes a VM_COLUMNS row for the VM, and adds its CPU, memory
+            and power state to the vm_data AllocationTable under group
+    """
 
+    num_cpu = vm_props.get('config.hardware.numCPU', 0)
+    memory_mb = vm_props.get('config.hardware.memoryMB', 0)
+    writer.write({'cluster': group, 'name': vm_props['name'],
+                  'num_cpu': num_cpu,
+                  'memory_gb': int(round(memory_mb/1024.0)),
+                  'power_state': vm_props['runtime.powerState']})
+    vm_data.add(group, num_cpu, memory_mb,
+                vm_props['runtime.powerState'] == 'poweredOn', key)
 
     return vm_data
 
-def get_vminfo(vmachine, vm_data):
+def collect_usage(content, running, result_data):
+    """
+    Sample USAGE_COUNTERS for every powered on VM in a few batched
+    QueryPerf calls, and sum them up per cluster into result_data
+
+    Input: the (group, VM) pairs of the powered on VMs
     """
-    Get the info from VM
 
-    Input: VirtualMachine object
-    Output: modifies vmdata var for #CPU allocated, # of CPU allocated, and # of total VMs
+    groups = sorted(set(group for group, _ in running))
+    codes = dict((group, code) for code, group in enumerate(groups))
+    samples = vsphere_tools.PerfCollector(content).query(
+        [vmachine for _, vmachine in running], list(USAGE_COUNTERS))
+    for counter, (stat, how, scale) in USAGE_COUNTERS.items():
+        found = [(codes[group], samples[vmachine][counter][-1])
+                 for group, vmachine in running
+                 if samples.get(vmachine, {}).get(counter)]
+        if not found:
+            continue
+        totals = group_stats([code for code, _ in found],
+                             [value for _, value in found], len(groups))
+        for code, group in enumerate(groups):
+            if totals['count'][code]:
+                result_data.setdefault(group+'.virtualmachines.usage', {})[stat] = \
+                    float(totals[how][code] * scale)
+
+    return result_data
+
+def summarize(vm_data, result_data):
+    """
+    Work out the per cluster allocation, overcommit and percentiles over
+    the whole AllocationTable at once, and add them to result_data
     """
 
-    vm_hardware = vmachine.config.hardware
+    for suffix, stats in (('.virtualmachines.allocated', vm_data.allocation()),
+                          ('.virtualmachines.overcommit', vm_data.overcommit()),
+                          ('.virtualmachines.percentile', vm_data.percentiles())):
+        for group, values in stats.items():
+            result_data[group+suffix] = values
 
-    print(vmachine.name+','+str(vm_hardware.numCPU)+','+\
-        str(int(round(vm_hardware.memoryMB/1024.0)))+\
-        ','+vmachine.runtime.powerState)
+    return result_data
+
+def print_results(result_data, timestamp, previous=None, stream=None):
+    """
+    Print each stat as "name value timestamp", skipping ones that couldn't
+    be worked out (eg overcommit for a host without cluster capacity)
+
+    previous - optional {name: value} of what was printed last time; only
+               stats that have changed since are printed, and it's updated
+    stream - where to print them, default stdout
+    """
+
+    lines = []
+    for key in sorted(result_data):
+        for stat in sorted(result_data[key]):
+            value = result_data[key][stat]
+            if value is None or value != value: # unknown, or nan
+                continue
+            name = key+'.'+stat
+            if previous is not None:
+                if previous.get(name) == value:
+                    continue
+                previous[name] = value
+            lines.append('%s %s %d' % (name, round(value, 3), timestamp))
+    with OUTPUT_LOCK:
+        for line in lines:
+            print(line, file=stream or sys.stdout)
+        (stream or sys.stdout).flush()
+
+def apply_updates(updates, vm_data, vm_props, writer):
+    """
+    Apply PropertyFollower updates to the AllocationTable
+
+    Input: the updates, keyed by cluster group, the table, and the
+           {moid: VM_PROPERTIES} collected so far
+    """
+
+    for group, kind, vmachine, changes in updates:
+        moid = vmachine._moId # pylint: disable=protected-access
+        if kind == 'leave':
+            # A VM moved between clusters may enter the new one first
+            if vm_data.group_of(moid) == group:
+                vm_data.remove(moid)
+                vm_props.pop(moid, None)
+            continue
+        vm_props.setdefault(moid, {}).update(changes)
+        get_vminfo(vm_props[moid], vm_data, group, writer, moid)
 
     return vm_data
 
-def get_args():
+def follow_vms(content, clusters, vm_data, result_data, interval, writer,
+               stats=None):
+    """
+    Daemon mode: one full collection, then follow changes to the VMs with
+    WaitForUpdatesEx, printing the stats that changed as they change and
+    all of them every interval seconds, until interrupted.  A row is
+    written for each VM as it changes.
+
+    Input: the (group, compute resource) pairs to follow, and the stream
+           to print the stats to, default stdout
+    """
+
+    follower = vsphere_tools.PropertyFollower(content.propertyCollector)
+    vm_props = {}
+    previous = {}
+    next_snapshot = 0
+    try:
+        for group, compute_resource in clusters:
+            follower.add_filter(vsphere_tools.resource_vm_filter(
+                compute_resource, VM_PROPERTIES), group)
+        while True:
+            updates = follower.wait(
+                max(1, int(round(next_snapshot - time.time()))))
+            apply_updates(updates, vm_data, vm_props, writer)
+            writer.flush()
+            summarize(vm_data, result_data)
+            timestamp = int(time.time())
+            if timestamp >= next_snapshot:
+                previous.clear()
+                next_snapshot = timestamp + interval
+            print_results(result_data, timestamp, previous, stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
+
+    return result_data
+
+def get_args(argv=None):
     """
     Get and parse the command line args
+
+    argv - the command line to parse, default sys.argv
     """
 
     parser = ArgumentParser(description='Args needed to retrieve data from VC')
 
     parser.add_argument('-s', '--host', action='store', help='Remote VC to connect to', dest='host')
+    parser.add_argument('-f', '--config', action='store', dest='configfile', \
+      default=str(Path.home()) + os.path.sep + 'vsphere-tools.ini', \
+      help='The config file to use')
+    parser.add_argument('--dc', action='append', dest='dc', \
+      help='DC section of the config file to collect from, may be repeated')
+    parser.add_argument('-F', '--format', action='store', dest='format', \
+      choices=sorted(vsphere_tools.WRITERS), default='csv', \
+      help='Format to write the VMs out in (default csv, with a header)')
+    parser.add_argument('-w', '--output', action='store', dest='output', \
+      default='-', help='File to write the VMs to, default stdout')
+    parser.add_argument('--stats-output', action='store', dest='stats_output', \
+      help='File to print the stats to (- for stdout), default stdout, or ' \
+      'stderr when the VMs are written to stdout')
+    parser.add_argument('--perf', action='store_true', dest='perf', \
+      help='Also sample CPU, memory, network and disk usage of running VMs')
+    parser.add_argument('-a', '--all-dcs', action='store_true', dest='all_dcs', \
+      help='Collect from every [DC-*] section of the config file')
     parser.add_argument('-o', '--port', action='store', type=int, default=443, \
       help='Port to connect on', dest='port')
     parser.add_argument('-u', '--user', action='store', help='User to connect as', \
       dest='user')
     parser.add_argument('-p', '--password', action='store', \
       help='Password to use when connecting to host', dest='password')
+    parser.add_argument('--reuse-session', action='store_true', \
+      dest='reuse_session', default=False, \
+      help='reuse the sessions from the last run, and keep these for the next')
     parser.add_argument('-d', action='store_true', help='debug/verbose mode.', \
       dest='debug', default=True)
+    parser.add_argument('--follow', action='store_true', \
+      help='Keep running, following changes instead of re-collecting', \
+      dest='follow')
+    parser.add_argument('-i', '--interval', action='store', type=int, default=60, \
+      help='With --follow, print every stat this often (seconds); ' \
+      'in between only changes are printed', dest='interval')
+    bootstrap.add_profile_args(parser)
 
     #(options, args) = parser.parse_args()
-    options = parser.parse_args()
+    options = parser.parse_args(argv)
+    if options.stats_output == '-' and options.output == '-':
+        parser.error("the VMs and the stats can't both go to stdout, "
+                     "use -w or a --stats-output file")
     return options
 
 #def disable_warnings():
@@ -80,83 +276,258 @@ def get_args():
 #    except:
 #        pass
 
-def main():
+def get_targets(args):
+    """
+    Work out which vCenters to collect from
+
+    Input: the command line args; -s and any number of --dc sections (or
+           --all-dcs for every [DC-*] section) of the ini file
+    Output: list of (server, user), one per vCenter
     """
-    Put the pieces together, connect to the VC, and being aware of clusters,
-    chew through and get the data.
+
+    targets = []
+    if args.host:
+        targets.append((args.host, args.user))
+    if args.all_dcs or args.dc:
+        for server, user, _ in bootstrap.config_targets(
+                args.configfile, None if args.all_dcs else args.dc):
+            # Several DCs may live on one vCenter, which covers them all
+            if server not in [target[0] for target in targets]:
+                targets.append((server, args.user or user))
+    if not targets:
+        raise Exception("No VC and no DC specified.")
+
+    return targets
+
+def connect_targets(targets, args):
     """
+    Log in to every vCenter, one at a time so that password prompts don't
+    get mixed up, as the other scripts do: with -p, or asking for each
+    server and user, and reusing sessions with --reuse-session
 
+    Output: ({server: ServiceInstance}, {server: why it couldn't log in})
+    """
 
-    starttime = int(time.time())
+    connections = {}
+    errors = {}
+    for server, user in targets:
+        try:
+            connections[server] = vsphere_tools.connect_vc(
+                server, user, args.password, args.port,
+                getattr(args, 'reuse_session', False))
+        except Exception as error: # pylint: disable=broad-except
+            errors[server] = error
+
+    return connections, errors
+
+def vcenter_group(server):
+    """
+    The start of the groups of a vCenter's clusters: its server name, with
+    dots made underscores so that it stays one part of the stat names.
+    Keeps vCenters using the same (eg default) datacenter and cluster
+    names apart.
+    """
+
+    return server.replace('.', '_')
+
+def find_clusters(content, vm_data, result_data, vcenter):
+    """
+    Find every cluster/compute resource in every datacenter of a vCenter
+
+    Input: vcenter - the vCenter's vcenter_group
+    Output: list of (group, compute resource), group being
+            vcenter.dc.cluster; cluster hardware goes in result_data and
+            vm_data's groups
+    """
+
+    clusters = []
+    for _, dc_props in vsphere_tools.collect_properties(
+            content, [vim.Datacenter], ['name', 'hostFolder']):
+        for compute_resource, props in vsphere_tools.collect_properties(
+                content, [vim.ComputeResource],
+                ['name', 'summary.effectiveMemory', 'summary.numCpuThreads'],
+                container=dc_props['hostFolder']):
+            group = vcenter+'.'+dc_props['name']+'.'+props['name']
+            if isinstance(compute_resource, vim.ClusterComputeResource):
+                result_data[group+'.hardware'] = \
+                    {'totalMB':props.get('summary.effectiveMemory'),\
+                        'totalCPU':props.get('summary.numCpuThreads')}
+                vm_data.add_group(group, result_data[group+'.hardware']['totalCPU'],
+                                  result_data[group+'.hardware']['totalMB'])
+            else:
+                vm_data.add_group(group)
+            clusters.append((group, compute_resource))
+
+    return clusters
+
+def collect_vcenter(server, si_obj, args, writer, stats=None):
+    """
+    Collect (or with --follow, keep following) the stats of every cluster
+    in all the datacenters of one logged in vCenter
+
+    Input: the vCenter's server name, and its connection
+           stats - where --follow prints the stats, default stdout
+    Output: the vCenter's result_data
+    """
 
     result_data = {}
+    vm_data = AllocationTable()
+
+    content = si_obj.RetrieveContent()
+
+    #Grab the hardware:
+    clusters = find_clusters(content, vm_data, result_data,
+                             vcenter_group(server))
+
+    if args.follow:
+        return follow_vms(content, clusters, vm_data, result_data, args.interval,
+                          writer, stats)
+
+    #Now to cycle through the VMs.
+    running = [] if args.perf else None
+    for group, compute_resource in clusters:
+        collect_vms(content, compute_resource, vm_data, group, writer, running)
+
+    if running:
+        collect_usage(content, running, result_data)
+
+    #Totals per cluster, over all the VMs at once
+    return summarize(vm_data, result_data)
+
+def follow_vcenters(connections, args, writer, stats=None):
+    """
+    --follow against every vCenter at once, each in its own (daemon)
+    thread printing its own changes, until interrupted or they all stop
+
+    Output: {server: the exception its thread stopped with}
+    """
+
+    errors = {}
+
+    def follow(server, si_obj):
+        try:
+            collect_vcenter(server, si_obj, args, writer, stats)
+        except Exception as error: # pylint: disable=broad-except
+            errors[server] = error
+
+    threads = [threading.Thread(target=follow, daemon=True,
+                                args=(server, si_obj))
+               for server, si_obj in connections.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+    except KeyboardInterrupt:
+        pass
+
+    return errors
+
+def stats_stream(args):
+    """
+    Where the stats go: --stats-output, otherwise stdout - unless the VMs
+    are being written there, when it's stderr, so that each can be parsed
+
+    Output: the stream, which the caller closes if it's a file
+    """
+
+    stats_output = getattr(args, 'stats_output', None)
+    if stats_output is None:
+        return sys.stderr if args.output == '-' else sys.stdout
+    if stats_output == '-':
+        return sys.stdout
+    return open(stats_output, 'w')
+
+def report_errors(errors):
+    """
+    Print why each vCenter that failed did, to stderr
+
+    Input: {server: exception or None}
+    Output: True if any did
+    """
 
+    failed = False
+    for server, error in errors.items():
+        if error is None:
+            continue
+        failed = True
+        if isinstance(error, vmodl.MethodFault):
+            print("Caught vmodl fault from %s : %s" % (server, error.msg),
+                  file=sys.stderr)
+        else:
+            print("%s : %s" % (server, error), file=sys.stderr)
+
+    return failed
+
+def main():
+    """
+    Get the args, and collect, profiling the run with --profile
+    """
+    starttime = int(time.time())
     args = get_args()
-    if args.password:
-        password = args.password
-    else:
-        password = getpass.getpass(prompt='Enter password for host %s and user %s: '\
-            % (args.host, args.user))
+    with bootstrap.profiling(args):
+        return collect_all(args, starttime)
+
+def collect_all(args, starttime):
+    """
+    Put the pieces together, connect to the VCs, and being aware of clusters,
+    chew through and get the data.  Each vCenter is collected from in its
+    own thread, and the results merged at the end.
+    """
 
+    connections, errors = connect_targets(get_targets(args), args)
+
+    stats = stats_stream(args)
     try:
-        connect_result = None
-        try:
-#            disable_warnings()
-#            connect_result = SmartConnectNoSSL(host=args.host, user=args.user, pwd=password, \
-#                port=int(args.port))
-            context = None
-            context = ssl._create_unverified_context() # pylint: disable=protected-access
-            connect_result = connect.Connect(host=args.host, user=args.user,
-                             pwd=password, port=int(args.port), sslContext=context)
-        except IOError:
-            pass
-        if not connect_result:
-            print("Could not connect to the specified host with provided user/pass")
-            return -1
-    #No matter what, disconnect
-        atexit.register(Disconnect, connect_result)
+        return collect_to(connections, errors, args, stats, starttime)
+    finally:
+        if stats not in (sys.stdout, sys.stderr):
+            stats.close()
 
-        content = connect_result.RetrieveContent()
+def collect_to(connections, errors, args, stats, starttime):
+    """
+    Collect from every logged in vCenter, writing the VMs out and printing
+    the stats to the stats stream, and timing and errors (those logging in
+    to start with) to stderr
 
-        datacenter = content.rootFolder.childEntity[0]
+    Output: the exit status
+    """
 
-        hostfolder = datacenter.hostFolder
+    result_data = {}
 
-        dc_name = datacenter.name
+    writer = vsphere_tools.get_writer(args.format, args.output, VM_COLUMNS,
+                                      VM_TYPES)
 
+    if args.follow:
+        try:
+            errors.update(follow_vcenters(connections, args, writer,
+                                          stats))
+        finally:
+            writer.close()
+        return -1 if report_errors(errors) else 0
 
-    #Grab the hardware:
-        for compute_resource in hostfolder.childEntity:
-            cluster_name = compute_resource.name
-#      if type(compute_resource) == pyVmomi.vim.ClusterComputeResource:
-#        result_data[dcName+'.'+clusterName+'.hardware'] = \
-#            {'totalMB':compute_resource.summary.effectiveMemory,\
-#            'totalCPU':compute_resource.summary.numCpuThreads}
-            if isinstance(compute_resource, vim.ClusterComputeResource):
-                result_data[dc_name+'.'+cluster_name+'.hardware'] = \
-                    {'totalMB':compute_resource.summary.effectiveMemory,\
-                        'totalCPU':compute_resource.summary.numCpuThreads}
-      #Now to cycle through the VMs.
-            result_data[dc_name+'.'+cluster_name+'.virtualmachines.allocated'] = \
-                {}.fromkeys(('onCPU', 'onMB', 'onTotal', 'offCPU', 'offMB', 'offTotal'), 0)
-            iterate_vmtree(compute_resource.resourcePool, \
-                result_data[dc_name+'.'+cluster_name+'.virtualmachines.allocated'])
+    def collect(target):
+        result_data.update(collect_vcenter(target[0], target[1], args,
+                                           writer))
 
-    #Time to get the time and print out the results
+    try:
+        errors.update(vsphere_tools.run_parallel(
+            collect, [(server, (server, si_obj))
+                      for server, si_obj in connections.items()],
+            max(1, len(connections))))
+    finally:
+        writer.close()
 
-        timestamp = int(time.time())
+    #Time to get the time and print out the results
 
-        if args.debug:
-            print("elapsed time: ", timestamp - starttime)
+    timestamp = int(time.time())
+    print_results(result_data, timestamp, stream=stats)
 
-    except vmodl.MethodFault as error:
-        print("Caught vmodl fault : " + error.msg)
-        return -1
-#  except Exception, e:
-#    print "Caught exception : " + str(e)
-#    return -1
+    if args.debug:
+        print("elapsed time: ", timestamp - starttime, file=sys.stderr)
 
-    return 0
+    return -1 if report_errors(errors) else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
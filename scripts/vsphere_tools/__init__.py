@@ -3,14 +3,37 @@
     Intermediate functions for the vsphere-tools scripts
 """
 
-import subprocess
-import platform
-import os
 import time
 import sys
 
 from pyVmomi import vim  # pylint: disable=no-name-in-module
 
+from .inventory import (retrieve_properties, collect_properties,
+                        collect_object_properties, collect_resource_vms,
+                        resource_vm_filter, vm_placement, InventoryIndex)
+from .cache import InventoryCache, cache_section
+from .follow import PropertyFollower
+from .writers import get_writer, WRITERS
+from .perf import PerfCollector
+from .session import connect_vc, SessionStore
+from .batch import run_parallel
+from .tasks import (TaskWaiter, Throttle, wait_for_tasks, run_tasks,
+                    FINISHED_STATES)
+from .snaptree import SnapshotTree
+from .probe import (ProbeResult, probe_hosts, ProbeMonitor,
+                    MonitorStats)
+from .hops import (HOP_COLUMNS, METRICS, hop_record, read_hops,
+                   compare_hops, hop_failures)
+from .addresses import AddressIndex
+from .trace import CallTracer
+
+# how long the canary must answer every probe after a vmotion before it
+# counts as settled, the longest to wait for that, and the pause between
+# readiness checks, all in seconds
+SETTLE_TIME = 2.0
+READY_TIMEOUT = 60.0
+READY_POLL = 0.2
+
 
 def _create_char_spinner():
     """Creates a generator yielding a char based spinner.
@@ -32,41 +55,47 @@ def spinner(label=''):
     sys.stdout.flush()
 
 
-def ping(host, verbose=False):
+def ping_result(host, verbose=False, **options):
     """
-    ping - ping the address/name given
-
-    host - the host/address to ping
-    verbose - boolean - if False, don't echo the ping
+    ping, returning what came back rather than just whether anything did
 
-    Result - True if things succeed, False if not.
+    Result - the ProbeResult
     """
-    if platform.system().lower() == "windows":
-        parameters = "-n 3 -w 100"
-        need_sh = False
-    else:
-        parameters = "-c 3 -W 100"
-        need_sh = True
+    result = probe_hosts([host], **options)[host]
+    if verbose:
+        print(result)
+    return result
 
-    args = "ping " + parameters + " " + host
 
-    file_discard = open(os.devnull, 'w')
+def ping(host, verbose=False, **options):
+    """
+    ping - check the address/name given answers, without starting a process
 
-    if verbose:
-        return_code = subprocess.call(args, shell=need_sh) == 0
-    else:
-        return_code = subprocess.call(args, shell=need_sh, stdout=file_discard,
-                                      stderr=subprocess.STDOUT) == 0
+    host - the host/address to ping
+    verbose - boolean - if True, print the replies, loss and round trip times
+    options - for probe_hosts: method (auto, icmp or tcp), count, timeout,
+              interval, port
 
-    file_discard.close()
+    Result - True if any probe got a reply, False if not.
+    """
+    return ping_result(host, verbose, **options).ok
 
-    return return_code
+
+def mean_rtt_ms(rtts):
+    """
+    The mean of round trip times in seconds, in milliseconds; None if there
+    are none
+    """
+    if not rtts:
+        return None
+    return sum(rtts) / len(rtts) * 1000
 
 # get_obj is awesome
 # Connect using si and smartconnectnossl...
 # content = si.RetrieveContent()
 # ds = get_obj(content, [pyVmomi.vim.Datastore], 'sas_node1_1')
 # now ds is a pointer to the named datacenter
+# For more than one lookup, build an InventoryIndex once and use its get()
 
 
 def get_obj(content, vimtype, name=None):
@@ -74,18 +103,26 @@ def get_obj(content, vimtype, name=None):
     Return an object by name, if name is None the
     first found object is returned
     """
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for current_obj in container.view:
-        if name:
-            if current_obj.name == name:
-                obj = current_obj
-                break
-        else:
-            obj = current_obj
-            break
-    return obj
+    return InventoryIndex(content, vimtype).get(name)
+
+
+def resolve_vms(si_obj, names, section=None, cache=None):
+    """
+    Resolve a whole list of VM names with one inventory pass
+
+    si_obj - a connection to a vCenter
+    names - list of VM names
+    section - if set, use the on-disk InventoryCache for this ini section
+    cache - if set, an already loaded InventoryCache (or anything else with
+            a resolve(names)) to use instead
+    return - ({name: vm object}, [names not found])
+    """
+    if cache is not None:
+        return cache.resolve(names)
+    if section is not None:
+        return InventoryCache(si_obj, section).resolve(names)
+    return InventoryIndex(si_obj.RetrieveContent(),
+                          [vim.VirtualMachine]).resolve(names)
 
 
 def get_dc(si_obj, name):
@@ -102,16 +139,33 @@ def get_dc(si_obj, name):
     raise Exception('Failed to find datacenter named %s' % name)
 
 
-def find_vm_byip(service_instance, ip_addr):
+def only_match(found, what, index):
+    """
+    The one object an AddressIndex lookup found, raising if it found
+    several
+    """
+    if len(found) > 1:
+        raise Exception('More than one match for %s: %s' % (
+            what, ', '.join(sorted(str(index.name_of(obj))
+                                   for obj in found))))
+    return found
+
+
+def find_vm_byip(service_instance, ip_addr, index=None):
     """
     find a VM in a datacenter
     service_instance - the connection to the VC
     ip_addr - ip of the vm
+    index - optional AddressIndex to look in, instead of asking the VC.
+            An IP more than one VM has is an error, rather than the first.
     return - the vm object.
     """
 
-    vm_obj = service_instance.content.searchIndex.FindAllByIp(None, ip_addr,
-                                                              True)
+    if index is not None:
+        vm_obj = only_match(index.find_ip(ip_addr), ip_addr, index)
+    else:
+        vm_obj = service_instance.content.searchIndex.FindAllByIp(
+            None, ip_addr, True)
     # if vm is not None:
     if vm_obj:
         return vm_obj[0]
@@ -119,17 +173,21 @@ def find_vm_byip(service_instance, ip_addr):
         raise Exception('Cannot find vm with ip: ' + ip_addr)
 
 
-def find_vm_bydns(service_instance, dns_name):
+def find_vm_bydns(service_instance, dns_name, index=None):
     """
     find a VM in a datacenter
     service_instance - the connection to the VC
     dns_name - fqdn of the vm
+    index - optional AddressIndex to look in, instead of asking the VC
     return - the vm object.
     """
 
-    vm_obj = service_instance.content.searchIndex.FindAllByDnsName(None,
-                                                                   dns_name,
-                                                                   True)
+    if index is not None:
+        vm_obj = only_match(index.find_name(dns_name, [vim.VirtualMachine]),
+                            dns_name, index)
+    else:
+        vm_obj = service_instance.content.searchIndex.FindAllByDnsName(
+            None, dns_name, True)
     # if vm is not None:
     if vm_obj:
         return vm_obj[0]
@@ -137,22 +195,90 @@ def find_vm_bydns(service_instance, dns_name):
         raise Exception('Cannot find vm by DNS: ' + dns_name)
 
 
-def find_host(service_instance, name):
+def find_host(service_instance, name, index=None):
     """
     find a Host in a datacenter
     service_instance - connection to VC
     name - name of the host - MUST be DNS
+    index - optional AddressIndex to look in, instead of asking the VC
     return - the host object.
     """
 
-    host = service_instance.content.searchIndex.FindAllByDnsName(None, name,
-                                                                 False)
+    if index is not None:
+        host = index.find_name(name, [vim.HostSystem])
+    else:
+        host = service_instance.content.searchIndex.FindAllByDnsName(
+            None, name, False)
     if host:
         return host[0]
     else:
         raise Exception('Cannot find host: ' + name)
 
 
+def find_hosts(service_instance, names):
+    """
+    find many Hosts at once, with one inventory pass rather than a DNS
+    search each
+    service_instance - connection to VC
+    names - names of the hosts, as in the inventory.  Any that aren't are
+            looked up by DNS, as find_host.
+    return - the host objects, in the order of names
+    """
+    by_name = {}
+    for host, props in collect_properties(service_instance.content,
+                                          [vim.HostSystem], ['name']):
+        by_name.setdefault(props.get('name', '').lower(), host)
+    return [by_name[name.lower()] if name.lower() in by_name
+            else find_host(service_instance, name) for name in names]
+
+
+def wait_until_ready(vm_obj, host, pingaddr, probe_options=None,
+                     settle=SETTLE_TIME, timeout=READY_TIMEOUT,
+                     timings=None):
+    """
+    Wait for a vm to be running on host, and for pingaddr to have answered
+    every probe for settle seconds
+
+    vm_obj - vm object
+    host - host object it should be on
+    pingaddr - the dns or ip to ping
+    probe_options - optional dict of ping options, eg {'method': 'tcp'};
+                    each probe is one ping of count 1
+    settle - seconds of unbroken replies needed
+    timeout - seconds to give up after, raising an exception
+    timings - optional dict, given ready_s (the seconds taken) and
+              post_rtt_ms (the mean round trip time of the settled probes)
+
+    return - seconds taken
+    """
+    options = dict(probe_options or {}, count=1)
+    start = time.monotonic()
+    deadline = start + timeout
+    while vm_obj.runtime.host != host:
+        if time.monotonic() >= deadline:
+            raise Exception('VM is not running on %s' % host.name)
+        time.sleep(READY_POLL)
+    answering_since = None
+    rtts = []
+    while True:
+        result = ping_result(pingaddr, **options)
+        now = time.monotonic()
+        if not result.ok:
+            answering_since = None
+            rtts = []
+        elif answering_since is None:
+            answering_since = now
+        rtts.extend(result.rtts)
+        if answering_since is not None and now - answering_since >= settle:
+            if timings is not None:
+                timings.update({'ready_s': now - start,
+                                'post_rtt_ms': mean_rtt_ms(rtts)})
+            return now - start
+        if now >= deadline:
+            raise Exception('Post-VMotion Ping Failed')
+        time.sleep(READY_POLL)
+
+
 def wait_for_task(task, verbose=False):
     """
     Wait for task to complete
@@ -160,32 +286,63 @@ def wait_for_task(task, verbose=False):
     returns True if successful, False if not.
     """
 
-    while task.info.state not in [vim.TaskInfo.State.success,
-                                  vim.TaskInfo.State.error]:
+    def progress(this_task, state, percent):
+        # pylint: disable=unused-argument
+        spinner(state)
+
+    # a quick task is often done already, which one read tells us
+    state = task.info.state
+    if state in FINISHED_STATES:
         if verbose:
-            spinner(task.info.state)
-        time.sleep(1)
+            spinner(state)
+            print('')
+        return state == vim.TaskInfo.State.success
+    error = wait_for_tasks([task], progress if verbose else None)[0]
     if verbose:
         print('')
-    if task.info.state == vim.TaskInfo.State.success:
-        return True
-    if task.info.state == vim.TaskInfo.State.error:
-        return False
+    return error is None
+
+
+def task_times(task):
+    """
+    How long a finished task was queued, and then ran, by the VC's clock
+
+    return - (queued, ran) in seconds, either None if the VC didn't say
+    """
+    info = task.info
+    queued = ran = None
+    if info.queueTime is not None and info.startTime is not None:
+        queued = (info.startTime - info.queueTime).total_seconds()
+    if info.startTime is not None and info.completeTime is not None:
+        ran = (info.completeTime - info.startTime).total_seconds()
+    return queued, ran
 
 
-def do_a_vmotion(vm_obj, host, pingaddr, verbose=False):
+def do_a_vmotion(vm_obj, host, pingaddr, verbose=False, probe_options=None,
+                 monitor=None, ready=None, timings=None):
     """
     do one repetition of a vmotion.
 
     Ping the pingaddr,
     migrate the vm
-    Ping the pingaddr
+    Wait for it to be on the host and answering steadily (wait_until_ready)
     raising exceptions on any failure
 
     vm_obj - vm object
     host - host object
     pingaddr - the dns or ip to ping.
+    probe_options - optional dict of ping options, eg {'method': 'tcp'}
+    monitor - optional dict of ProbeMonitor options, eg {'interval': 0.02}.
+              If given, pingaddr is probed that often from the start of the
+              vmotion until it is ready again, to measure the outage.
+    ready - optional dict of wait_until_ready options, eg {'settle': 5}
+    timings - optional dict, filled in as the hop goes with pre_rtt_ms,
+              queue_s, run_s (see task_times), ready_s and post_rtt_ms, so
+              a failed hop still has what was measured before it failed
+
+    return - the MonitorStats with monitor, otherwise None
     """
+    probe_options = probe_options or {}
 
     spec = vim.VirtualMachineRelocateSpec()
     spec.host = host
@@ -194,67 +351,117 @@ def do_a_vmotion(vm_obj, host, pingaddr, verbose=False):
         print('*** Preparing to move VM: ' + vm_obj.name + ' to host: %s' %
               host.name)
 
-    if ping(pingaddr):
-        if verbose:
-            print('*** We have initial pings - moving to host: %s' % host.name)
-            print('*** VMotion to host %s now' % host.name)
-        task = vm_obj.RelocateVM_Task(spec)
-    else:
+    if timings is None:
+        timings = {}
+    result = ping_result(pingaddr, verbose, **probe_options)
+    timings['pre_rtt_ms'] = mean_rtt_ms(result.rtts)
+    if not result.ok:
         raise Exception('Pre-VMotion Ping Failed')
+    if verbose:
+        print('*** We have initial pings - moving to host: %s' % host.name)
+        print('*** VMotion to host %s now' % host.name)
+
+    watcher = None
+    if monitor is not None:
+        options = dict((key, value) for key, value in probe_options.items()
+                       if key in ('method', 'port', 'refused_ok', 'timeout'))
+        options.update(monitor)
+        watcher = ProbeMonitor(pingaddr, **options).start()
+    try:
+        task = vm_obj.RelocateVM_Task(spec)
+        succeeded = wait_for_task(task, verbose)
+        timings['queue_s'], timings['run_s'] = task_times(task)
+        if succeeded:
+            if verbose:
+                print("*** VMotion succeeded")
+        else:
+            raise Exception("VMotion task failed")
 
-    if wait_for_task(task, verbose):
         if verbose:
-            print("*** VMotion succeeded")
-    else:
-        raise Exception("VMotion task failed")
+            print("*** Waiting for the VM to settle on %s" % host.name)
+        taken = wait_until_ready(vm_obj, host, pingaddr, probe_options,
+                                 timings=timings, **(ready or {}))
+        if verbose:
+            print('*** Success, steady pings post VMotion to %s after '
+                  '%.1f seconds' % (host.name, taken))
+    finally:
+        if watcher is not None:
+            watcher.stop()
+            if verbose:
+                print('*** During the VMotion: %s' % watcher.stats)
+    return None if watcher is None else watcher.stats
 
-    if verbose:
-        print("*** Sleeping 5 seconds to let things settle.")
-    time.sleep(5)
 
-    if ping(pingaddr):
-        if verbose:
-            print('*** Success, we have ping post VMotion to %s' % host.name)
-    else:
-        raise Exception('Post-VMotion Ping Failed')
+def fetch_snapshot_trees(content, vm_objs):
+    """
+    Fetch the snapshot trees of many VMs with one property collection
+
+    content : the ServiceContent of the connection
+    vm_objs : list of vm objects
+
+    yields : (vm name, rootSnapshotList or None if there are no snapshots)
+             as the pages come back from the VC
+    """
+    for _, props in collect_object_properties(
+            content, vm_objs, ['name', 'snapshot.rootSnapshotList']):
+        yield props.get('name'), props.get('snapshot.rootSnapshotList')
+
+
+def iter_snapshots(snapshotlist, vm_name=None):
+    """
+    Walk the snapshot tree depth first, yielding a line for each snap.
+    Everything needed is already in the tree, so nothing is fetched from
+    the VC as long as vm_name is given.
+
+    snapshotlist: the list of snapshots vm.snapshot.rootSnapshotList to start
+    vm_name: the name of the VM, looked up from the first snapshot if not
+             given
+    """
+    tree = SnapshotTree(snapshotlist, vm_name)
+    if vm_name is None and tree.roots:
+        tree.vm_name = tree.roots[0].tree.vm.name
+    return tree.lines()
 
 
-def list_snapshots(snapshotlist):
+def list_snapshots(snapshotlist, vm_name=None):
     """
-    recursively transit the snapshot tree, returning all snaps
+    transit the snapshot tree, returning all snaps
 
     snapshotlist: the list of snapshots vm.snapshot.rootSnapshotList to start
+    vm_name: the name of the VM, looked up from each snapshot if not given
     """
 
-    result_snapshot_list = []
-    snap_text = ""
-    for snapshot in snapshotlist:
-        snap_text = "VM: %s; Name: %s; Description: %s; \
-                    Created: %s; VMState: %s" % (
-                        snapshot.vm.name, snapshot.name,
-                        snapshot.description, snapshot.createTime,
-                        snapshot.state)
-        result_snapshot_list.append(snap_text)
-        result_snapshot_list = result_snapshot_list + list_snapshots(
-            snapshot.childSnapshotList)
-    return result_snapshot_list
+    return list(iter_snapshots(snapshotlist, vm_name))
 
 
 def get_snapshot(name, snapshotlist):
     """
-    Recursively search the snapshot tree, returning the snaps that match name
+    Search the snapshot tree, returning the snaps that match name
 
     name:  Name of the snapshot to look for
     snapshotlist: the list of snapshots vm.snapshot.rootSnapshotList to start
     """
-    result_snapshot_list = []
-    for snapshot in snapshotlist:
-        if snapshot.name == name:
-            result_snapshot_list.append(snapshot)
-        else:
-            result_snapshot_list = result_snapshot_list + get_snapshot(
-                name, snapshot.childSnapshotList)
-    return result_snapshot_list
+    return [node.tree for node in SnapshotTree(snapshotlist).find(name)]
+
+
+def find_snapshot(vm_obj, snapname, tree=None):
+    """
+    Find the one snapshot of a VM called snapname, raising an exception if
+    there isn't exactly one.
+
+    vm_obj : vm object
+    snapname : the name of the snapshot
+    tree : the VM's SnapshotTree, if already built
+
+    result : the snapshot's vim.vm.SnapshotTree
+    """
+    if tree is not None:
+        return tree.find_one(snapname).tree
+    snapobj = get_snapshot(snapname, vm_obj.snapshot.rootSnapshotList)
+    if len(snapobj) != 1:
+        raise Exception(
+            "** We did not find one and only one snapshot by that name")
+    return snapobj[0]
 
 
 def create_snapshot(vm_obj, snapname, snapdesc="", verbose=False):
@@ -274,13 +481,14 @@ def create_snapshot(vm_obj, snapname, snapdesc="", verbose=False):
                   verbose)
 
 
-def delete_snapshot(vm_obj, snapname, verbose=False):
+def delete_snapshot(vm_obj, snapname, verbose=False, tree=None):
     """
-    Create a snapshot of the given VM
+    Delete a snapshot of the given VM
 
     vm_obj : vm object
     snapname : string of the name of the snap to delete
     verbose : printing out statuses
+    tree : the VM's SnapshotTree, if already built
 
     result : Snapshot has been removed
     """
@@ -288,25 +496,44 @@ def delete_snapshot(vm_obj, snapname, verbose=False):
         print("** Finding snapshot %s" % snapname)
     if snapname is None:
         raise Exception("snapshot name required for delete operations.")
-    snapobj = get_snapshot(snapname, vm_obj.snapshot.rootSnapshotList)
-    if len(snapobj) == 1:
-        # Found our one snapshot
+    snapobj = find_snapshot(vm_obj, snapname, tree)
+    if verbose:
+        print("** Removing snapshot %s from VM %s" % (snapname, vm_obj.name))
+    wait_for_task(snapobj.snapshot.RemoveSnapshot_Task(True), verbose)
+
+
+def delete_old_snapshots(tree, cutoff, verbose=False):
+    """
+    Delete every snapshot of a VM created before cutoff, oldest first.
+    Children of a deleted snapshot are kept.
+
+    tree : the VM's SnapshotTree
+    cutoff : a timezone aware datetime
+    verbose : printing out statuses
+
+    result : list of the names of the snapshots removed
+    """
+    removed = []
+    for node in tree.older_than(cutoff):
         if verbose:
-            print("** Removing snapshot %s from VM %s" % (snapname,
-                                                          vm_obj.name))
-        wait_for_task(snapobj[0].snapshot.RemoveSnapshot_Task(True), verbose)
-    else:
-        raise Exception(
-            "** We did not find one and only one snapshot by that name")
+            print("** Removing snapshot %s from %s of VM %s" %
+                  (node.name, node.create_time, tree.vm_name))
+        if not wait_for_task(node.snapshot.RemoveSnapshot_Task(False),
+                             verbose):
+            raise Exception("Removing snapshot %s from VM %s failed" %
+                            (node.name, tree.vm_name))
+        removed.append(node.name)
+    return removed
 
 
-def revert_snapshot(vm_obj, snapshot, verbose=False):
+def revert_snapshot(vm_obj, snapshot, verbose=False, tree=None):
     """
     Revert a VM to the referenced snapshot
 
     vm_obj : a vm object
     snapname : the name of the snapshot to look for
     verbose : printing out statements
+    tree : the VM's SnapshotTree, if already built
 
     result : VM has been reverted to the referenced snapshot
     """
@@ -314,16 +541,38 @@ def revert_snapshot(vm_obj, snapshot, verbose=False):
         print("** Finding snapshot %s" % snapshot)
     if snapshot is None:
         raise Exception("snapshot name required for revert operations.")
-    snapobj = get_snapshot(snapshot, vm_obj.snapshot.rootSnapshotList)
-    if len(snapobj) == 1:
-        # Found our one snapshot
-        if verbose:
-            print("** Reverting VM %s to snapshot %s" % (vm_obj.name,
-                                                         snapshot))
-        wait_for_task(snapobj[0].snapshot.RevertToSnapshot_Task(), verbose)
-    else:
-        raise Exception(
-            "** We did not find one and only one snapshot by that name")
+    snapobj = find_snapshot(vm_obj, snapshot, tree)
+    if verbose:
+        print("** Reverting VM %s to snapshot %s" % (vm_obj.name, snapshot))
+    wait_for_task(snapobj.snapshot.RevertToSnapshot_Task(), verbose)
+
+
+def start_snapshot_task(vm_obj, operation, snapname, snapdesc="",
+                        tree=None):
+    """
+    Start a snapshot create, delete or revert without waiting for it
+
+    vm_obj : vm object
+    operation : one of "create", "delete", "revert"
+    snapname : the name of the snapshot to create, delete or revert to
+    snapdesc : description for a created snapshot - optional
+    tree : the VM's SnapshotTree, if already built
+
+    result : the task started
+    """
+    if snapname is None:
+        raise Exception("snapshot name required for %s operations." %
+                        operation)
+    if operation == "create":
+        return vm_obj.CreateSnapshot_Task(snapname, snapdesc, True, True)
+    if operation not in ["delete", "revert"]:
+        raise Exception("Unknown snapshot operation %s" % operation)
+    if tree is None and vm_obj.snapshot is None:
+        raise Exception("** VM has no snapshots")
+    snapobj = find_snapshot(vm_obj, snapname, tree)
+    if operation == "delete":
+        return snapobj.snapshot.RemoveSnapshot_Task(True)
+    return snapobj.snapshot.RevertToSnapshot_Task()
 
 
 def vm_poweron(vm_obj, verbose=False):
@@ -0,0 +1,180 @@
+"""
+    IP address and DNS name -> VM/host index for the vsphere-tools scripts
+
+    The SearchIndex FindAllByIp/FindAllByDnsName calls are a round trip to
+    the VC per lookup.  AddressIndex instead follows guest.net,
+    guest.ipAddress and guest.hostName of every VM, and the name of every
+    host, with a PropertyFollower: the first wait downloads the lot in one
+    go, and update() after that only fetches what has changed.  Lookups are
+    then answered from dicts, and an IP reported by more than one VM is a
+    collision rather than whichever VM the VC happened to list first.
+"""
+
+import ipaddress
+import threading
+
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+
+from .follow import PropertyFollower
+from .inventory import view_filter
+
+# the properties followed for each type
+VM_PATHS = ['name', 'guest.net', 'guest.ipAddress', 'guest.hostName']
+HOST_PATHS = ['name']
+
+
+def normalize_ip(address):
+    """
+    The canonical text of an IP address, eg 2001:DB8::0:1 -> 2001:db8::1
+
+    return - None for something that isn't an address, or is link local or
+             loopback, and so doesn't say which VM it is
+    """
+    try:
+        address = ipaddress.ip_address(address.split('%')[0])
+    except (AttributeError, ValueError):
+        return None
+    if address.is_link_local or address.is_loopback:
+        return None
+    return str(address)
+
+
+def normalize_name(name):
+    """
+    A DNS name as looked up: lower case, without a trailing dot
+    """
+    return name.lower().rstrip('.')
+
+
+def guest_ips(props):
+    """
+    Every IP address a VM's guest reports, on any NIC
+    """
+    addresses = set()
+    for nic in props.get('guest.net') or []:
+        for address in getattr(nic, 'ipAddress', None) or []:
+            addresses.add(normalize_ip(address))
+    if props.get('guest.ipAddress'):
+        addresses.add(normalize_ip(props['guest.ipAddress']))
+    addresses.discard(None)
+    return addresses
+
+
+class AddressIndex(object):
+    """
+    An IP address and DNS name index of a VC's VMs and hosts, kept up to
+    date from property updates.  Thread safe.
+    """
+
+    def __init__(self, content, container=None):
+        """
+        content - the ServiceContent of a VC connection
+        container - the folder/entity to start from, defaults to rootFolder
+        """
+        self.view = content.viewManager.CreateContainerView(
+            container or content.rootFolder,
+            [vim.VirtualMachine, vim.HostSystem], True)
+        self.follower = PropertyFollower(content.propertyCollector)
+        self.props = {}
+        self.keys = {}
+        self.by_ip = {}
+        self.by_name = {}
+        self.lock = threading.Lock()
+        try:
+            self.follower.add_filter(view_filter(
+                self.view, {vim.VirtualMachine: VM_PATHS,
+                            vim.HostSystem: HOST_PATHS}), 'addresses')
+            self.update(None)
+        except Exception:
+            self.close()
+            raise
+
+    def _unindex(self, obj):
+        ips, names = self.keys.pop(obj, ((), ()))
+        for key, table in [(ip, self.by_ip) for ip in ips] + \
+                [(name, self.by_name) for name in names]:
+            table[key].remove(obj)
+            if not table[key]:
+                del table[key]
+
+    def _index(self, obj):
+        props = self.props[obj]
+        if isinstance(obj, vim.HostSystem):
+            ips = set()
+            names = set([props.get('name')])
+        else:
+            ips = guest_ips(props)
+            names = set([props.get('guest.hostName')])
+        names = set(normalize_name(name) for name in names if name)
+        self.keys[obj] = (ips, names)
+        for ip in ips:
+            self.by_ip.setdefault(ip, []).append(obj)
+        for name in names:
+            self.by_name.setdefault(name, []).append(obj)
+
+    def update(self, max_wait=0):
+        """
+        Apply what has changed since the last update
+
+        max_wait - longest to wait for a change in seconds, 0 not to wait,
+                   None to wait until something does
+        return - how many objects changed
+        """
+        updates = self.follower.wait(max_wait)
+        with self.lock:
+            for _, kind, obj, changes in updates:
+                self._unindex(obj)
+                if kind == 'leave':
+                    self.props.pop(obj, None)
+                    continue
+                self.props.setdefault(obj, {}).update(changes)
+                self._index(obj)
+        return len(updates)
+
+    def find_ip(self, address):
+        """
+        Every VM with an IP address
+
+        return - list of VMs, more than one for a collision
+        """
+        with self.lock:
+            return list(self.by_ip.get(normalize_ip(address), []))
+
+    def find_name(self, name, vimtype=None):
+        """
+        Every VM whose guest reports a DNS name, and host with it as its
+        name
+
+        vimtype - optional list of types to restrict the result to
+        return - list of objects
+        """
+        with self.lock:
+            found = list(self.by_name.get(normalize_name(name), []))
+        if vimtype:
+            found = [obj for obj in found if isinstance(obj, tuple(vimtype))]
+        return found
+
+    def name_of(self, obj):
+        """
+        The inventory name of an indexed object
+        """
+        with self.lock:
+            return self.props.get(obj, {}).get('name')
+
+    def collisions(self):
+        """
+        The IP addresses reported by more than one VM
+
+        return - {address: [VMs]}
+        """
+        with self.lock:
+            return dict((address, list(objs))
+                        for address, objs in self.by_ip.items()
+                        if len(objs) > 1)
+
+    def close(self):
+        """
+        Stop following, and throw the view away
+        """
+        self.follower.close()
+        self.view.DestroyView()
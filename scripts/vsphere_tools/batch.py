@@ -0,0 +1,37 @@
+"""
+    Running an operation across many VMs at once for the vsphere-tools scripts
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def run_parallel(operation, items, parallel=1, report=None):
+    """
+    Run operation over a list of objects, up to parallel at a time.
+
+    An exception from one object doesn't stop the others - it is handed
+    back as that object's result instead.  Each runs in a copy of the
+    caller's context, so context variables (eg where daemon.py sends a
+    command's output) carry over into the worker threads.
+
+    operation - function taking one object, eg vm_poweron
+    items - list of (name, object) pairs
+    parallel - how many to have on the go at once
+    report - optional function(name, error) called as each one finishes,
+             error being None on success
+
+    return - {name: None on success, or the exception raised}, in the
+             order of items
+    """
+    results = dict((name, None) for name, _ in items)
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = dict((executor.submit(contextvars.copy_context().run,
+                                        operation, obj), name)
+                       for name, obj in items)
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name] = future.exception()
+            if report is not None:
+                report(name, results[name])
+    return results
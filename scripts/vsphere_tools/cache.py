@@ -0,0 +1,226 @@
+"""
+    On disk name -> MoRef cache for the vsphere-tools scripts
+
+    One json file per [DC-<DC>] section of the ini file, holding the MoRef and
+    name of every VM, plus the PropertyCollector and version token that were
+    used to build it.  While that collector is still alive (ie the session it
+    was made in is still logged in) the cache is brought up to date with a
+    WaitForUpdatesEx on the saved version, which only returns what changed.
+    Otherwise the cached MoRefs are checked with a single property fetch for
+    just the VMs being asked for, and the whole thing is rebuilt if any of
+    them turn out to be stale.
+"""
+
+# pylint: disable=protected-access
+
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+from .inventory import collect_object_properties, resolve_names, view_filter
+
+CACHE_DIR = str(Path.home()) + os.path.sep + '.vsphere-tools' + \
+    os.path.sep + 'cache'
+
+
+def cache_section(dc_name, server):
+    """
+    Work out the cache key for a run
+
+    dc_name - the --dc argument, "NONE" if not given
+    server - the VC being connected to
+    return - DC-<DC> as used in the ini file, or the server name
+    """
+    if dc_name and dc_name != "NONE":
+        return "DC-" + dc_name.upper()
+    return server
+
+
+def write_json(path, data):
+    """
+    Write data out as json, replacing the file in one go.  Each write goes
+    through its own temporary file (created private) next to it, so
+    processes saving the same file at once can't mix their writes up.
+
+    path - the file to write, its directory being made if need be
+    data - what to write
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as json_file:
+            json.dump(data, json_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class InventoryCache(object):
+    """
+    A persistent name -> MoRef index for one ini section
+    """
+
+    def __init__(self, si_obj, section, vimtype=None, cache_dir=CACHE_DIR):
+        """
+        si_obj - a connection to a vCenter
+        section - the ini section (see cache_section) the cache is for
+        vimtype - list of managed object types to cache, default VMs
+        cache_dir - where the cache files live
+        """
+        self.si_obj = si_obj
+        self.content = si_obj.RetrieveContent()
+        self.vimtype = vimtype or [vim.VirtualMachine]
+        self.path = os.path.join(cache_dir, section + '.json')
+        self.server = self.content.about.instanceUuid
+        self.collector = None
+        self.version = None
+        self.entries = {}
+        self.by_name = {}
+        self.live = False
+        self.load()
+
+    def load(self):
+        """
+        Read the cache file, discarding it if it was made against another VC
+        """
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+        if data.get('server') != self.server:
+            return
+        self.collector = data.get('collector')
+        self.version = data.get('version')
+        self.entries = dict((moid, tuple(entry)) for moid, entry in
+                            data.get('entries', {}).items())
+        self._reindex()
+
+    def save(self):
+        """
+        Write the cache file out, replacing the previous one in one go
+        """
+        write_json(self.path, {'server': self.server,
+                               'collector': self.collector,
+                               'version': self.version,
+                               'entries': self.entries})
+
+    def _reindex(self):
+        self.by_name = {}
+        for moid, (type_name, name) in self.entries.items():
+            self.by_name.setdefault(name, []).append((type_name, moid))
+
+    def _moref(self, type_name, moid):
+        return getattr(vim, type_name)(moid, self.si_obj._stub)
+
+    def _apply(self, update_set):
+        for filter_update in update_set.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                moid = obj_update.obj._moId
+                if obj_update.kind == 'leave':
+                    self.entries.pop(moid, None)
+                    continue
+                for change in obj_update.changeSet or []:
+                    if change.name == 'name' and change.op == 'assign':
+                        self.entries[moid] = (obj_update.obj._wsdlName,
+                                              change.val)
+
+    def _wait(self, collector, version):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update_set = collector.WaitForUpdatesEx(version, options)
+            if update_set is None:
+                return version
+            self._apply(update_set)
+            version = update_set.version
+            if not update_set.truncated:
+                return version
+
+    def update(self):
+        """
+        Bring the cache up to date using the saved collector and version.
+
+        return - True if that worked, False if the collector is gone
+                 (typically because the session it belongs to has ended)
+        """
+        if self.collector is None or self.version is None:
+            return False
+        collector = vmodl.query.PropertyCollector(self.collector,
+                                                  self.si_obj._stub)
+        try:
+            version = self._wait(collector, self.version)
+        except (vmodl.fault.ManagedObjectNotFound,
+                vmodl.query.InvalidCollectorVersion):
+            return False
+        self.live = True
+        if version != self.version:
+            # something changed, otherwise the file is already up to date
+            self.version = version
+            self._reindex()
+            self.save()
+        return True
+
+    def rebuild(self):
+        """
+        Rebuild the cache from scratch, leaving a collector and filter in
+        this session that later runs can get incremental updates from
+        """
+        collector = self.content.propertyCollector.CreatePropertyCollector()
+        # the view has to outlive this run, for the filter to keep working
+        view = self.content.viewManager.CreateContainerView(
+            self.content.rootFolder, self.vimtype, True)
+        collector.CreateFilter(view_filter(view, dict(
+            (this_type, ['name']) for this_type in self.vimtype)), True)
+        self.entries = {}
+        self.collector = collector._moId
+        self.version = self._wait(collector, '')
+        self._reindex()
+        self.live = True
+        self.save()
+
+    def lookup(self, name):
+        """
+        Return the cached MoRef for name, or None
+        """
+        found = self.by_name.get(name)
+        if not found:
+            return None
+        return self._moref(*found[0])
+
+    def _validate(self, found):
+        # The saved collector is gone, so check the MoRefs are still there
+        # and still called what we think they are
+        try:
+            current = dict(
+                (obj._moId, props.get('name'))
+                for obj, props in collect_object_properties(
+                    self.content, list(found.values()), ['name']))
+        except vmodl.fault.ManagedObjectNotFound:
+            return False
+        for name, obj in found.items():
+            if current.get(obj._moId) != name:
+                return False
+        return True
+
+    def resolve(self, names):
+        """
+        Resolve a list of names to MoRefs.
+
+        names - list of names to look for
+        return - ({name: MoRef}, [names not found])
+        """
+        if not self.update() and not self.entries:
+            self.rebuild()
+            return resolve_names(self.lookup, names)
+        found, missing = resolve_names(self.lookup, names)
+        if not self.live and (missing or not self._validate(found)):
+            # Unknown or stale names, and nothing to tell us what changed
+            self.rebuild()
+            found, missing = resolve_names(self.lookup, names)
+        return found, missing
@@ -0,0 +1,83 @@
+"""
+    Following inventory changes for the vsphere-tools scripts
+
+    A private PropertyCollector is given the filters to follow.  The first
+    WaitForUpdatesEx (with an empty version) hands back everything the
+    filters match, and every one after that only what has changed since the
+    version before it, so a long running script only ever downloads the
+    inventory once.
+"""
+
+# pylint: disable=protected-access
+
+from pyVmomi import vmodl  # pylint: disable=no-name-in-module
+
+
+class PropertyFollower(object):
+    """
+    Follow the properties matched by one or more filters
+    """
+
+    def __init__(self, collector):
+        """
+        collector - a PropertyCollector on the connection, usually
+                    content.propertyCollector.  A private one is made from it,
+                    and thrown away again by close().
+        """
+        self.collector = collector.CreatePropertyCollector()
+        self.filters = {}
+        self.version = ''
+
+    def add_filter(self, filter_spec, key):
+        """
+        Start following a filter
+
+        filter_spec - a vmodl.query.PropertyCollector.FilterSpec
+        key - what to hand back with updates from this filter
+        """
+        prop_filter = self.collector.CreateFilter(filter_spec, True)
+        self.filters[prop_filter._moId] = key
+
+    def wait(self, max_wait=None):
+        """
+        Wait for changes since the last call, all of them on the first call
+
+        max_wait - longest to block for in seconds, 0 to not block at all,
+                   None to block until something changes
+
+        return - list of (filter key, kind, object, {path: value}), kind
+                 being 'enter', 'modify' or 'leave' and a removed property
+                 having a value of None.  Empty if nothing changed in time.
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=max_wait)
+        updates = []
+        while True:
+            update_set = self.collector.WaitForUpdatesEx(self.version,
+                                                         options)
+            if update_set is None:
+                return updates
+            self.version = update_set.version
+            for filter_update in update_set.filterSet or []:
+                key = self.filters.get(filter_update.filter._moId)
+                for obj_update in filter_update.objectSet or []:
+                    updates.append((key, obj_update.kind, obj_update.obj,
+                                    dict((change.name,
+                                          None if change.op == 'remove'
+                                          else change.val)
+                                         for change in
+                                         obj_update.changeSet or [])))
+            if not update_set.truncated:
+                return updates
+            # the rest of a truncated update is already waiting
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=0)
+
+    def close(self):
+        """
+        Throw away the private collector, and the filters with it
+        """
+        try:
+            self.collector.DestroyPropertyCollector()
+        except vmodl.MethodFault:
+            pass
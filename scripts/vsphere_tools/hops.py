@@ -0,0 +1,113 @@
+"""
+    Per vmotion timing records for canarytest.py, and comparing two runs
+
+    Each hop (one canary moving to one host) is a row of HOP_COLUMNS,
+    written as JSON Lines by a writers.JSONLinesWriter.  Comparing two such
+    files gives per host statistics for each metric, old against new, so a
+    host that has got slower since a firmware or ESXi update stands out.
+"""
+
+import json
+import statistics
+import time
+
+# the columns of a hop record, in order
+HOP_COLUMNS = ['time', 'host', 'canary', 'ok', 'error', 'queue_s', 'run_s',
+               'ready_s', 'pre_rtt_ms', 'post_rtt_ms', 'outage_ms', 'loss']
+# the columns compare_hops compares: how long the task was queued and ran
+# for, how long the canary took to settle afterwards, its round trip time
+# before and after, and the longest time it didn't answer
+METRICS = ('queue_s', 'run_s', 'ready_s', 'pre_rtt_ms', 'post_rtt_ms',
+           'outage_ms')
+
+
+def hop_record(host, canary, timings=None, stats=None, error=None):
+    """
+    Make a hop record
+
+    host - the host name moved to
+    canary - the canary's name
+    timings - the dict do_a_vmotion filled in, as far as it got
+    stats - the MonitorStats of the move, if it was watched
+    error - what went wrong, None if it passed
+
+    return - {column: value}, with None for anything not measured
+    """
+    record = dict((column, None) for column in HOP_COLUMNS)
+    record.update(timings or {})
+    record.update({'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'host': host, 'canary': canary, 'ok': error is None,
+                   'error': None if error is None else str(error)})
+    if stats is not None:
+        record['outage_ms'] = stats.longest_outage() * 1000
+        record['loss'] = stats.loss
+    return record
+
+
+def read_hops(path):
+    """
+    Read a results file written with HOP_COLUMNS
+
+    return - list of records, skipping blank lines
+    """
+    with open(path) as hops_file:
+        return [json.loads(line) for line in hops_file if line.strip()]
+
+
+def summarize(values):
+    """
+    Basic statistics of a metric's values
+
+    return - {'n', 'mean', 'median', 'stdev', 'min', 'max'}, the rest None
+             if there are no values; stdev is 0 for a single value
+    """
+    if not values:
+        return {'n': 0, 'mean': None, 'median': None, 'stdev': None,
+                'min': None, 'max': None}
+    return {'n': len(values), 'mean': statistics.mean(values),
+            'median': statistics.median(values),
+            'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+            'min': min(values), 'max': max(values)}
+
+
+def compare_hops(old, new, metrics=METRICS):
+    """
+    Compare two runs' hops host by host
+
+    old, new - lists of hop records, eg from read_hops.  Failed hops are
+               left out of the statistics, but counted.
+    metrics - the columns to compare
+
+    return - list of (host, metric, old summary, new summary, change),
+             sorted by host, where change is the relative change in the
+             median, eg 0.25 for 25% slower, None if either side has no
+             values.  Metrics neither run has a value for are left out.
+    """
+    hosts = sorted(set(hop['host'] for hop in old + new))
+    rows = []
+    for host in hosts:
+        for metric in metrics:
+            before = summarize([hop[metric] for hop in old
+                                if hop['host'] == host and hop['ok'] and
+                                hop.get(metric) is not None])
+            after = summarize([hop[metric] for hop in new
+                               if hop['host'] == host and hop['ok'] and
+                               hop.get(metric) is not None])
+            if not before['n'] and not after['n']:
+                continue
+            change = None
+            if before['n'] and after['n'] and before['median']:
+                change = after['median'] / before['median'] - 1
+            rows.append((host, metric, before, after, change))
+    return rows
+
+
+def hop_failures(hops):
+    """
+    {host: (failed hops, total hops)} for a run
+    """
+    counts = {}
+    for hop in hops:
+        failed, total = counts.get(hop['host'], (0, 0))
+        counts[hop['host']] = (failed + (not hop['ok']), total + 1)
+    return counts
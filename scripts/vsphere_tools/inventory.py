@@ -0,0 +1,268 @@
+"""
+    PropertyCollector backed inventory lookups for the vsphere-tools scripts
+
+    Reading a property off a pyVmomi managed object is a round trip to the
+    VC.  Everything in here fetches what it needs for many objects with one
+    (paged) RetrievePropertiesEx call instead.
+"""
+
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+# maxObjects per RetrievePropertiesEx page
+PAGE_SIZE = 1000
+
+
+def retrieve_properties(collector, spec_set, page_size=PAGE_SIZE):
+    """
+    Run a RetrievePropertiesEx, following the continuation token until
+    all pages have been read.
+
+    collector - a PropertyCollector, usually content.propertyCollector
+    spec_set - list of vmodl.query.PropertyCollector.FilterSpec
+    page_size - maxObjects per page
+
+    yields - (managed object, {property path: value}) for each object
+    """
+    options = vmodl.query.PropertyCollector.RetrieveOptions(
+        maxObjects=page_size)
+    result = collector.RetrievePropertiesEx(specSet=spec_set,
+                                            options=options)
+    while result:
+        for obj_content in result.objects:
+            yield obj_content.obj, dict(
+                (prop.name, prop.val) for prop in obj_content.propSet or [])
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+
+def resolve_names(lookup, names):
+    """
+    Resolve a list of names in one go
+
+    lookup - function taking a name, returning its object or None
+    names - list of names to look for
+    return - ({name: object}, [names not found])
+    """
+    found = {}
+    missing = []
+    for name in names:
+        obj = lookup(name)
+        if obj is None:
+            missing.append(name)
+        else:
+            found[name] = obj
+    return found, missing
+
+
+def view_filter(view, paths):
+    """
+    The FilterSpec for properties of every object in a ContainerView
+
+    view - the vim.view.ContainerView
+    paths - {managed object type: list of property paths}
+    """
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseView', path='view', skip=False,
+        type=vim.view.ContainerView)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(
+        type=this_type, pathSet=path_set)
+                  for this_type, path_set in paths.items()]
+    return vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=prop_specs)
+
+
+def collect_properties(content, vimtype, path_set, container=None,
+                       page_size=PAGE_SIZE):
+    """
+    Fetch properties of every object of the given types below container
+
+    content - the ServiceContent of a VC connection
+    vimtype - list of managed object types, eg [vim.VirtualMachine]
+    path_set - list of property paths to fetch, eg ['name']
+    container - the folder/entity to start from, defaults to the rootFolder
+    page_size - maxObjects per page
+
+    yields - (managed object, {property path: value}) for each object
+    """
+    view = content.viewManager.CreateContainerView(
+        container or content.rootFolder, vimtype, True)
+    try:
+        filter_spec = view_filter(view, dict(
+            (this_type, path_set) for this_type in vimtype))
+        for item in retrieve_properties(content.propertyCollector,
+                                        [filter_spec], page_size):
+            yield item
+    finally:
+        view.DestroyView()
+
+
+def collect_object_properties(content, objs, path_set, page_size=PAGE_SIZE):
+    """
+    Fetch properties of an explicit list of objects in one call
+
+    content - the ServiceContent of a VC connection
+    objs - list of managed objects, all of which must have every path
+    path_set - list of property paths to fetch
+    page_size - maxObjects per page
+
+    yields - (managed object, {property path: value}) for each object
+    """
+    if not objs:
+        return
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+                 for obj in objs]
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(
+        type=this_type, pathSet=path_set)
+                  for this_type in set(type(obj) for obj in objs)]
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=obj_specs, propSet=prop_specs)
+    for item in retrieve_properties(content.propertyCollector,
+                                    [filter_spec], page_size):
+        yield item
+
+
+def resource_vm_traversal():
+    """
+    The TraversalSpec that gets from a (cluster) compute resource to every
+    VM in it, through its root resource pool and any nested pools/vApps
+    """
+    pool_to_pool = vmodl.query.PropertyCollector.TraversalSpec(
+        name='poolToPool', type=vim.ResourcePool, path='resourcePool',
+        skip=False, selectSet=[
+            vmodl.query.PropertyCollector.SelectionSpec(name='poolToPool'),
+            vmodl.query.PropertyCollector.SelectionSpec(name='poolToVm')])
+    pool_to_vm = vmodl.query.PropertyCollector.TraversalSpec(
+        name='poolToVm', type=vim.ResourcePool, path='vm', skip=False)
+    return vmodl.query.PropertyCollector.TraversalSpec(
+        name='resourceToPool', type=vim.ComputeResource, path='resourcePool',
+        skip=False, selectSet=[pool_to_pool, pool_to_vm])
+
+
+def resource_vm_filter(compute_resource, path_set):
+    """
+    The FilterSpec for path_set of every VM in a (cluster) compute resource
+
+    compute_resource - a ComputeResource or ClusterComputeResource
+    path_set - list of VM property paths to fetch
+    """
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=compute_resource, skip=True,
+        selectSet=[resource_vm_traversal()])
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.VirtualMachine, pathSet=path_set)
+    return vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def collect_resource_vms(content, compute_resource, path_set,
+                         page_size=PAGE_SIZE):
+    """
+    Fetch properties of every VM in a (cluster) compute resource with one
+    paged RetrievePropertiesEx, rather than walking its resource pools
+
+    content - the ServiceContent of a VC connection
+    compute_resource - a ComputeResource or ClusterComputeResource
+    path_set - list of VM property paths to fetch
+    page_size - maxObjects per page
+
+    yields - (vm object, {property path: value}) for each VM
+    """
+    for item in retrieve_properties(
+            content.propertyCollector,
+            [resource_vm_filter(compute_resource, path_set)], page_size):
+        yield item
+
+
+def vm_placement(content, vm_objs):
+    """
+    Find the host and datastores of a list of VMs in one call
+
+    content - the ServiceContent of a VC connection
+    vm_objs - list of VMs
+    return - {vm object: [('host', host), ('datastore', datastore), ...]}
+    """
+    placement = {}
+    for obj, props in collect_object_properties(
+            content, vm_objs, ['runtime.host', 'datastore']):
+        keys = [('datastore', datastore)
+                for datastore in props.get('datastore') or []]
+        if props.get('runtime.host') is not None:
+            keys.insert(0, ('host', props['runtime.host']))
+        placement[obj] = keys
+    return placement
+
+
+class InventoryIndex(object):
+    """
+    A name -> managed object index of a VC's inventory
+
+    Built from a single property collection of the name of every object of
+    the requested types, after which lookups are answered from a dict.
+    """
+
+    def __init__(self, content, vimtype, container=None):
+        """
+        content - the ServiceContent of a VC connection
+        vimtype - list of managed object types to index
+        container - the folder/entity to start from, defaults to rootFolder
+        """
+        self.vimtype = vimtype
+        self.objects = []
+        self.by_name = {}
+        for obj, props in collect_properties(content, vimtype, ['name'],
+                                             container):
+            self.add(obj, props.get('name'))
+
+    def add(self, obj, name):
+        """
+        Add an object to the index under name
+        """
+        self.objects.append(obj)
+        self.by_name.setdefault(name, []).append(obj)
+
+    def find(self, name, vimtype=None):
+        """
+        Return every indexed object called name
+
+        name - the name to look for
+        vimtype - optional list of types to restrict the result to
+        """
+        found = self.by_name.get(name, [])
+        if vimtype:
+            found = [obj for obj in found if isinstance(obj, tuple(vimtype))]
+        return found
+
+    def get(self, name=None, vimtype=None):
+        """
+        Return the first object called name, or the first object indexed if
+        name is None.  None if nothing matches.
+        """
+        if name is None:
+            found = self.objects
+            if vimtype:
+                found = [obj for obj in found
+                         if isinstance(obj, tuple(vimtype))]
+        else:
+            found = self.find(name, vimtype)
+        if found:
+            return found[0]
+        return None
+
+    def resolve(self, names, vimtype=None):
+        """
+        Resolve a list of names in one go
+
+        names - list of names to look for
+        vimtype - optional list of types to restrict the result to
+        return - ({name: managed object}, [names not found])
+        """
+        return resolve_names(lambda name: self.get(name, vimtype), names)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __len__(self):
+        return len(self.objects)
@@ -0,0 +1,192 @@
+"""
+    Batched PerformanceManager queries for the vsphere-tools scripts
+
+    Counters are asked for by name (eg cpu.usage.average), and the name ->
+    counter ID map is kept on disk per vCenter - it doesn't change from run
+    to run, and perfManager.perfCounter is a big download.  Many entities
+    go into each QueryPerf, split so as to stay under the vCenter's limit
+    on metrics per query.
+
+    Which counters an entity has depends on the entity itself (its host,
+    its devices, whether it's running), so QueryAvailablePerfMetric is
+    asked about each one, and the answer kept on disk by entity and
+    interval for AVAILABLE_TTL.  Each entity is then only asked for the
+    counters it has, which packs more of them into each query.
+"""
+
+# pylint: disable=protected-access
+
+import json
+import os
+import time
+
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+
+from .cache import CACHE_DIR, write_json
+
+# the realtime (20 second) sampling interval
+REALTIME_INTERVAL = 20
+# vpxd.stats.maxQueryMetrics - vCenter's default limit on entity x counter
+# combinations in one QueryPerf, which applies to the historical intervals
+MAX_QUERY_METRICS = 64
+# realtime stats aren't under that limit; this just keeps each call sane
+REALTIME_QUERY_METRICS = 10000
+# how long an entity's available counters are trusted for, in seconds
+AVAILABLE_TTL = 24 * 3600
+
+
+def counter_name(counter):
+    """
+    The dotted name of a PerfCounterInfo, eg cpu.usage.average
+    """
+    return '%s.%s.%s' % (counter.groupInfo.key, counter.nameInfo.key,
+                         counter.rollupType)
+
+
+class PerfCollector(object):
+    """
+    Query performance counters for many entities at once
+    """
+
+    def __init__(self, content, interval=REALTIME_INTERVAL, max_metrics=None,
+                 cache_dir=CACHE_DIR):
+        """
+        content - the ServiceContent of a VC connection
+        interval - the sampling interval in seconds, 20 for realtime
+        max_metrics - most entity x counter combinations per QueryPerf,
+                      defaults to MAX_QUERY_METRICS for historical intervals
+        cache_dir - where the counter and availability cache file lives
+        """
+        self.perf_manager = content.perfManager
+        self.interval = interval
+        if max_metrics is None:
+            max_metrics = REALTIME_QUERY_METRICS \
+                if interval == REALTIME_INTERVAL else MAX_QUERY_METRICS
+        self.max_metrics = max_metrics
+        self.path = os.path.join(cache_dir, 'perf-%s.json' %
+                                 content.about.instanceUuid)
+        self.counters = {}
+        # {'interval/moid': [when it was checked, [counter IDs]]}
+        self.available = {}
+        self.load()
+
+    def load(self):
+        """
+        Read the cached counter IDs and available counters, if there are
+        any
+        """
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+        self.counters = data.get('counters', {})
+        self.available = data.get('available', {})
+
+    def save(self):
+        """
+        Write the cache file out, replacing the previous one in one go, and
+        leaving out availability that has expired
+        """
+        now = time.time()
+        self.available = dict(
+            (key, checked) for key, checked in self.available.items()
+            if now - checked[0] <= AVAILABLE_TTL)
+        write_json(self.path, {'counters': self.counters,
+                               'available': self.available})
+
+    def counter_ids(self, names):
+        """
+        Look up counter IDs by name, fetching perfManager.perfCounter only
+        when a name isn't cached
+
+        return - {name: counter ID}
+        """
+        if any(name not in self.counters for name in names):
+            self.counters = dict((counter_name(counter), counter.key)
+                                 for counter in self.perf_manager.perfCounter)
+            self.save()
+        missing = [name for name in names if name not in self.counters]
+        if missing:
+            raise Exception("Unknown performance counters: " +
+                            ", ".join(missing))
+        return dict((name, self.counters[name]) for name in names)
+
+    def available_ids(self, entity):
+        """
+        The counter IDs an entity has at this interval, from the cache or
+        failing that QueryAvailablePerfMetric
+
+        return - (set of counter IDs, True if it had to be asked)
+        """
+        key = '%d/%s' % (self.interval, entity._moId)
+        checked = self.available.get(key)
+        if checked is not None and \
+                time.time() - checked[0] <= AVAILABLE_TTL:
+            return set(checked[1]), False
+        counter_ids = sorted(set(
+            metric.counterId for metric in
+            self.perf_manager.QueryAvailablePerfMetric(
+                entity=entity, intervalId=self.interval) or []))
+        self.available[key] = [time.time(), counter_ids]
+        return set(counter_ids), True
+
+    def batches(self, specs):
+        """
+        Split QuerySpecs into lists of them that stay within max_metrics
+        """
+        batch = []
+        size = 0
+        for spec in specs:
+            metrics = len(spec.metricId)
+            if batch and size + metrics > self.max_metrics:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(spec)
+            size += metrics
+        if batch:
+            yield batch
+
+    def query(self, entities, names, max_sample=1, instance=''):
+        """
+        Fetch counters for many entities in as few QueryPerf calls as the
+        limits allow
+
+        entities - list of managed entities, eg VMs
+        names - list of counter names, eg ['cpu.usage.average']
+        max_sample - how many of the most recent samples to fetch
+        instance - the counter instance, '' for the entity as a whole, '*'
+                   for every instance as well
+
+        return - {entity: {name: [values, oldest first]}}.  Counters an
+                 entity doesn't have are left out, as are entities with none
+                 of them.
+        """
+        ids = self.counter_ids(names)
+        by_id = dict((counter_id, name) for name, counter_id in ids.items())
+        specs = []
+        asked = False
+        for entity in entities:
+            available, checked = self.available_ids(entity)
+            asked = asked or checked
+            metric_ids = [vim.PerformanceManager.MetricId(
+                counterId=counter_id, instance=instance)
+                          for counter_id in ids.values()
+                          if counter_id in available]
+            if metric_ids:
+                specs.append(vim.PerformanceManager.QuerySpec(
+                    entity=entity, metricId=metric_ids,
+                    intervalId=self.interval, maxSample=max_sample))
+        if asked:
+            self.save()
+        results = {}
+        for batch in self.batches(specs):
+            for entity_metric in self.perf_manager.QueryPerf(
+                    querySpec=batch) or []:
+                values = results.setdefault(entity_metric.entity, {})
+                for series in entity_metric.value or []:
+                    name = by_id.get(series.id.counterId)
+                    if name is not None:
+                        values.setdefault(name, []).extend(series.value)
+        return results
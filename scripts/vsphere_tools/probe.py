@@ -0,0 +1,581 @@
+"""
+    In-process reachability probes for the vsphere-tools scripts
+
+    Probes go out from asyncio rather than by running the system ping, so
+    there's no process per check, and checking many addresses at once takes
+    about as long as checking one.  ICMP echo is sent over an unprivileged
+    datagram socket where the OS allows it (net.ipv4.ping_group_range on
+    Linux), or a raw socket when running as root.  Where neither is allowed,
+    or when asked for, a TCP connect to a port is timed instead - a refused
+    connection still shows the host is up.
+
+    ProbeMonitor keeps probing one address every few tens of milliseconds
+    from a background thread, eg for the length of a vMotion, so how long it
+    stopped answering can be measured rather than just whether it answers
+    afterwards.
+"""
+
+import asyncio
+import itertools
+import os
+import socket
+import struct
+import threading
+import time
+
+# probes sent to each address, and the gap between them in seconds
+COUNT = 3
+INTERVAL = 0.2
+# seconds to wait for each reply
+TIMEOUT = 1.0
+# the port TCP probes connect to
+TCP_PORT = 22
+# most addresses probed at once by probe_hosts
+CONCURRENCY = 256
+# seconds between ProbeMonitor probes
+MONITOR_INTERVAL = 0.025
+# round trip time percentiles MonitorStats reports
+RTT_PERCENTILES = (50, 95, 99)
+# ICMP echo (request type, reply type) and protocol for each family
+ECHO_TYPES = {socket.AF_INET: (8, 0), socket.AF_INET6: (128, 129)}
+PROTOCOLS = {socket.AF_INET: socket.IPPROTO_ICMP,
+             socket.AF_INET6: socket.IPPROTO_ICMPV6}
+
+# echo identifiers, which tell raw socket probes' replies apart
+_IDENTS = itertools.count(os.getpid())
+
+
+class ProbeResult(object):
+    """
+    What came back from the probes of one address
+    """
+
+    def __init__(self, host, method):
+        """
+        host - the name or address probed
+        method - icmp or tcp
+        """
+        self.host = host
+        self.method = method
+        self.sent = 0
+        self.rtts = []
+        self.error = None
+
+    @property
+    def received(self):
+        """
+        How many probes got a reply
+        """
+        return len(self.rtts)
+
+    @property
+    def loss(self):
+        """
+        The fraction of probes that got no reply, 1.0 if none were sent
+        """
+        if not self.sent:
+            return 1.0
+        return 1.0 - float(self.received) / self.sent
+
+    @property
+    def ok(self):
+        """
+        True if any probe got a reply, as the ping command would see it
+        """
+        return self.received > 0
+
+    def rtt_stats(self):
+        """
+        return - (min, mean, max) round trip time in seconds, or None if
+                 nothing came back
+        """
+        if not self.rtts:
+            return None
+        return (min(self.rtts), sum(self.rtts) / len(self.rtts),
+                max(self.rtts))
+
+    def __str__(self):
+        summary = "%s: %d/%d replies, %.0f%% loss via %s" % (
+            self.host, self.received, self.sent, self.loss * 100, self.method)
+        stats = self.rtt_stats()
+        if stats is not None:
+            summary += ", rtt min/avg/max %.1f/%.1f/%.1f ms" % tuple(
+                rtt * 1000 for rtt in stats)
+        if self.error is not None:
+            summary += " (%s)" % self.error
+        return summary
+
+
+def checksum(data):
+    """
+    The internet checksum of data
+    """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(family, ident, seq, payload):
+    """
+    Build an ICMP (or ICMPv6) echo request.  The kernel fills in the ICMPv6
+    checksum, and the identifier for datagram sockets.
+    """
+    header = struct.pack('!BBHHH', ECHO_TYPES[family][0], 0, 0, ident, seq)
+    if family == socket.AF_INET:
+        header = header[:2] + struct.pack('!H', checksum(header + payload)) + \
+            header[4:]
+    return header + payload
+
+
+def parse_echo_reply(family, data):
+    """
+    Pick an echo reply apart
+
+    data - what was received, with or without an IPv4 header in front
+    return - (ident, seq, payload), or None if it isn't an echo reply
+    """
+    if family == socket.AF_INET and data and data[0] >> 4 == 4:
+        data = data[(data[0] & 0x0f) * 4:]
+    if len(data) < 8:
+        return None
+    icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+    if icmp_type != ECHO_TYPES[family][1]:
+        return None
+    return ident, seq, data[8:]
+
+
+def open_icmp_socket(family=socket.AF_INET):
+    """
+    Open a non-blocking socket to send echo requests from, unprivileged if
+    allowed, raw otherwise
+
+    return - (socket, True if it's a raw socket)
+    raises - OSError if ICMP isn't allowed at all
+    """
+    try:
+        sock = socket.socket(family, socket.SOCK_DGRAM, PROTOCOLS[family])
+        raw = False
+    except OSError:
+        sock = socket.socket(family, socket.SOCK_RAW, PROTOCOLS[family])
+        raw = True
+    sock.setblocking(False)
+    return sock, raw
+
+
+async def icmp_echo(sock, raw, family, address, ident, seq, timeout):
+    """
+    Send one echo request and wait for its reply
+
+    return - the round trip time in seconds, or None for no reply
+    """
+    loop = asyncio.get_running_loop()
+    payload = os.urandom(8)
+    start = time.perf_counter()
+    deadline = start + timeout
+    try:
+        sock.sendto(echo_request(family, ident, seq, payload),
+                    (address, 0))
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            data = await asyncio.wait_for(loop.sock_recv(sock, 65535),
+                                          remaining)
+            reply = parse_echo_reply(family, data)
+            # a raw socket sees every echo reply for the host; the
+            # kernel sorts them out for datagram sockets
+            if reply is not None and reply[1:] == (seq, payload) and \
+                    (not raw or reply[0] == ident):
+                return time.perf_counter() - start
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+
+async def tcp_connect(address, port, timeout, refused_ok=True):
+    """
+    Time a TCP connect
+
+    refused_ok - count a refused connection as a reply
+    return - the time to connect (or be refused) in seconds, or None for no
+             answer
+    """
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(address, port), timeout)
+    except ConnectionRefusedError:
+        return time.perf_counter() - start if refused_ok else None
+    except (OSError, asyncio.TimeoutError):
+        return None
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed
+
+
+async def open_target(host, method):
+    """
+    Look up an address to probe, and open the ICMP socket if there'll be one
+
+    host - the name or address to probe
+    method - icmp, tcp, or auto for icmp where it's allowed and tcp if not
+    return - (address, family, socket or None, raw, method used), address
+             being None and the method the error if it can't be probed
+    """
+    if method not in ('auto', 'icmp', 'tcp'):
+        raise Exception("Unknown probe method " + method)
+    loop = asyncio.get_running_loop()
+    try:
+        family, _, _, _, sockaddr = (await loop.getaddrinfo(
+            host, None, type=socket.SOCK_STREAM))[0]
+    except OSError as err:
+        return None, None, None, False, str(err)
+    if method == 'tcp':
+        return sockaddr[0], family, None, False, 'tcp'
+    try:
+        sock, raw = open_icmp_socket(family)
+    except OSError as err:
+        if method == 'icmp':
+            return None, None, None, False, str(err)
+        return sockaddr[0], family, None, False, 'tcp'
+    return sockaddr[0], family, sock, raw, 'icmp'
+
+
+async def probe(host, method='auto', count=COUNT, timeout=TIMEOUT,
+                interval=INTERVAL, port=TCP_PORT, refused_ok=True):
+    """
+    Probe one address count times
+
+    host - the name or address to probe
+    method - icmp, tcp, or auto for icmp where it's allowed and tcp if not
+    count - how many probes to send
+    timeout - seconds to wait for each reply
+    interval - seconds between probes
+    port, refused_ok - for tcp, the port and whether a refused connection
+                       counts as a reply
+
+    return - a ProbeResult
+    """
+    address, family, sock, raw, used = await open_target(host, method)
+    if address is None:
+        result = ProbeResult(host, 'tcp' if method == 'tcp' else 'icmp')
+        result.error = used
+        return result
+    result = ProbeResult(host, used)
+    ident = next(_IDENTS) & 0xffff
+    try:
+        for seq in range(count):
+            if seq:
+                await asyncio.sleep(interval)
+            result.sent += 1
+            if sock is not None:
+                rtt = await icmp_echo(sock, raw, family, address, ident,
+                                      seq, timeout)
+            else:
+                rtt = await tcp_connect(address, port, timeout, refused_ok)
+            if rtt is not None:
+                result.rtts.append(rtt)
+    finally:
+        if sock is not None:
+            sock.close()
+    return result
+
+
+async def probe_many(hosts, concurrency=CONCURRENCY, **options):
+    """
+    Probe many addresses at once, no more than concurrency at a time
+
+    options - as for probe
+    return - {host: ProbeResult}
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe_one(host):
+        async with semaphore:
+            return await probe(host, **options)
+
+    results = await asyncio.gather(*[probe_one(host) for host in hosts])
+    return dict(zip(hosts, results))
+
+
+def probe_hosts(hosts, concurrency=CONCURRENCY, **options):
+    """
+    Probe many addresses at once, from code that isn't already running an
+    event loop
+
+    hosts - list of names or addresses
+    options - as for probe
+    return - {host: ProbeResult}
+    """
+    return asyncio.run(probe_many(list(hosts), concurrency, **options))
+
+
+def percentile(ordered, percent):
+    """
+    The nearest rank percentile of an already sorted list
+    """
+    if not ordered:
+        return None
+    rank = max(1, int(-(-percent * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class MonitorStats(object):
+    """
+    What a ProbeMonitor saw: when each probe was sent, and its round trip
+    time or None if it got no reply
+    """
+
+    def __init__(self, host, method, interval):
+        """
+        host - the name or address probed
+        method - icmp or tcp
+        interval - seconds between probes
+        """
+        self.host = host
+        self.method = method
+        self.interval = interval
+        self.samples = []
+        self.error = None
+        # how many times reading replies failed, eg on an ICMP error
+        self.receive_errors = 0
+
+    @property
+    def sent(self):
+        """
+        How many probes were sent
+        """
+        return len(self.samples)
+
+    @property
+    def received(self):
+        """
+        How many probes got a reply
+        """
+        return len([rtt for _, rtt in self.samples if rtt is not None])
+
+    @property
+    def loss(self):
+        """
+        The fraction of probes that got no reply, 1.0 if none were sent
+        """
+        if not self.samples:
+            return 1.0
+        return 1.0 - float(self.received) / self.sent
+
+    def longest_outage(self):
+        """
+        The longest time the address didn't answer: from the first probe of
+        a run of unanswered ones to the next probe that was answered (or the
+        last probe sent, if it never answered again).  Good to about one
+        interval.
+
+        return - seconds, 0.0 if every probe was answered
+        """
+        longest = 0.0
+        lost_from = None
+        for sent_at, rtt in self.samples:
+            if rtt is None:
+                if lost_from is None:
+                    lost_from = sent_at
+            elif lost_from is not None:
+                longest = max(longest, sent_at - lost_from)
+                lost_from = None
+        if lost_from is not None:
+            longest = max(longest, self.samples[-1][0] - lost_from +
+                          self.interval)
+        return longest
+
+    def rtt_percentiles(self, percentiles=RTT_PERCENTILES):
+        """
+        return - {percentile: round trip time in seconds}, plus 0 and 100
+                 for the min and max; None for each if nothing came back
+        """
+        ordered = sorted(rtt for _, rtt in self.samples if rtt is not None)
+        return dict((percent, percentile(ordered, percent))
+                    for percent in (0,) + tuple(percentiles) + (100,))
+
+    def __str__(self):
+        summary = "%s: %d/%d replies, %.1f%% loss via %s, longest outage " \
+            "%.0f ms" % (self.host, self.received, self.sent,
+                         self.loss * 100, self.method,
+                         self.longest_outage() * 1000)
+        rtts = self.rtt_percentiles()
+        if rtts[0] is not None:
+            summary += ", rtt " + "/".join(
+                'min' if percent == 0 else 'max' if percent == 100 else
+                'p%d' % percent for percent in sorted(rtts)) + " " + \
+                "/".join("%.1f" % (rtts[percent] * 1000)
+                         for percent in sorted(rtts)) + " ms"
+        if self.receive_errors:
+            summary += ", %d receive errors" % self.receive_errors
+        if self.error is not None:
+            summary += " (%s)" % self.error
+        return summary
+
+
+class ProbeMonitor(object):
+    """
+    Probe one address every interval seconds from a background thread,
+    until stopped.  Probes go out on time whether or not the last one has
+    been answered, so an outage is seen at the interval's resolution.
+
+    with ProbeMonitor('10.0.0.1') as monitor:
+        ... migrate ...
+    print(monitor.stats)
+    """
+
+    def __init__(self, host, interval=MONITOR_INTERVAL, timeout=TIMEOUT,
+                 method='auto', port=TCP_PORT, refused_ok=True):
+        """
+        host - the name or address to probe
+        interval - seconds between probes
+        timeout - seconds after which a probe counts as lost
+        method, port, refused_ok - as for probe
+        """
+        self.host = host
+        self.interval = interval
+        self.timeout = timeout
+        self.method = method
+        self.port = port
+        self.refused_ok = refused_ok
+        self.stats = MonitorStats(host, method, interval)
+        self._loop = None
+        self._stop = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start probing, returning once the first probe is about to go out
+        """
+        self._thread = threading.Thread(target=asyncio.run,
+                                        args=(self._run(),), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        """
+        Stop probing, giving the probes still out up to timeout to come back
+
+        return - the MonitorStats
+        """
+        if self._thread is None:
+            return self.stats
+        try:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        except (AttributeError, RuntimeError):
+            # it never got going, or has already finished
+            pass
+        self._thread.join()
+        self._thread = None
+        return self.stats
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _wait(self, seconds):
+        # sleep, but wake up for stop(); True if stopped
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        try:
+            address, family, sock, raw, used = await open_target(
+                self.host, self.method)
+        except Exception as err:  # pylint: disable=broad-except
+            address, used = None, str(err)
+        if address is None:
+            self.stats.error = used
+            self._ready.set()
+            return
+        self.stats.method = used
+        self._ready.set()
+        if sock is None:
+            await self._run_tcp(address)
+            return
+        try:
+            await self._run_icmp(sock, raw, family, address)
+        finally:
+            sock.close()
+
+    def _record(self, index, rtt):
+        if rtt is not None and rtt <= self.timeout:
+            self.stats.samples[index] = (self.stats.samples[index][0], rtt)
+
+    async def _run_tcp(self, address):
+        async def connect(index):
+            self._record(index, await tcp_connect(
+                address, self.port, self.timeout, self.refused_ok))
+
+        connects = []
+        while True:
+            self.stats.samples.append((time.perf_counter(), None))
+            connects.append(asyncio.ensure_future(
+                connect(len(self.stats.samples) - 1)))
+            if await self._wait(self.interval):
+                break
+        await asyncio.gather(*connects)
+
+    async def _run_icmp(self, sock, raw, family, address):
+        loop = asyncio.get_running_loop()
+        ident = next(_IDENTS) & 0xffff
+        # sequence number: (sample index, payload); sequence numbers wrap
+        # at 65536, long after a probe has timed out
+        pending = {}
+
+        async def receive():
+            while True:
+                try:
+                    data = await loop.sock_recv(sock, 65535)
+                except OSError:
+                    # eg an ICMP error queued on the socket, which may well
+                    # come back straight away; wait for the next probe
+                    # rather than spin on it
+                    self.stats.receive_errors += 1
+                    await asyncio.sleep(self.interval)
+                    continue
+                received_at = time.perf_counter()
+                reply = parse_echo_reply(family, data)
+                if reply is None or (raw and reply[0] != ident) or \
+                        reply[1] not in pending:
+                    continue
+                index, payload = pending[reply[1]]
+                if reply[2] == payload:
+                    del pending[reply[1]]
+                    self._record(index, received_at -
+                                 self.stats.samples[index][0])
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            while True:
+                index = len(self.stats.samples)
+                seq = index & 0xffff
+                payload = os.urandom(8)
+                pending[seq] = (index, payload)
+                self.stats.samples.append((time.perf_counter(), None))
+                try:
+                    sock.sendto(echo_request(family, ident, seq, payload),
+                                (address, 0))
+                except OSError:
+                    # eg no route to it, which is an outage too
+                    pass
+                if await self._wait(self.interval):
+                    break
+            # let the last probes come back
+            deadline = time.perf_counter() + self.timeout
+            while pending and time.perf_counter() < deadline:
+                await asyncio.sleep(min(self.interval, self.timeout))
+        finally:
+            receiver.cancel()
@@ -0,0 +1,161 @@
+"""
+    Reusing vCenter sessions between runs for the vsphere-tools scripts
+
+    Logging in (and the ServiceContent fetch that comes with it) is the
+    slowest part of a short run, and every login leaves a session behind on
+    the vCenter until it times out.  With reuse turned on, the session
+    cookie is kept per server and user - in the system keyring if the
+    keyring module is installed, otherwise in a file only the user can
+    read - and the next run picks the session back up, only logging in
+    again once it has expired.  Reused sessions aren't logged out at exit,
+    so that the run after can have them too.
+"""
+
+# pylint: disable=protected-access
+
+import atexit
+import getpass
+import hashlib
+import os
+import ssl
+from http.cookies import SimpleCookie
+from pathlib import Path
+
+from pyvim import connect
+from pyvim.connect import Disconnect
+from pyVmomi import vmodl  # pylint: disable=no-name-in-module
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+SESSION_DIR = str(Path.home()) + os.path.sep + '.vsphere-tools' + \
+    os.path.sep + 'sessions'
+# the keyring service the session cookies are kept under
+KEYRING_SERVICE = 'vsphere-tools'
+# the name of the vCenter's session cookie
+COOKIE_NAME = 'vmware_soap_session'
+
+
+class SessionStore(object):
+    """
+    Where the session cookie for one server and user is kept
+    """
+
+    def __init__(self, server, user, port=443, session_dir=SESSION_DIR,
+                 use_keyring=True):
+        """
+        server, user, port - what the session is for
+        session_dir - where session files live when there's no keyring
+        use_keyring - use the keyring module, if it's installed
+        """
+        self.key = '%s@%s:%d' % (user, server, port)
+        self.keyring = keyring if use_keyring else None
+        self.path = os.path.join(session_dir, hashlib.sha256(
+            self.key.encode('utf-8')).hexdigest())
+
+    def load(self):
+        """
+        return - the saved session id, or None
+        """
+        if self.keyring is not None:
+            return self.keyring.get_password(KEYRING_SERVICE, self.key)
+        try:
+            with open(self.path) as session_file:
+                return session_file.read().strip() or None
+        except IOError:
+            return None
+
+    def save(self, session_id):
+        """
+        Keep session_id for the next run
+        """
+        if self.keyring is not None:
+            self.keyring.set_password(KEYRING_SERVICE, self.key, session_id)
+            return
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        # created 0600, rather than made private after it's been written
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT |
+                               os.O_TRUNC, 0o600), 'w') as session_file:
+            session_file.write(session_id)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Forget the saved session
+        """
+        if self.keyring is not None:
+            try:
+                self.keyring.delete_password(KEYRING_SERVICE, self.key)
+            except Exception:  # pylint: disable=broad-except
+                pass
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def session_id(si_obj):
+    """
+    The session id of a connection, from its session cookie
+    """
+    cookie = SimpleCookie(si_obj._stub.cookie).get(COOKIE_NAME)
+    if cookie is None:
+        return None
+    return cookie.value
+
+
+def resume_session(server, saved_id, port=443, context=None):
+    """
+    Pick a saved session back up
+
+    return - the connection, or None if the session has expired
+    """
+    try:
+        si_obj = connect.Connect(host=server, port=port, sslContext=context,
+                                 sessionId=saved_id)
+        if si_obj.RetrieveContent().sessionManager.currentSession is None:
+            return None
+    except (vmodl.MethodFault, IOError):
+        return None
+    return si_obj
+
+
+def connect_vc(server, user, password=None, port=443, reuse=False,
+               store=None):
+    """
+    Connect to a vCenter, optionally reusing the session from a previous run
+
+    server, user, port - what to connect to, and as who
+    password - the password, prompted for if None and a login is needed
+    reuse - reuse a saved session if it's still good, and save this one
+            for next time rather than logging out at exit
+    store - the SessionStore to use, defaults to one for server and user
+
+    return - the ServiceInstance
+    """
+    context = ssl._create_unverified_context()
+    if reuse:
+        store = store or SessionStore(server, user, port)
+        saved_id = store.load()
+        if saved_id:
+            si_obj = resume_session(server, saved_id, port, context)
+            if si_obj is not None:
+                return si_obj
+            store.clear()
+    if password is None:
+        password = getpass.getpass(
+            prompt='Enter password for host %s and user %s: ' %
+            (server, user))
+    si_obj = connect.Connect(host=server, user=user, pwd=password, port=port,
+                             sslContext=context)
+    if reuse:
+        new_id = session_id(si_obj)
+        if new_id:
+            store.save(new_id)
+    else:
+        atexit.register(Disconnect, si_obj)
+    return si_obj
@@ -0,0 +1,135 @@
+"""
+    An indexed model of a VM's snapshot tree for the vsphere-tools scripts
+
+    vm.snapshot.rootSnapshotList comes back from the VC as one nested data
+    object, so one property fetch is all it takes to have the whole tree.
+    SnapshotTree flattens that once, giving each snapshot its parent and
+    depth, and indexing them by name so lookups don't have to search the
+    tree again.
+
+    As with the recursive search this replaced, a name lookup stops at the
+    first match along each branch: a snapshot under another of the same
+    name (eg a "nightly" taken on top of the last "nightly") isn't found by
+    that name, so it neither makes the name ambiguous nor gets picked.
+"""
+
+
+class SnapshotNode(object):
+    """
+    One snapshot in a SnapshotTree
+    """
+    __slots__ = ('tree', 'snapshot', 'name', 'description', 'create_time',
+                 'state', 'parent', 'depth', 'children')
+
+    def __init__(self, tree, parent):
+        """
+        tree - the vim.vm.SnapshotTree data object for this snapshot
+        parent - the parent SnapshotNode, None for a root snapshot
+        """
+        self.tree = tree
+        self.snapshot = tree.snapshot
+        self.name = tree.name
+        self.description = tree.description
+        self.create_time = tree.createTime
+        self.state = tree.state
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children = []
+
+
+class SnapshotTree(object):
+    """
+    All the snapshots of one VM, in depth first order, indexed by name
+    """
+
+    def __init__(self, snapshotlist, vm_name=None):
+        """
+        snapshotlist - vm.snapshot.rootSnapshotList, None or [] for a VM
+                       without snapshots
+        vm_name - the name of the VM, for display
+        """
+        self.vm_name = vm_name
+        self.roots = []
+        self.nodes = []
+        self.by_name = {}
+        stack = [(snapshot, None) for snapshot in reversed(snapshotlist or [])]
+        while stack:
+            snapshot, parent = stack.pop()
+            node = SnapshotNode(snapshot, parent)
+            if parent is None:
+                self.roots.append(node)
+            else:
+                parent.children.append(node)
+            self.nodes.append(node)
+            if not self._shadowed(node):
+                self.by_name.setdefault(node.name, []).append(node)
+            stack.extend((child, node) for child in
+                         reversed(snapshot.childSnapshotList or []))
+
+    @staticmethod
+    def _shadowed(node):
+        """
+        True if one of node's ancestors has the same name
+        """
+        parent = node.parent
+        while parent is not None:
+            if parent.name == node.name:
+                return True
+            parent = parent.parent
+        return False
+
+    @classmethod
+    def from_vm(cls, vm_obj, vm_name=None):
+        """
+        Build the tree for a VM with a single fetch of vm.snapshot
+        """
+        snapshot_info = vm_obj.snapshot
+        if snapshot_info is None:
+            return cls([], vm_name)
+        return cls(snapshot_info.rootSnapshotList, vm_name)
+
+    def walk(self):
+        """
+        Iterate over every snapshot, depth first
+        """
+        return iter(self.nodes)
+
+    def find(self, name):
+        """
+        Return every snapshot called name that isn't under another one
+        called name
+        """
+        return self.by_name.get(name, [])
+
+    def find_one(self, name):
+        """
+        Return the one snapshot called name, raising an exception if there
+        are none or more than one
+        """
+        found = self.find(name)
+        if len(found) != 1:
+            raise Exception(
+                "** We did not find one and only one snapshot by that name")
+        return found[0]
+
+    def older_than(self, cutoff):
+        """
+        Return every snapshot created before cutoff, oldest first
+
+        cutoff - a timezone aware datetime
+        """
+        return sorted((node for node in self.nodes
+                       if node.create_time < cutoff),
+                      key=lambda node: node.create_time)
+
+    def lines(self):
+        """
+        Yield a line of text for each snapshot, depth first
+        """
+        for node in self.nodes:
+            yield "VM: %s; Name: %s; Description: %s; Created: %s; " \
+                "VMState: %s" % (self.vm_name, node.name, node.description,
+                                 node.create_time, node.state)
+
+    def __len__(self):
+        return len(self.nodes)
@@ -0,0 +1,220 @@
+"""
+    Columnar VM allocation stats for the vsphere-tools scripts
+
+    VM attributes are stored as one column per attribute, with each VM's
+    group (eg its cluster) held as an integer code.  Totals, overcommit
+    ratios and percentiles per group are then worked out with numpy over
+    the whole columns, rather than looping over the VMs in Python.
+"""
+
+import numpy
+
+# percentiles of the powered on VMs' sizes reported for each group
+PERCENTILES = (50, 95)
+
+
+def group_percentile(codes, values, groups, percentile):
+    """
+    The percentile of values within each group, interpolating linearly
+    between the closest ranks like numpy.percentile
+
+    codes - integer array of the group of each value
+    values - array of values
+    groups - how many groups there are
+    percentile - 0 to 100
+
+    return - float array, one per group, nan for a group with no values
+    """
+    result = numpy.full(groups, numpy.nan)
+    if not len(values):  # pylint: disable=len-as-condition
+        return result
+    ordered = values[numpy.lexsort((values, codes))].astype(float)
+    counts = numpy.bincount(codes, minlength=groups)
+    starts = numpy.cumsum(counts) - counts
+    position = percentile / 100.0 * numpy.maximum(counts - 1, 0)
+    lower = numpy.floor(position).astype(int)
+    upper = numpy.ceil(position).astype(int)
+    last = len(ordered) - 1
+    low = ordered[numpy.minimum(starts + lower, last)]
+    high = ordered[numpy.minimum(starts + upper, last)]
+    present = counts > 0
+    result[present] = (low + (high - low) * (position - lower))[present]
+    return result
+
+
+def group_stats(codes, values, groups):
+    """
+    Sum, count, mean and max of values within each group
+
+    codes - integer array of the group of each value
+    values - array of values
+    groups - how many groups there are
+
+    return - {'sum', 'count', 'mean', 'max'} of float arrays, one per group,
+             mean and max being nan for a group with no values
+    """
+    values = numpy.asarray(values, dtype=float)
+    total = numpy.bincount(codes, weights=values, minlength=groups)
+    count = numpy.bincount(codes, minlength=groups).astype(float)
+    most = numpy.full(groups, -numpy.inf)
+    numpy.maximum.at(most, codes, values)
+    most[count == 0] = numpy.nan
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+    return {'sum': total, 'count': count, 'mean': mean, 'max': most}
+
+
+class AllocationTable(object):
+    """
+    The CPU and memory allocated to VMs, grouped by cluster
+    """
+
+    def __init__(self):
+        self.groups = []
+        self.codes = {}
+        self.capacity = []
+        self._columns = ([], [], [], [])
+        self._keys = []
+        self._rows = {}
+
+    def add_group(self, group, cpu_threads=None, memory_mb=None):
+        """
+        Add a group, with the capacity its VMs are allocated from
+
+        group - the group name, eg vcenter.dc.cluster
+        cpu_threads - the cluster's summary.numCpuThreads, if known
+        memory_mb - the cluster's summary.effectiveMemory, if known
+        """
+        if group not in self.codes:
+            self.codes[group] = len(self.groups)
+            self.groups.append(group)
+            self.capacity.append((numpy.nan, numpy.nan))
+        self.capacity[self.codes[group]] = (
+            numpy.nan if cpu_threads is None else cpu_threads,
+            numpy.nan if memory_mb is None else memory_mb)
+
+    def add(self, group, num_cpu, memory_mb, powered_on, key=None):
+        """
+        Add a VM to a group
+
+        num_cpu - vCPUs allocated to the VM
+        memory_mb - memory allocated to the VM
+        powered_on - True if the VM is powered on
+        key - optional key for the VM (eg its moid).  Adding a key that is
+              already in the table replaces that VM's row.
+        """
+        if group not in self.codes:
+            self.add_group(group)
+        row = (self.codes[group], num_cpu, memory_mb, powered_on)
+        if key is not None and key in self._rows:
+            for column, value in zip(self._columns, row):
+                column[self._rows[key]] = value
+            return
+        if key is not None:
+            self._rows[key] = len(self._keys)
+        self._keys.append(key)
+        for column, value in zip(self._columns, row):
+            column.append(value)
+
+    def remove(self, key):
+        """
+        Take the VM added with key out of the table, if it's there
+        """
+        if key not in self._rows:
+            return
+        row = self._rows.pop(key)
+        last_key = self._keys.pop()
+        for column in self._columns:
+            value = column.pop()
+            if row < len(column):
+                column[row] = value
+        if row < len(self._keys):
+            # the last row has been moved into the gap
+            self._keys[row] = last_key
+            if last_key is not None:
+                self._rows[last_key] = row
+
+    def group_of(self, key):
+        """
+        return - the group of the VM added with key, None if it isn't there
+        """
+        if key not in self._rows:
+            return None
+        return self.groups[self._columns[0][self._rows[key]]]
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def arrays(self):
+        """
+        return - (group codes, vCPUs, memory MB, powered on) numpy arrays
+        """
+        codes, cpus, memory, powered_on = self._columns
+        return (numpy.array(codes, dtype=int),
+                numpy.array(cpus, dtype=float),
+                numpy.array(memory, dtype=float),
+                numpy.array(powered_on, dtype=bool))
+
+    def allocation(self):
+        """
+        Total vCPUs, memory and VMs, powered on and off, for every group
+
+        return - {group: {'onCPU', 'onMB', 'onTotal', 'offCPU', 'offMB',
+                 'offTotal'}}
+        """
+        codes, cpus, memory, powered_on = self.arrays()
+        powered_off = ~powered_on
+
+        def total(weights):
+            return numpy.bincount(codes, weights=weights,
+                                  minlength=len(self.groups)).astype(int)
+
+        columns = {'onCPU': total(cpus * powered_on),
+                   'onMB': total(memory * powered_on),
+                   'onTotal': total(powered_on.astype(float)),
+                   'offCPU': total(cpus * powered_off),
+                   'offMB': total(memory * powered_off),
+                   'offTotal': total(powered_off.astype(float))}
+        return dict((group, dict((key, int(values[code]))
+                                 for key, values in columns.items()))
+                    for code, group in enumerate(self.groups))
+
+    def overcommit(self):
+        """
+        vCPUs and memory of powered on VMs over the group's capacity
+
+        return - {group: {'cpu': ratio, 'memory': ratio}}, nan where the
+                 capacity isn't known
+        """
+        codes, cpus, memory, powered_on = self.arrays()
+        capacity = numpy.array(self.capacity, dtype=float).reshape(-1, 2)
+        groups = len(self.groups)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            cpu = numpy.bincount(codes, weights=cpus * powered_on,
+                                 minlength=groups) / capacity[:, 0]
+            mem = numpy.bincount(codes, weights=memory * powered_on,
+                                 minlength=groups) / capacity[:, 1]
+        cpu[~numpy.isfinite(cpu)] = numpy.nan
+        mem[~numpy.isfinite(mem)] = numpy.nan
+        return dict((group, {'cpu': float(cpu[code]),
+                             'memory': float(mem[code])})
+                    for code, group in enumerate(self.groups))
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """
+        Percentiles of the vCPUs and memory of powered on VMs in each group
+
+        return - {group: {'cpuP50': .., 'mbP50': .., ...}}, nan for a group
+                 with no powered on VMs
+        """
+        codes, cpus, memory, powered_on = self.arrays()
+        result = dict((group, {}) for group in self.groups)
+        for percentile in percentiles:
+            for name, values in (('cpu', cpus), ('mb', memory)):
+                column = group_percentile(codes[powered_on],
+                                          values[powered_on],
+                                          len(self.groups), percentile)
+                for code, group in enumerate(self.groups):
+                    result[group]['%sP%d' % (name, percentile)] = \
+                        float(column[code])
+        return result
@@ -0,0 +1,328 @@
+"""
+    Waiting on vCenter tasks for the vsphere-tools scripts
+
+    Rather than sleeping and re-reading task.info, a private PropertyCollector
+    is given a filter per task, and WaitForUpdatesEx blocks until one of them
+    changes.  Any number of tasks can be waited on together, and each one is
+    handed back as soon as it finishes.  If the collector can't be used, it
+    falls back to polling task.info with a backoff.
+
+    The connection's PropertyCollector is looked up once per connection,
+    and wait_for_task checks task.info once before setting a collector up,
+    so a one-off wait on a task that's already done is a single call.
+"""
+
+# pylint: disable=protected-access
+
+import threading
+import time
+import weakref
+
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+# the task properties watched for changes
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.error']
+# how long a single WaitForUpdatesEx may block for
+WAIT_SECONDS = 60
+# first and longest sleep between polls when falling back to polling
+POLL_MIN = 0.1
+POLL_MAX = 2.0
+
+FINISHED_STATES = [vim.TaskInfo.State.success, vim.TaskInfo.State.error]
+
+# {stub: its connection's PropertyCollector}, guarded by _COLLECTORS_LOCK
+_COLLECTORS = weakref.WeakKeyDictionary()
+_COLLECTORS_LOCK = threading.Lock()
+
+
+def task_collector(task):
+    """
+    Find the PropertyCollector of the connection a task came from, only
+    asking the VC the first time for each connection
+    """
+    with _COLLECTORS_LOCK:
+        collector = _COLLECTORS.get(task._stub)
+    if collector is None:
+        si_obj = vim.ServiceInstance('ServiceInstance', task._stub)
+        collector = si_obj.RetrieveContent().propertyCollector
+        with _COLLECTORS_LOCK:
+            _COLLECTORS[task._stub] = collector
+    return collector
+
+
+def _task_error(info):
+    error = info.get('info.error')
+    if isinstance(error, Exception):
+        return error
+    return Exception(getattr(error, 'msg', None) or "Task failed")
+
+
+class TaskWaiter(object):
+    """
+    Wait on many tasks at once, getting each back as it finishes
+    """
+
+    def __init__(self, collector, progress=None):
+        """
+        collector - a PropertyCollector on the tasks' connection, usually
+                    content.propertyCollector.  A private one is made from it
+                    so that other waiters on the connection aren't disturbed.
+        progress - optional function(task, state, progress) called whenever a
+                   task's state or progress changes
+        """
+        self.progress = progress
+        self.pending = {}
+        self.filters = {}
+        self.version = ''
+        self.delay = POLL_MIN
+        try:
+            self.collector = collector.CreatePropertyCollector()
+        except vmodl.MethodFault:
+            self.collector = None
+
+    def add(self, task, key=None):
+        """
+        Start watching a task
+
+        task - the task
+        key - what to hand back for this task from wait(), defaults to task
+        """
+        self.pending[task._moId] = (task, task if key is None else key, {})
+        if self.collector is None:
+            return
+        try:
+            self.filters[task._moId] = self.collector.CreateFilter(
+                vmodl.query.PropertyCollector.FilterSpec(
+                    objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                        obj=task)],
+                    propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                        type=vim.Task, pathSet=TASK_PROPERTIES)]), True)
+        except vmodl.MethodFault:
+            self._fall_back()
+
+    def _fall_back(self):
+        self.close()
+        self.collector = None
+        self.filters = {}
+
+    def _changed(self, moid, info, finished):
+        task, key, _ = self.pending[moid]
+        state = info.get('info.state')
+        if self.progress is not None:
+            self.progress(task, state, info.get('info.progress'))
+        if state in FINISHED_STATES:
+            del self.pending[moid]
+            task_filter = self.filters.pop(moid, None)
+            # a finished task doesn't change again, so the last one's filter
+            # is left for close() to throw away with the collector
+            if task_filter is not None and self.pending:
+                task_filter.DestroyPropertyFilter()
+            if state == vim.TaskInfo.State.success:
+                finished.append((key, None))
+            else:
+                finished.append((key, _task_error(info)))
+
+    def _wait_for_updates(self, finished):
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=WAIT_SECONDS)
+        try:
+            update_set = self.collector.WaitForUpdatesEx(self.version,
+                                                         options)
+        except vmodl.MethodFault:
+            self._fall_back()
+            return
+        if update_set is None:
+            return
+        self.version = update_set.version
+        for filter_update in update_set.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                moid = obj_update.obj._moId
+                if moid not in self.pending:
+                    continue
+                info = self.pending[moid][2]
+                for change in obj_update.changeSet or []:
+                    info[change.name] = change.val
+                self._changed(moid, info, finished)
+
+    def _poll(self, finished):
+        for moid in list(self.pending):
+            task_info = self.pending[moid][0].info
+            self._changed(moid, {'info.state': task_info.state,
+                                 'info.progress': task_info.progress,
+                                 'info.error': task_info.error}, finished)
+        if self.pending and not finished:
+            time.sleep(self.delay)
+            self.delay = min(self.delay * 2, POLL_MAX)
+        else:
+            self.delay = POLL_MIN
+
+    def wait(self):
+        """
+        Block until at least one of the pending tasks has finished
+
+        return - list of (key, error) for the tasks that finished, error
+                 being None for a successful task
+        """
+        finished = []
+        while self.pending and not finished:
+            if self.collector is not None:
+                self._wait_for_updates(finished)
+            else:
+                self._poll(finished)
+        return finished
+
+    def close(self):
+        """
+        Throw away the private collector, and the filters with it
+        """
+        if self.collector is not None:
+            try:
+                self.collector.DestroyPropertyCollector()
+            except vmodl.MethodFault:
+                pass
+
+
+def wait_for_tasks(tasks, progress=None, collector=None):
+    """
+    Wait for a list of tasks to all finish
+
+    tasks - list of tasks, all on the same connection
+    progress - optional function(task, state, progress) called on changes
+    collector - PropertyCollector to use, found from the tasks if not given
+
+    return - list of errors in the order of tasks, None where the task
+             succeeded
+    """
+    if not tasks:
+        return []
+    waiter = TaskWaiter(collector or task_collector(tasks[0]), progress)
+    results = {}
+    try:
+        for index, task in enumerate(tasks):
+            waiter.add(task, index)
+        while waiter.pending:
+            for index, error in waiter.wait():
+                results[index] = error
+    finally:
+        waiter.close()
+    return [results[index] for index in range(len(tasks))]
+
+
+class Throttle(object):
+    """
+    Caps how many tasks may be running at once against shared resources,
+    eg no more than 2 per datastore and 4 per host.
+    """
+
+    def __init__(self, limits):
+        """
+        limits - {kind: most tasks at once}, eg {'datastore': 2, 'host': 4}.
+                 A limit of 0 or less means no limit for that kind.
+        """
+        self.limits = limits
+        self.keys = {}
+        self.running = {}
+
+    def set_keys(self, name, keys):
+        """
+        Say which resources the task for name uses
+
+        name - the item name, as given to run_tasks
+        keys - list of (kind, id), eg [('datastore', 'datastore-12')]
+        """
+        self.keys[name] = [key for key in keys
+                           if self.limits.get(key[0], 0) > 0]
+
+    def allows(self, name):
+        """
+        True if the task for name can be started without going over a limit
+        """
+        return all(self.running.get(key, 0) < self.limits[key[0]]
+                   for key in self.keys.get(name, []))
+
+    def acquire(self, name):
+        """
+        Count the task for name as running
+        """
+        for key in self.keys.get(name, []):
+            self.running[key] = self.running.get(key, 0) + 1
+
+    def release(self, name):
+        """
+        Count the task for name as finished
+        """
+        for key in self.keys.get(name, []):
+            self.running[key] -= 1
+
+
+def run_tasks(start, items, parallel=1, report=None, collector=None,
+              throttle=None):
+    """
+    Start a task per object, keeping up to parallel of them running at
+    once, and waiting on all of the running ones together.
+
+    An exception or failed task for one object doesn't stop the others - it
+    is handed back as that object's result instead.
+
+    start - function taking one object and returning the task it started,
+            or None if there was nothing to wait for
+    items - list of (name, object) pairs
+    parallel - how many tasks to have running at once
+    report - optional function(name, error) called as each one finishes,
+             error being None on success
+    collector - PropertyCollector to use, found from the tasks if not given
+    throttle - optional Throttle; objects whose resources are at their limit
+               are passed over until a running task on them finishes
+
+    return - {name: None on success, or the exception/task error}, in the
+             order of items
+    """
+    results = dict((name, None) for name, _ in items)
+    queue = list(items)
+    waiter = None
+
+    def finish(name, error):
+        results[name] = error
+        if report is not None:
+            report(name, error)
+
+    def running():
+        if waiter is None:
+            return 0
+        return len(waiter.pending)
+
+    try:
+        while queue or running():
+            waiting = []
+            for name, obj in queue:
+                if running() >= max(1, parallel) or \
+                        (throttle is not None and not throttle.allows(name)):
+                    waiting.append((name, obj))
+                    continue
+                try:
+                    task = start(obj)
+                except Exception as error:  # pylint: disable=broad-except
+                    finish(name, error)
+                    continue
+                if task is None:
+                    finish(name, None)
+                    continue
+                if waiter is None:
+                    waiter = TaskWaiter(collector or task_collector(task))
+                waiter.add(task, name)
+                if throttle is not None:
+                    throttle.acquire(name)
+            queue = waiting
+            if not running():
+                if queue:
+                    raise Exception("Nothing can be started within the "
+                                    "throttle limits")
+                break
+            for key, error in waiter.wait():
+                if throttle is not None:
+                    throttle.release(key)
+                finish(key, error)
+    finally:
+        if waiter is not None:
+            waiter.close()
+    return results
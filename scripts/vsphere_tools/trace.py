@@ -0,0 +1,262 @@
+"""
+    Tracing the SOAP calls made to the vCenter, for the scripts' --profile
+
+    Every round trip pyVmomi makes goes through SoapStubAdapter.InvokeMethod,
+    including the hidden ones: reading a property of a managed object that
+    wasn't fetched up front, eg vm_obj.runtime.host, is a Fetch call of its
+    own.  While a CallTracer is running, InvokeMethod (and the request
+    serializer and response parser, for the sizes) are wrapped, and each
+    call is counted by method, by managed object type and by the function
+    that made it - the innermost vsphere_tools function on the stack, or
+    failing that the script code - with its time and request and response
+    bytes.
+
+    The wrapping is of the class, so every connection is traced, from any
+    thread.  Tracers can overlap, eg for two commands run by daemon.py at
+    once, and each then sees the other's calls too.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pyvim
+import pyVmomi
+from pyVmomi import SoapAdapter
+
+# calls made from in here are put down to the function that called them
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+# frames in these are never who made a call
+SKIP_DIRS = tuple(os.path.dirname(os.path.abspath(module.__file__)) +
+                  os.path.sep for module in (pyVmomi, pyvim))
+THIS_FILE = os.path.abspath(__file__)
+
+# the tracers running, and the originals of what they wrap, guarded by
+# _LOCK
+_TRACERS = []
+_ORIGINALS = {}
+_LOCK = threading.Lock()
+# the sizes of the call in progress on each thread
+_CURRENT = threading.local()
+
+
+class CallStats(object):
+    """
+    The totals for one method, type or caller
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sent = 0
+        self.received = 0
+
+    def add(self, seconds, sent, received):
+        """
+        Count one call
+
+        seconds - how long it took
+        sent, received - the request and response bytes
+        """
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.sent += sent
+        self.received += received
+
+
+class CountingReader(object):
+    """
+    Wraps the response stream, counting the bytes the parser reads
+    """
+
+    def __init__(self, stream, sizes):
+        self.stream = stream
+        self.sizes = sizes
+
+    def read(self, *args):
+        """
+        Read from the stream, adding up what came back
+        """
+        data = self.stream.read(*args)
+        self.sizes['received'] += len(data)
+        return data
+
+
+def method_name(info, args):
+    """
+    The name a call is counted under: the WSDL method name, with the
+    property for a Fetch, eg Fetch(runtime)
+    """
+    if info.wsdlName == 'Fetch' and args:
+        return 'Fetch(%s)' % args[0]
+    return info.wsdlName
+
+
+def caller_name(frame):
+    """
+    Who made a call: the innermost vsphere_tools function on the stack, eg
+    vsphere_tools.find_hosts or vsphere_tools.inventory.collect_properties,
+    otherwise the innermost function outside pyVmomi, eg power.run
+
+    frame - the frame to start looking from
+    """
+    fallback = None
+    while frame is not None:
+        path = os.path.abspath(frame.f_code.co_filename)
+        module = os.path.splitext(os.path.basename(path))[0]
+        if path == THIS_FILE or path.startswith(SKIP_DIRS):
+            pass
+        elif os.path.dirname(path) == TOOLS_DIR:
+            if module == '__init__':
+                return 'vsphere_tools.' + frame.f_code.co_name
+            return 'vsphere_tools.%s.%s' % (module, frame.f_code.co_name)
+        elif fallback is None:
+            fallback = '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return fallback or '?'
+
+
+def _invoke_method(stub, mo, info, args, outerStub=None):
+    # pylint: disable=invalid-name
+    sizes = {'sent': 0, 'received': 0}
+    outer = getattr(_CURRENT, 'sizes', None)
+    _CURRENT.sizes = sizes
+    start = time.monotonic()
+    try:
+        return _ORIGINALS['InvokeMethod'](stub, mo, info, args, outerStub)
+    finally:
+        seconds = time.monotonic() - start
+        _CURRENT.sizes = outer
+        with _LOCK:
+            tracers = list(_TRACERS)
+        if tracers:
+            call = (method_name(info, args), type(mo).__name__,
+                    caller_name(sys._getframe(1)))  # pylint: disable=W0212
+            for tracer in tracers:
+                tracer.record(call, seconds, sizes['sent'],
+                              sizes['received'])
+
+
+def _serialize_request(stub, mo, info, args):
+    request = _ORIGINALS['SerializeRequest'](stub, mo, info, args)
+    sizes = getattr(_CURRENT, 'sizes', None)
+    if sizes is not None:
+        sizes['sent'] += len(request)
+    return request
+
+
+def _deserialize(parser, response, *args, **kwargs):
+    sizes = getattr(_CURRENT, 'sizes', None)
+    if sizes is not None:
+        if isinstance(response, (bytes, str)):
+            sizes['received'] += len(response)
+        else:
+            response = CountingReader(response, sizes)
+    return _ORIGINALS['Deserialize'](parser, response, *args, **kwargs)
+
+
+# what's wrapped: name: (class, wrapper)
+_WRAPPERS = {
+    'InvokeMethod': (SoapAdapter.SoapStubAdapter, _invoke_method),
+    'SerializeRequest': (SoapAdapter.SoapStubAdapterBase,
+                         _serialize_request),
+    'Deserialize': (SoapAdapter.SoapResponseDeserializer, _deserialize),
+}
+
+
+class CallTracer(object):
+    """
+    Counts the SOAP calls made while it's running, by method, managed
+    object type and caller.  Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_method = {}
+        self.by_type = {}
+        self.by_caller = {}
+        self.total = CallStats()
+        self.started = None
+        self.seconds = 0.0
+
+    def start(self):
+        """
+        Start tracing, wrapping pyVmomi if nothing else already has
+        """
+        with _LOCK:
+            if self in _TRACERS:
+                raise Exception("The tracer is already running")
+            if not _TRACERS:
+                for name, (cls, wrapper) in _WRAPPERS.items():
+                    _ORIGINALS[name] = getattr(cls, name)
+                    setattr(cls, name, wrapper)
+            _TRACERS.append(self)
+        self.started = time.monotonic()
+
+    def stop(self):
+        """
+        Stop tracing, putting pyVmomi back once the last tracer stops
+        """
+        with _LOCK:
+            if self not in _TRACERS:
+                return
+            _TRACERS.remove(self)
+            if not _TRACERS:
+                for name, (cls, _) in _WRAPPERS.items():
+                    setattr(cls, name, _ORIGINALS.pop(name))
+        self.seconds += time.monotonic() - self.started
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, call, seconds, sent=0, received=0):
+        """
+        Count one call
+
+        call - (method name, managed object type, caller)
+        seconds - how long it took
+        sent, received - the request and response bytes
+        """
+        method, mo_type, caller = call
+        with self.lock:
+            for table, key in ((self.by_method, method),
+                               (self.by_type, mo_type),
+                               (self.by_caller, caller)):
+                table.setdefault(key, CallStats()).add(seconds, sent,
+                                                       received)
+            self.total.add(seconds, sent, received)
+
+    def summary(self, top=None):
+        """
+        The report --profile prints
+
+        top - how many of the slowest to list in each table, default all
+        return - the lines of text
+        """
+        with self.lock:
+            lines = ["%d SOAP calls in %.3fs of %.3fs, %d bytes sent, "
+                     "%d received" % (self.total.calls, self.total.seconds,
+                                      self.seconds, self.total.sent,
+                                      self.total.received)]
+            for title, table in (('method', self.by_method),
+                                 ('type', self.by_type),
+                                 ('caller', self.by_caller)):
+                lines.append('')
+                lines.append("%-48s %6s %9s %9s %10s %10s" % (
+                    'by ' + title, 'calls', 'total s', 'max s', 'sent',
+                    'received'))
+                ordered = sorted(table.items(),
+                                 key=lambda item: (-item[1].seconds,
+                                                   item[0]))
+                for key, stats in ordered[:top]:
+                    lines.append("%-48s %6d %9.3f %9.3f %10d %10d" % (
+                        key, stats.calls, stats.seconds, stats.max_seconds,
+                        stats.sent, stats.received))
+        return lines
@@ -0,0 +1,173 @@
+"""
+    Buffered row writers for the vsphere-tools scripts
+
+    Rows are handed over one at a time as they're collected, buffered, and
+    written out a batch at a time, so output keeps up with a big inventory
+    without everything being held in memory first.  All of them are safe to
+    write to from several threads.
+
+    pyarrow is only needed (and only imported) for Parquet output.
+"""
+
+import abc
+import csv
+import json
+import sys
+import threading
+
+# rows buffered before being written out
+BATCH_SIZE = 1000
+
+
+class RowWriter(abc.ABC):
+    """
+    Base class for the writers - buffers rows and writes them in batches
+    """
+    binary = False
+
+    def __init__(self, output, columns, batch_size=BATCH_SIZE):
+        """
+        output - a file name, or '-' for stdout
+        columns - the names of the columns, in order
+        batch_size - rows to buffer before writing them out
+        """
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.rows = []
+        self.lock = threading.Lock()
+        if output == '-':
+            self.stream = sys.stdout.buffer if self.binary else sys.stdout
+            self.close_stream = False
+        else:
+            self.stream = open(output, 'wb' if self.binary else 'w',
+                               **({} if self.binary else {'newline': ''}))
+            self.close_stream = True
+
+    def write(self, row):
+        """
+        Add a row
+
+        row - {column: value}; missing columns are left empty
+        """
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """
+        Write out any buffered rows
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+        self.stream.flush()
+
+    @abc.abstractmethod
+    def write_rows(self, rows):
+        """
+        Write out a batch of rows - implemented by each format
+        """
+
+    def close(self):
+        """
+        Write out what's left and finish the output
+        """
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+class CSVWriter(RowWriter):
+    """
+    CSV, with a header row
+    """
+
+    def __init__(self, output, columns, batch_size=BATCH_SIZE):
+        RowWriter.__init__(self, output, columns, batch_size)
+        self.writer = csv.DictWriter(self.stream, self.columns,
+                                     extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+
+class JSONLinesWriter(RowWriter):
+    """
+    One JSON object per line
+    """
+
+    def write_rows(self, rows):
+        self.stream.write(''.join(
+            json.dumps(dict((column, row.get(column))
+                            for column in self.columns)) + '\n'
+            for row in rows))
+
+
+class ParquetWriter(RowWriter):
+    """
+    Apache Parquet, one row group per batch
+    """
+    binary = True
+
+    def __init__(self, output, columns, batch_size=BATCH_SIZE, types=None):
+        """
+        types - optional {column: pyarrow type name, eg 'int64'}; columns
+                not given are typed from the first batch written
+        """
+        try:
+            import pyarrow  # pylint: disable=import-outside-toplevel
+            import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            raise Exception("Parquet output needs pyarrow installed")
+        if output == '-':
+            raise Exception("Parquet output needs a file to write to")
+        RowWriter.__init__(self, output, columns, batch_size)
+        self.pyarrow = pyarrow
+        self.types = types or {}
+        self.writer = None
+
+    def write_rows(self, rows):
+        table = self.pyarrow.table(dict(
+            (column, self.pyarrow.array(
+                [row.get(column) for row in rows],
+                type=self.pyarrow.type_for_alias(self.types[column])
+                if column in self.types else None))
+            for column in self.columns))
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.stream,
+                                                             table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.close_stream:
+            self.stream.close()
+
+
+WRITERS = {'csv': CSVWriter, 'jsonl': JSONLinesWriter,
+           'parquet': ParquetWriter}
+
+
+def get_writer(output_format, output, columns, types=None,
+               batch_size=BATCH_SIZE):
+    """
+    Make a writer
+
+    output_format - one of WRITERS, eg 'csv'
+    output - a file name, or '-' for stdout
+    columns - the names of the columns, in order
+    types - optional {column: pyarrow type name}, for typed formats
+    """
+    if output_format not in WRITERS:
+        raise Exception("Unknown output format " + output_format)
+    if output_format == 'parquet':
+        return ParquetWriter(output, columns, batch_size, types)
+    return WRITERS[output_format](output, columns, batch_size)
@@ -0,0 +1,32 @@
+"""
+    Fakes shared by the tests
+"""
+
+from unittest import mock
+
+
+def make_update(version, updates, filter_moid=None, truncated=False):
+    """
+        Build a fake WaitForUpdatesEx result from (kind, obj, [(name, op,
+        val)]) updates on one filter
+    """
+    update_set = mock.MagicMock()
+    update_set.version = version
+    update_set.truncated = truncated
+    filter_update = mock.MagicMock()
+    filter_update.filter._moId = filter_moid
+    filter_update.objectSet = []
+    for kind, obj, changes in updates:
+        obj_update = mock.MagicMock()
+        obj_update.kind = kind
+        obj_update.obj = obj
+        obj_update.changeSet = []
+        for name, op, val in changes:
+            change = mock.MagicMock()
+            change.name = name
+            change.op = op
+            change.val = val
+            obj_update.changeSet.append(change)
+        filter_update.objectSet.append(obj_update)
+    update_set.filterSet = [filter_update]
+    return update_set
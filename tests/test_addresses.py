@@ -0,0 +1,104 @@
+#!/usr/local/bin/python
+"""
+    testing the IP address and DNS name index
+"""
+# pylint: disable=no-self-use
+
+import unittest
+from unittest import mock
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+from scripts.vsphere_tools import addresses
+
+
+def nics(*ips):
+    """
+        guest.net for a VM with one NIC per list of IPs
+    """
+    return [vim.vm.GuestInfo.NicInfo(ipAddress=list(nic_ips))
+            for nic_ips in ips]
+
+
+class AddressIndexTestCase(unittest.TestCase):
+    """
+        unittests for AddressIndex
+    """
+
+    def setUp(self):
+        self.vm1 = vim.VirtualMachine('vm-1')
+        self.vm2 = vim.VirtualMachine('vm-2')
+        self.host = vim.HostSystem('host-1')
+        patcher = mock.patch('scripts.vsphere_tools.addresses.'
+                             'PropertyFollower')
+        self.follower = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('scripts.vsphere_tools.addresses.view_filter')
+        self.view_filter = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.follower.wait.side_effect = [[
+            ('addresses', 'enter', self.vm1, {
+                'name': 'web01', 'guest.hostName': 'Web01.example.com.',
+                'guest.ipAddress': '10.0.0.1',
+                'guest.net': nics(['10.0.0.1', 'fe80::1'],
+                                  ['2001:DB8::0:1'])}),
+            ('addresses', 'enter', self.vm2, {
+                'name': 'web02', 'guest.hostName': 'web02.example.com',
+                'guest.ipAddress': '10.0.0.2',
+                'guest.net': nics(['10.0.0.2'])}),
+            ('addresses', 'enter', self.host, {
+                'name': 'esx1.example.com'})]]
+        self.content = mock.MagicMock()
+        self.index = addresses.AddressIndex(self.content)
+
+    def test_lookups(self):
+        """
+            Verify one wait indexes every guest address and name, and the
+            host names, ignoring link local addresses
+        """
+        self.follower.wait.assert_called_once_with(None)
+        view = self.content.viewManager.CreateContainerView.return_value
+        self.view_filter.assert_called_once_with(
+            view, {vim.VirtualMachine: addresses.VM_PATHS,
+                   vim.HostSystem: addresses.HOST_PATHS})
+        self.follower.add_filter.assert_called_once_with(
+            self.view_filter.return_value, 'addresses')
+        self.assertEqual(self.index.find_ip('10.0.0.1'), [self.vm1])
+        self.assertEqual(self.index.find_ip('2001:db8::1'), [self.vm1])
+        self.assertEqual(self.index.find_ip('fe80::1'), [])
+        self.assertEqual(self.index.find_name('web01.EXAMPLE.com'),
+                         [self.vm1])
+        self.assertEqual(self.index.find_name('esx1.example.com',
+                                              [vim.HostSystem]), [self.host])
+        self.assertEqual(self.index.find_name('esx1.example.com',
+                                              [vim.VirtualMachine]), [])
+        self.assertEqual(self.index.name_of(self.vm2), 'web02')
+        self.assertEqual(self.index.collisions(), {})
+        self.index.close()
+        self.follower.close.assert_called_once()
+        view.DestroyView.assert_called_once()
+
+    def test_updates(self):
+        """
+            Verify changes move a VM's entries, a duplicate IP is a
+            collision, and a VM that leaves is dropped
+        """
+        self.follower.wait.side_effect = [
+            [('addresses', 'modify', self.vm2, {
+                'guest.ipAddress': '10.0.0.1',
+                'guest.net': nics(['10.0.0.1'])})],
+            [('addresses', 'leave', self.vm1, {})]]
+        self.assertEqual(self.index.update(), 1)
+        self.follower.wait.assert_called_with(0)
+        self.assertEqual(self.index.find_ip('10.0.0.2'), [])
+        self.assertEqual(sorted(self.index.find_ip('10.0.0.1'), key=str),
+                         [self.vm1, self.vm2])
+        self.assertEqual(list(self.index.collisions()), ['10.0.0.1'])
+        self.assertEqual(self.index.find_name('web02.example.com'),
+                         [self.vm2])
+        self.index.update()
+        self.assertEqual(self.index.find_ip('10.0.0.1'), [self.vm2])
+        self.assertEqual(self.index.find_name('web01.example.com'), [])
+        self.assertEqual(self.index.collisions(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
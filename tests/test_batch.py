@@ -0,0 +1,57 @@
+#!/usr/local/bin/python
+"""
+    testing running operations across many VMs at once
+"""
+# pylint: disable=no-self-use
+
+import threading
+import time
+import unittest
+from scripts.vsphere_tools import run_parallel
+
+
+class ParallelTestCase(unittest.TestCase):
+    """
+        unittests for run_parallel
+    """
+
+    def test_failures_isolated(self):
+        """
+            One failure is reported, and doesn't stop the others
+        """
+        done = []
+
+        def operation(obj):
+            if obj == 'bad':
+                raise Exception('bad VM')
+            done.append(obj)
+
+        reports = []
+        results = run_parallel(operation, [('vm1', 'ok'), ('vm2', 'bad'),
+                                           ('vm3', 'ok')], 2,
+                               lambda name, error: reports.append(name))
+        self.assertEqual(list(results), ['vm1', 'vm2', 'vm3'])
+        self.assertIsNone(results['vm1'])
+        self.assertEqual(str(results['vm2']), 'bad VM')
+        self.assertIsNone(results['vm3'])
+        self.assertEqual(len(done), 2)
+        self.assertEqual(sorted(reports), ['vm1', 'vm2', 'vm3'])
+
+    def test_parallel_limit(self):
+        """
+            No more than parallel operations run at once
+        """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def operation(obj):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run_parallel(operation, [('vm%d' % i, i) for i in range(12)], 3)
+        self.assertLessEqual(running[1], 3)
+        self.assertGreater(running[1], 1)
@@ -0,0 +1,160 @@
+#!/usr/local/bin/python
+"""
+    testing the shared script start up
+"""
+# pylint: disable=unused-argument
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from scripts import bootstrap
+
+INI = """
+[DC-EXAMPLE]
+SERVER=vc1.example.com
+USERNAME=gerbil@example.com
+
+[DC-EMPTY]
+USERNAME=nobody@example.com
+"""
+
+
+class BootstrapTestCase(unittest.TestCase):
+    """
+        unittests for bootstrap
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.configfile = os.path.join(self.tmpdir.name, 'vsphere-tools.ini')
+        with open(self.configfile, 'w') as ini_file:
+            ini_file.write(INI)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_args(self, **kwargs):
+        """
+            args as the scripts would parse them
+        """
+        values = {'vc': 'NONE', 'dc': 'NONE', 'user': None,
+                  'password': 'secret', 'port': 443,
+                  'configfile': self.configfile, 'reuse_session': False}
+        values.update(kwargs)
+        return argparse.Namespace(**values)
+
+    def test_lazy_import(self):
+        """
+            Verify the module isn't run until an attribute is used
+        """
+        with open(os.path.join(self.tmpdir.name, 'lazy_probe.py'),
+                  'w') as module_file:
+            module_file.write("import sys\nsys.lazy_probe_loaded = True\n"
+                              "VALUE = 42\n")
+        sys.path.insert(0, self.tmpdir.name)
+        try:
+            module = bootstrap.lazy_import('lazy_probe')
+            self.assertFalse(getattr(sys, 'lazy_probe_loaded', False))
+            self.assertEqual(module.VALUE, 42)
+            self.assertTrue(sys.lazy_probe_loaded)
+            self.assertIs(bootstrap.lazy_import('lazy_probe'), module)
+        finally:
+            sys.path.remove(self.tmpdir.name)
+            sys.modules.pop('lazy_probe', None)
+            del sys.lazy_probe_loaded
+        self.assertRaises(ImportError, bootstrap.lazy_import,
+                          'no_such_module_here')
+
+    def test_read_config(self):
+        """
+            Verify the server and user come from the DC section only when
+            no VC was given
+        """
+        args = bootstrap.read_config(self.make_args(dc='example'))
+        self.assertEqual((args.vc, args.user),
+                         ('vc1.example.com', 'gerbil@example.com'))
+        args = bootstrap.read_config(self.make_args(vc='vc2', user='me',
+                                                    dc='example'))
+        self.assertEqual((args.vc, args.user), ('vc2', 'me'))
+        self.assertRaises(Exception, bootstrap.read_config,
+                          self.make_args())
+        self.assertRaises(Exception, bootstrap.read_config,
+                          self.make_args(dc='empty'))
+        self.assertRaises(Exception, bootstrap.read_config,
+                          self.make_args(dc='missing'))
+
+    def test_config_targets(self):
+        """
+            Verify every DC is a target once per server and user
+        """
+        with open(self.configfile, 'w') as ini_file:
+            ini_file.write("[DC-ONE]\nSERVER=vc1.example.com\n"
+                           "USERNAME=gerbil@example.com\n\n"
+                           "[DC-TWO]\nSERVER=vc1.example.com\n"
+                           "USERNAME=gerbil@example.com\n\n"
+                           "[DC-THREE]\nSERVER=vc2.example.com\n"
+                           "USERNAME=hamster@example.com\n\n"
+                           "[OTHER]\nSERVER=vc3.example.com\n")
+        self.assertEqual(bootstrap.config_targets(self.configfile), [
+            ('vc1.example.com', 'gerbil@example.com', 'DC-ONE'),
+            ('vc2.example.com', 'hamster@example.com', 'DC-THREE')])
+        self.assertEqual(bootstrap.config_targets(self.configfile,
+                                                  ['three']), [
+            ('vc2.example.com', 'hamster@example.com', 'DC-THREE')])
+        self.assertRaises(Exception, bootstrap.config_targets,
+                          self.configfile, ['missing'])
+
+    @mock.patch('scripts.vsphere_tools.connect_vc')
+    def test_connect(self, mock_connect):
+        """
+            Verify connect works out the server, then connects
+        """
+        result = bootstrap.connect(self.make_args(dc='example', port=4443,
+                                                  reuse_session=True))
+        self.assertEqual(result, mock_connect.return_value)
+        mock_connect.assert_called_once_with(
+            'vc1.example.com', 'gerbil@example.com', 'secret', 4443, True)
+
+    def test_read_vm_list(self):
+        """
+            Verify VM lists are parsed, with per-VM settings, and mistakes
+            are reported by line
+        """
+        params = {'operation': ('operation', bootstrap.choice('on', 'off')),
+                  'force': ('hardware', bootstrap.flag)}
+        vm_list = io.StringIO("# maintenance\nvm1\n\n'vm 2' operation=off "
+                              "force=yes  # db\nvm3 force=no\n")
+        self.assertEqual(bootstrap.read_vm_list('-', params, vm_list), [
+            ('vm1', {}), ('vm 2', {'operation': 'off', 'hardware': True}),
+            ('vm3', {'hardware': False})])
+        for text in ["vm1\nvm1\n", "vm1 operation=sideways\n",
+                     "vm1 color=red\n", "vm1 force\n", "'vm1\n"]:
+            self.assertRaises(Exception, bootstrap.read_vm_list, '-', params,
+                              io.StringIO(text))
+        args = bootstrap.vm_args(self.make_args(), {'dc': 'other'})
+        self.assertEqual((args.dc, args.password), ('other', 'secret'))
+
+    def test_profiling(self):
+        """
+            Verify --profile traces the block and prints the reports, and
+            does nothing without it
+        """
+        parser = argparse.ArgumentParser()
+        bootstrap.add_profile_args(parser)
+        with bootstrap.profiling(parser.parse_args([])) as tracer:
+            self.assertIsNone(tracer)
+        args = parser.parse_args(['--profile', '--profile-python', '5',
+                                  '--profile-memory', '3'])
+        report = io.StringIO()
+        with bootstrap.profiling(args, report) as tracer:
+            tracer.record(('Fetch(runtime)', 'vim.VirtualMachine',
+                           'power.run'), 0.5)
+        lines = report.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("1 SOAP calls in 0.500s"))
+        self.assertIn('Fetch(runtime)', lines[3])
+        self.assertIn('Ordered by: cumulative time', report.getvalue())
+        self.assertIn('memory still allocated, by line', lines)
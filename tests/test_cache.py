@@ -0,0 +1,155 @@
+#!/usr/local/bin/python
+"""
+    testing the on-disk inventory cache
+"""
+# pylint: disable=unused-argument
+# pylint: disable=no-self-use
+# pylint: disable=protected-access
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+from scripts.vsphere_tools import cache
+from tests.helpers import make_update
+
+
+class CacheTestCase(unittest.TestCase):
+    """
+        unittests for InventoryCache
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.si_obj = mock.MagicMock()
+        self.content = self.si_obj.RetrieveContent.return_value
+        self.content.about.instanceUuid = 'vc-uuid'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_cache(self, entries, collector='session[1]pc'):
+        """
+            Put a cache file in place, as a previous run would have
+        """
+        with open(os.path.join(self.tmpdir.name, 'DC-TEST.json'),
+                  'w') as cache_file:
+            json.dump({'server': 'vc-uuid', 'collector': collector,
+                       'version': '1', 'entries': entries}, cache_file)
+
+    def test_cache_section(self):
+        """
+            Verify DC names map onto their ini section
+        """
+        self.assertEqual(cache.cache_section('mdc1', 'vc1'), 'DC-MDC1')
+        self.assertEqual(cache.cache_section('NONE', 'vc1'), 'vc1')
+
+    def test_write_json(self):
+        """
+            Verify the file is replaced through a temporary file of its
+            own, which isn't left behind if the write fails
+        """
+        path = os.path.join(self.tmpdir.name, 'sub', 'DC-TEST.json')
+        with mock.patch('os.replace', wraps=os.replace) as mock_replace:
+            cache.write_json(path, {'version': '1'})
+            cache.write_json(path, {'version': '2'})
+        tmp_paths = [call[0][0] for call in mock_replace.call_args_list]
+        self.assertNotEqual(tmp_paths[0], tmp_paths[1])
+        self.assertEqual(os.path.dirname(tmp_paths[0]),
+                         os.path.dirname(path))
+        with open(path) as cache_file:
+            self.assertEqual(json.load(cache_file), {'version': '2'})
+        self.assertRaises(TypeError, cache.write_json, path, {'x': object()})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['DC-TEST.json'])
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_cold_rebuild(self, mock_pc):
+        """
+            With no cache file, the cache is built and saved
+        """
+        collector = self.content.propertyCollector.CreatePropertyCollector.\
+            return_value
+        collector._moId = 'session[1]pc'
+        collector.WaitForUpdatesEx.return_value = make_update(
+            '2', [('enter', vim.VirtualMachine('vm-1'),
+                   [('name', 'assign', 'one')]),
+                  ('enter', vim.VirtualMachine('vm-2'),
+                   [('name', 'assign', 'two')])])
+        inv = cache.InventoryCache(self.si_obj, 'DC-TEST',
+                                   cache_dir=self.tmpdir.name)
+        found, missing = inv.resolve(['one', 'three'])
+        self.assertEqual(list(found), ['one'])
+        self.assertEqual(missing, ['three'])
+        with open(inv.path) as cache_file:
+            data = json.load(cache_file)
+        self.assertEqual(data['version'], '2')
+        self.assertEqual(data['collector'], 'session[1]pc')
+        self.assertEqual(len(data['entries']), 2)
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_warm_incremental(self, mock_pc):
+        """
+            With a live collector, only the changes are fetched and no
+            inventory scan happens, and the file is only rewritten when
+            something has changed
+        """
+        self.write_cache({'vm-1': ['VirtualMachine', 'one'],
+                          'vm-2': ['VirtualMachine', 'two']})
+        mock_pc.return_value.WaitForUpdatesEx.return_value = make_update(
+            '2', [('leave', vim.VirtualMachine('vm-2'), []),
+                  ('enter', vim.VirtualMachine('vm-3'),
+                   [('name', 'assign', 'three')])])
+        inv = cache.InventoryCache(self.si_obj, 'DC-TEST',
+                                   cache_dir=self.tmpdir.name)
+        found, missing = inv.resolve(['one', 'two', 'three'])
+        self.assertEqual(sorted(found), ['one', 'three'])
+        self.assertEqual(missing, ['two'])
+        mock_pc.return_value.WaitForUpdatesEx.assert_called_once()
+        self.content.viewManager.CreateContainerView.assert_not_called()
+        mock_pc.return_value.WaitForUpdatesEx.return_value = None
+        with mock.patch.object(inv, 'save') as mock_save:
+            self.assertEqual(inv.resolve(['one'])[1], [])
+        mock_save.assert_not_called()
+
+    @mock.patch('scripts.vsphere_tools.cache.collect_object_properties')
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_warm_validated(self, mock_pc, mock_cop):
+        """
+            With the collector gone, cached MoRefs are checked in one call
+        """
+        self.write_cache({'vm-1': ['VirtualMachine', 'one']})
+        mock_pc.return_value.WaitForUpdatesEx.side_effect = \
+            vmodl.fault.ManagedObjectNotFound()
+        mock_cop.return_value = [(vim.VirtualMachine('vm-1'),
+                                  {'name': 'one'})]
+        inv = cache.InventoryCache(self.si_obj, 'DC-TEST',
+                                   cache_dir=self.tmpdir.name)
+        found, missing = inv.resolve(['one'])
+        self.assertEqual(list(found), ['one'])
+        self.assertEqual(missing, [])
+        mock_cop.assert_called_once()
+        self.content.viewManager.CreateContainerView.assert_not_called()
+
+    @mock.patch('scripts.vsphere_tools.cache.collect_object_properties')
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_stale_rebuild(self, mock_pc, mock_cop):
+        """
+            A cached MoRef that no longer exists causes a rebuild
+        """
+        self.write_cache({'vm-1': ['VirtualMachine', 'one']})
+        mock_pc.return_value.WaitForUpdatesEx.side_effect = \
+            vmodl.fault.ManagedObjectNotFound()
+        mock_cop.side_effect = vmodl.fault.ManagedObjectNotFound()
+        collector = self.content.propertyCollector.CreatePropertyCollector.\
+            return_value
+        collector._moId = 'session[2]pc'
+        collector.WaitForUpdatesEx.return_value = make_update(
+            '2', [('enter', vim.VirtualMachine('vm-9'),
+                   [('name', 'assign', 'one')])])
+        inv = cache.InventoryCache(self.si_obj, 'DC-TEST',
+                                   cache_dir=self.tmpdir.name)
+        found, _ = inv.resolve(['one'])
+        self.assertEqual(found['one']._moId, 'vm-9')
+        self.content.viewManager.CreateContainerView.assert_called_once()
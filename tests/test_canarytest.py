@@ -6,7 +6,12 @@
 # pylint: disable=unused-argument
 # pylint: disable=too-many-arguments
 
+import configparser
+import io
+import json
 import sys
+import tempfile
+import threading
 import unittest
 import os
 from pathlib import Path
@@ -14,6 +19,18 @@ from unittest import mock
 from pyVmomi import vim  # pylint: disable=no-name-in-module
 from scripts import canarytest
 from scripts.canarytest import *  # pylint: disable=unused-wildcard-import
+from scripts.vsphere_tools import session
+
+
+def resolve_to(vm_objs):
+    """
+    A resolve_vms that finds vm_objs, {name: vm object}
+    """
+    def resolve_vms(si_obj, names, section=None, cache=None):
+        return (dict((name, vm_objs[name]) for name in names
+                     if name in vm_objs),
+                [name for name in names if name not in vm_objs])
+    return resolve_vms
 
 
 class CanaryTestCase(unittest.TestCase):
@@ -42,7 +59,7 @@ class CanaryTestCase(unittest.TestCase):
             self.assertEqual(result.vc, 'vc1', "VC not set correctly")
             self.assertEqual(result.verbose, False,
                              "Verbosity not set correctly")
-            self.assertEqual(result.vmname, 'vmname',
+            self.assertEqual(result.vmname, ['vmname'],
                              "Canary VM not set correctly")
             self.assertEqual(result.waitbetween, True,
                              "Wait Between not set correctly")
@@ -77,62 +94,77 @@ class CanaryTestCase(unittest.TestCase):
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'ServiceInstance')
     @mock.patch.object(vim, 'VirtualMachine')
-    @mock.patch('scripts.canarytest.vsphere_tools.get_obj')
-    @mock.patch('scripts.canarytest.vsphere_tools.find_host')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
     @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
-    @mock.patch('scripts.canarytest.time.sleep')
-    def test_canary_test(self, mock_sleep, mock_vmotion,
-                         mock_fh, mock_go, mock_vm, mock_si, mock_hs):
+    def test_canary_test(self, mock_vmotion, mock_fh, mock_go, mock_vm,
+                         mock_si, mock_hs):
         """
-            Verify that canary calls cause vmotions to be called for
+            Verify that canary calls cause vmotions to be called for, and
+            canaries that can't be found stop the test before any move
         """
         test_si = vim.ServiceInstance()
         test_vm = vim.VirtualMachine()
-        mock_go.return_value = test_vm
+        mock_go.side_effect = resolve_to({'vmname': test_vm})
         host = vim.HostSystem()
         host.name = 'Foo'
-        mock_fh.return_value = host
+        mock_fh.side_effect = lambda si_obj, names: [host] * len(names)
         canary_test(test_si, ['host1', 'host2'], 'vmname', False)
-        test_si.RetrieveContent.assert_called_once()
+        mock_go.assert_called_once_with(test_si, ['vmname'], cache=None)
         self.assertEqual(mock_vmotion.call_count, 2,
                          "Two vmotions should occur")
+        with self.assertRaises(Exception) as context:
+            canary_test(test_si, ['host1', 'host2'], ['vmname', 'typo'],
+                        False)
+        self.assertEqual(str(context.exception),
+                         "Cannot find VMs named typo")
+        self.assertEqual(mock_vmotion.call_count, 2)
 
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'ServiceInstance')
     @mock.patch.object(vim, 'VirtualMachine')
-    @mock.patch('scripts.canarytest.vsphere_tools.get_obj')
-    @mock.patch('scripts.canarytest.vsphere_tools.find_host')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
     @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
-    @mock.patch('scripts.canarytest.time.sleep')
-    def test_canary_test_failure(self, mock_sleep, mock_vmotion, mock_fh,
+    @mock.patch('scripts.canarytest.vsphere_tools.ping')
+    def test_canary_test_failure(self, mock_ping, mock_vmotion, mock_fh,
                                  mock_go, mock_vm, mock_si, mock_hs):
         """
             Verify that if an exception occurs, that
-            a) the vmotion was asked for, and
-            b) an exception happens
+            a) the vmotion was asked for,
+            b) a canary that still answers goes on to the other hosts, and
+               one that doesn't stops, and
+            c) an exception happens at the end
         """
         test_si = vim.ServiceInstance()
         test_vm = vim.VirtualMachine()
-        mock_go.return_value = test_vm
+        mock_go.side_effect = resolve_to({'vmname': test_vm})
         host = vim.HostSystem()
         host.name = 'Foo'
-        mock_fh.return_value = host
+        mock_fh.side_effect = lambda si_obj, names: [host] * len(names)
         canarytest.vsphere_tools.do_a_vmotion.side_effect = Exception(
             'vmotion raised an exception Failed')
+        mock_ping.return_value = True
         with self.assertRaises(Exception):
             canary_test(test_si, ['host1', 'host2'], 'vmname', False)
-        test_si.RetrieveContent.assert_called_once()
+        mock_go.assert_called_once_with(test_si, ['vmname'], cache=None)
+        self.assertEqual(mock_vmotion.call_count, 2,
+                         "Both vmotions should be tried")
+        mock_vmotion.reset_mock()
+        mock_ping.return_value = False
+        with self.assertRaises(Exception) as context:
+            canary_test(test_si, ['host1', 'host2'], 'vmname', False)
         self.assertEqual(mock_vmotion.call_count, 1,
-                         "One vmotions should occur, raising the exception")
+                         "One vmotions should occur, losing the canary")
+        self.assertIn('not tested: Foo, Foo', str(context.exception))
 
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'ServiceInstance')
     @mock.patch.object(vim, 'VirtualMachine')
-    @mock.patch('scripts.canarytest.vsphere_tools.get_obj')
-    @mock.patch('scripts.canarytest.vsphere_tools.find_host')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
     @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
-    @mock.patch('scripts.canarytest.time.sleep')
-    def test_canary_test_ip(self, mock_sleep, mock_vmotion, mock_fh,
+    def test_canary_test_ip(self, mock_vmotion, mock_fh,
                             mock_go, mock_vm, mock_si, mock_hs):
         """
             Given a canary's IP, verify that vmotions get called for
@@ -141,24 +173,25 @@ class CanaryTestCase(unittest.TestCase):
         test_vm = vim.VirtualMachine()
         test_vm.guest.ipAddress = '192.168.0.1'
         test_vm.name = "Bob"
-        mock_go.return_value = test_vm
+        mock_go.side_effect = resolve_to({'vmname': test_vm})
         host = vim.HostSystem()
         host.name = 'Foo'
-        mock_fh.return_value = host
+        mock_fh.side_effect = lambda si_obj, names: [host] * len(names)
         canary_test(test_si, ['host1', 'host2'], 'vmname', False)
-        test_si.RetrieveContent.assert_called_once()
+        mock_go.assert_called_once_with(test_si, ['vmname'], cache=None)
         self.assertEqual(mock_vmotion.call_count, 2,
                          "Two vmotions should occur")
-        mock_vmotion.assert_called_with(test_vm, host, '192.168.0.1', False)
+        mock_vmotion.assert_called_with(test_vm, host, '192.168.0.1', False,
+                                        probe_options=None, monitor=None,
+                                        ready=None, timings=mock.ANY)
 
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'ServiceInstance')
     @mock.patch.object(vim, 'VirtualMachine')
-    @mock.patch('scripts.canarytest.vsphere_tools.get_obj')
-    @mock.patch('scripts.canarytest.vsphere_tools.find_host')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
     @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
-    @mock.patch('scripts.canarytest.time.sleep')
-    def test_canary_test_vmname(self, mock_sleep, mock_vmotion, mock_fh,
+    def test_canary_test_vmname(self, mock_vmotion, mock_fh,
                                 mock_go, mock_vm, mock_si, mock_hs):
         """
             Given a canary VM name, vmotions get called for.
@@ -167,18 +200,125 @@ class CanaryTestCase(unittest.TestCase):
         test_vm = vim.VirtualMachine()
         test_vm.guest.ipAddress = None
         test_vm.name = "Bob"
-        mock_go.return_value = test_vm
+        mock_go.side_effect = resolve_to({'Bob': test_vm})
         host = vim.HostSystem()
         host.name = 'Foo'
-        mock_fh.return_value = host
+        mock_fh.side_effect = lambda si_obj, names: [host] * len(names)
         canary_test(test_si, ['host1', 'host2'], test_vm.name, False)
-        test_si.RetrieveContent.assert_called_once()
+        mock_go.assert_called_once_with(test_si, ['Bob'], cache=None)
         self.assertEqual(mock_vmotion.call_count, 2,
                          "Two vmotions should occur")
-        mock_vmotion.assert_called_with(test_vm, host, test_vm.name, False)
+        mock_vmotion.assert_called_with(test_vm, host, test_vm.name, False,
+                                        probe_options=None, monitor=None,
+                                        ready=None, timings=mock.ANY)
 
-    @mock.patch('scripts.canarytest.getpass.getpass')
-    @mock.patch.object(connect, "Connect")
+    @mock.patch.object(vim, 'HostSystem')
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch.object(vim, 'VirtualMachine')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
+    @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
+    def test_canary_test_max_outage(self, mock_vmotion, mock_fh,
+                                    mock_go, mock_vm, mock_si, mock_hs):
+        """
+            With a monitor, each move's outage is returned, and one over
+            max_outage fails that host without stopping the test
+        """
+        test_si = vim.ServiceInstance()
+        host = vim.HostSystem()
+        host.name = 'Foo'
+        mock_fh.side_effect = lambda si_obj, names: [host] * len(names)
+        mock_go.side_effect = resolve_to({'vmname': mock.MagicMock()})
+        quick = mock.MagicMock()
+        quick.longest_outage.return_value = 0.2
+        slow = mock.MagicMock()
+        slow.longest_outage.return_value = 2.5
+        mock_vmotion.side_effect = [quick, quick]
+        writer = mock.MagicMock()
+        hops = canary_test(test_si, ['host1', 'host2'], 'vmname', False,
+                           monitor={'interval': 0.02}, max_outage=1.0,
+                           results=writer)
+        self.assertEqual(writer.write.call_count, 2)
+        self.assertEqual(writer.write.call_args[0][0]['outage_ms'], 200.0)
+        self.assertEqual(hops, [('Foo', 'vmname', quick, None),
+                                ('Foo', 'vmname', quick, None)])
+        self.assertEqual(mock_vmotion.call_args[1]['monitor'],
+                         {'interval': 0.02})
+        mock_vmotion.side_effect = [quick, slow, quick]
+        with self.assertRaises(Exception) as context:
+            canary_test(test_si, ['host1', 'host2', 'host3'], 'vmname',
+                        False, monitor={'interval': 0.02}, max_outage=1.0)
+        self.assertIn('2500 ms', str(context.exception))
+        self.assertEqual(mock_vmotion.call_count, 5)
+
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    @mock.patch('scripts.canarytest.vsphere_tools.ping')
+    def test_canary_test_parallel(self, mock_ping, mock_go, mock_fh):
+        """
+            Several canaries move at once: every host is visited, no host
+            takes more than max_incoming at a time, and a host that fails
+            doesn't stop the others
+        """
+        hosts = {}
+        for name in ['host%d' % number for number in range(6)]:
+            hosts[name] = mock.MagicMock()
+            hosts[name].name = name
+        mock_fh.side_effect = lambda si_obj, names: [hosts[name]
+                                                     for name in names]
+        canaries = {}
+        for name in ['c1', 'c2', 'c3']:
+            canaries[name] = mock.MagicMock()
+            canaries[name].guest.ipAddress = name
+            canaries[name].runtime.host = hosts['host0']
+        mock_go.side_effect = resolve_to(canaries)
+        mock_ping.return_value = True
+        lock = threading.Lock()
+        incoming = {}
+        most = []
+
+        def vmotion(vm_obj, host, pingaddr, verbose, **options):
+            with lock:
+                incoming[host.name] = incoming.get(host.name, 0) + 1
+                most.append(incoming[host.name])
+            threading.Event().wait(0.01)
+            with lock:
+                incoming[host.name] -= 1
+            if host.name == 'host3':
+                raise Exception('host3 is broken')
+            vm_obj.runtime.host = host
+
+        with mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion',
+                        side_effect=vmotion):
+            with self.assertRaises(Exception) as context:
+                canary_test(mock.MagicMock(), sorted(hosts),
+                            ['c1', 'c2', 'c3'], False)
+        self.assertIn('host3 (host3 is broken)', str(context.exception))
+        self.assertNotIn('not tested', str(context.exception))
+        self.assertEqual(max(most), 1)
+
+        scheduler = canarytest.CanaryScheduler(list(hosts.values()), 2)
+        for name in canaries:
+            scheduler.add_canary(name, hosts['host0'])
+        self.assertEqual(scheduler.next_host('c1'), hosts['host1'])
+        self.assertEqual(scheduler.next_host('c2'), hosts['host2'])
+        scheduler.finish('c1', hosts['host1'], tested=False)
+        self.assertEqual(scheduler.next_host('c3'), hosts['host1'])
+        scheduler.finish('c2', hosts['host2'])
+        scheduler.finish('c3', hosts['host1'], error=Exception('no'))
+        self.assertEqual([result[:2] for result in scheduler.results],
+                         [('host2', 'c2'), ('host1', 'c3')])
+        self.assertEqual(scheduler.locations,
+                         {'c1': hosts['host0'], 'c2': hosts['host2'],
+                          'c3': hosts['host0']})
+        # a move that got there but failed its checks still moved it
+        self.assertEqual(scheduler.next_host('c3'), hosts['host3'])
+        scheduler.finish('c3', hosts['host3'], error=Exception('slow'),
+                         moved=True)
+        self.assertEqual(scheduler.locations['c3'], hosts['host3'])
+
+    @mock.patch('scripts.vsphere_tools.session.getpass.getpass')
+    @mock.patch.object(session.connect, "Connect")
     @mock.patch.object(canarytest, 'canary_test')
     @mock.patch.object(configparser, 'ConfigParser')
     def test_canary_no_conf_main(self, mock_parse, mock_canary,
@@ -196,6 +336,11 @@ class CanaryTestCase(unittest.TestCase):
         with mock.patch.object(sys, 'argv', test_args):
             canarytest.main()
         mock_canary.assert_called_once()
+        self.assertEqual(mock_canary.call_args[0][4],
+                         {'method': 'auto', 'port': 22, 'count': 3,
+                          'timeout': 1.0})
+        self.assertEqual(mock_canary.call_args[0][8],
+                         {'settle': 2.0, 'timeout': 60.0})
         conn_args = repr(mock_connect.call_args)
         self.assertNotEqual(conn_args.find("user='testuser'"), -1,
                             "Testuser isn't in the config parameters")
@@ -203,3 +348,35 @@ class CanaryTestCase(unittest.TestCase):
                             "vc1 isn't in the config parameters")
         self.assertNotEqual(conn_args.find("pwd='password'"), -1,
                             "password isn't in the config parameters")
+        self.assertNotEqual(conn_args.find("port=4050"), -1,
+                            "port isn't in the config parameters")
+
+    def test_compare_main(self):
+        """
+            Verify --compare reads two results files without connecting,
+            and flags hosts that got slower
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, name) for name in ('old', 'new')]
+            for path, run_s in zip(paths, (8.0, 12.0)):
+                with open(path, 'w') as results:
+                    for host, timings in (('esx1', {'run_s': run_s}),
+                                          ('esx2', {'run_s': 5.0})):
+                        record = canarytest.vsphere_tools.hop_record(
+                            host, 'canary', timings)
+                        results.write(json.dumps(record) + '\n')
+            output = io.StringIO()
+            with mock.patch.object(sys, 'argv', ['prog', '--compare'] +
+                                   paths), \
+                    mock.patch('scripts.bootstrap.connect') as mock_connect, \
+                    mock.patch('sys.stdout', output):
+                canarytest.main()
+            mock_connect.assert_not_called()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('esx1'))
+        self.assertTrue(lines[1].endswith('+50% SLOWER'))
+        self.assertTrue(lines[2].endswith('+0%'))
+        with mock.patch.object(sys, 'argv', ['prog', '-v', 'canary']), \
+                mock.patch('sys.stderr', io.StringIO()):
+            self.assertRaises(SystemExit, get_args)
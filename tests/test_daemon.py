@@ -0,0 +1,231 @@
+#!/usr/local/bin/python
+"""
+    testing the daemon, and the scripts' --daemon client
+"""
+# pylint: disable=unused-argument
+
+import argparse
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from scripts import bootstrap
+from scripts import canarytest
+from scripts import daemon
+
+
+class FakeScript(object):
+    """
+        A script module, printing what it was asked to do
+    """
+
+    @staticmethod
+    def get_args(argv):
+        """
+            parse argv, like the scripts' get_args
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-s', dest='vc', default='NONE')
+        parser.add_argument('-u', dest='user')
+        parser.add_argument('-p', dest='password')
+        parser.add_argument('--dc', dest='dc', default='NONE')
+        parser.add_argument('action')
+        bootstrap.add_profile_args(parser)
+        args = parser.parse_args(argv)
+        args.port = 443
+        args.configfile = os.devnull
+        return args
+
+    @staticmethod
+    def run(args, si_obj, cache=None):
+        """
+            print, fail or exit depending on the action
+        """
+        if args.action == 'fail':
+            raise Exception("it broke")
+        if args.action == 'exit':
+            sys.exit(3)
+        found, _ = cache.resolve(['vm1'])
+        print("%s on %s" % (args.action, found['vm1']))
+
+
+class DaemonTestCase(unittest.TestCase):
+    """
+        unittests for the daemon
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'daemon.sock')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def serve(self, vsphere_daemon):
+        """
+            Run a server for vsphere_daemon in a thread until the test ends
+        """
+        server = daemon.Server(self.socket_path, vsphere_daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        previous = daemon.install_output()
+        self.addCleanup(setattr, sys, 'stderr', previous[1])
+        self.addCleanup(setattr, sys, 'stdout', previous[0])
+        return server
+
+    def forward(self, argv, script='fake'):
+        """
+            Send a command the way the scripts do.  What the daemon prints
+            to its own stdout and stderr meanwhile is left in self.leaked.
+            return - (exit status, stdout, stderr)
+        """
+        client = mock.Mock(stdout=io.StringIO(), stderr=io.StringIO())
+        self.leaked = io.StringIO()
+        with mock.patch.object(sys.stdout, 'default', self.leaked), \
+                mock.patch.object(sys.stderr, 'default', self.leaked), \
+                mock.patch('scripts.bootstrap.sys', client):
+            status = bootstrap.forward(script, argv, self.socket_path)
+        return (status, client.stdout.getvalue(),
+                client.stderr.getvalue())
+
+    def test_forward(self):
+        """
+            Verify commands run in the daemon with its warm target, and
+            output, errors, --profile reports and exit status come back to
+            the client
+        """
+        vsphere_daemon = daemon.Daemon({'fake': FakeScript})
+        target = mock.MagicMock()
+        target.resolve.return_value = ({'vm1': 'vm-42'}, [])
+        vsphere_daemon.targets[('vc1', 'me', 443)] = target
+        self.serve(vsphere_daemon)
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+        self.assertEqual(self.forward(['-s', 'vc1', '-u', 'me', 'reboot']),
+                         (0, 'reboot on vm-42\n', ''))
+        status, stdout, stderr = self.forward(['-s', 'vc1', '-u', 'me',
+                                               '--profile', 'reboot'])
+        self.assertEqual((status, stdout), (0, 'reboot on vm-42\n'))
+        self.assertTrue(stderr.startswith('0 SOAP calls in '))
+        status, stdout, stderr = self.forward(['-s', 'vc1', '-u', 'me',
+                                               'fail'])
+        self.assertEqual((status, stdout), (1, ''))
+        self.assertIn('Exception: it broke', stderr)
+        self.assertEqual(self.forward(['-s', 'vc1', '-u', 'me', 'exit'])[0],
+                         3)
+        # argparse errors, and VCs the daemon isn't logged in to
+        self.assertEqual(self.forward([])[0], 2)
+        status, _, stderr = self.forward(['-s', 'vc9', '-u', 'me', 'x'])
+        self.assertEqual(status, 1)
+        self.assertIn('no session for me@vc9:443', stderr)
+        self.assertEqual(self.leaked.getvalue(), '')
+
+    @mock.patch('scripts.canarytest.vsphere_tools.do_a_vmotion')
+    @mock.patch('scripts.canarytest.vsphere_tools.find_hosts')
+    @mock.patch('scripts.canarytest.vsphere_tools.resolve_vms')
+    def test_forward_canaries(self, mock_resolve, mock_fh, mock_vmotion):
+        """
+            Verify what canaries print from run_parallel's worker threads
+            goes to the client, not the daemon's own stdout
+        """
+        mock_resolve.side_effect = lambda si_obj, names, cache: (
+            dict((name, mock.MagicMock()) for name in names), [])
+        hosts = [mock.MagicMock() for _ in range(2)]
+        for number, host in enumerate(hosts):
+            host.name = 'esx%d' % (number + 1)
+        mock_fh.return_value = hosts
+        # both canaries are moving at once, so each takes one host
+        moving = threading.Barrier(2, timeout=5)
+        mock_vmotion.side_effect = lambda *args, **kwargs: \
+            moving.wait() and None
+        vsphere_daemon = daemon.Daemon({'canarytest': canarytest})
+        vsphere_daemon.targets[('vc1', 'me', 443)] = mock.MagicMock()
+        self.serve(vsphere_daemon)
+
+        status, stdout, _ = self.forward(
+            ['-s', 'vc1', '-u', 'me', '-v', 'c1', '-v', 'c2',
+             '--monitor-interval', '0', 'esx1', 'esx2'], 'canarytest')
+        self.assertEqual(status, 0)
+        self.assertEqual(mock_vmotion.call_count, 2)
+        # print writes the newline separately, so the lines can interleave
+        self.assertEqual(sorted(re.findall(r'(c\d): moved to esx\d',
+                                           stdout)), ['c1', 'c2'])
+        self.assertEqual(self.leaked.getvalue(), '')
+        self.assertIs(mock_resolve.call_args[1]['cache'],
+                      vsphere_daemon.targets[('vc1', 'me', 443)])
+
+    def test_forward_no_daemon(self):
+        """
+            Verify a missing daemon is an error, not a hang
+        """
+        self.assertRaises(Exception, bootstrap.forward, 'power', [],
+                          self.socket_path)
+
+    def test_stale_socket(self):
+        """
+            Verify a dead daemon's socket is replaced, and a live one isn't
+        """
+        with open(self.socket_path, 'w'):
+            pass
+        self.serve(daemon.Daemon({}))
+        self.assertRaises(Exception, daemon.remove_stale_socket,
+                          self.socket_path)
+
+    @mock.patch('scripts.daemon.Target')
+    @mock.patch('scripts.vsphere_tools.connect_vc')
+    def test_target(self, mock_connect, mock_target):
+        """
+            Verify an unknown VC is logged in to with the command's password
+            and kept for the next command
+        """
+        vsphere_daemon = daemon.Daemon({}, reuse=True)
+        args = FakeScript.get_args(['-s', 'vc1', '-u', 'me', '-p', 'secret',
+                                    '--dc', 'one', 'on'])
+        self.assertEqual(vsphere_daemon.target(args),
+                         mock_target.return_value)
+        mock_connect.assert_called_once_with('vc1', 'me', 'secret', 443,
+                                             True)
+        mock_target.assert_called_once_with(mock_connect.return_value,
+                                            'DC-ONE')
+        args.password = None
+        self.assertEqual(vsphere_daemon.target(args),
+                         mock_target.return_value)
+        mock_connect.assert_called_once()
+
+    def test_refresh(self):
+        """
+            Verify refresh updates the caches, rebuilding one whose
+            collector has gone
+        """
+        si_obj = mock.MagicMock()
+        with mock.patch('scripts.vsphere_tools.InventoryCache') as mock_cache:
+            mock_cache.return_value.update.side_effect = [True, False]
+            target = daemon.Target(si_obj, 'DC-ONE')
+            mock_cache.assert_called_once_with(si_obj, 'DC-ONE')
+            mock_cache.return_value.rebuild.assert_not_called()
+            vsphere_daemon = daemon.Daemon({})
+            vsphere_daemon.targets[('vc1', 'me', 443)] = target
+            vsphere_daemon.refresh()
+            mock_cache.return_value.rebuild.assert_called_once()
+            mock_cache.return_value.resolve.return_value = ({}, ['vm1'])
+            self.assertEqual(target.resolve(['vm1']), ({}, ['vm1']))
+        with mock.patch('scripts.vsphere_tools.AddressIndex') as mock_index:
+            index = target.addresses()
+            self.assertEqual(target.addresses(), index)
+            mock_index.assert_called_once_with(
+                si_obj.RetrieveContent.return_value)
+            index.update.assert_called_once()
+            target.cache.update.side_effect = None
+            target.refresh()
+            self.assertEqual(index.update.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/local/bin/python
+"""
+    testing the property follower
+"""
+# pylint: disable=no-self-use
+# pylint: disable=protected-access
+
+import unittest
+from unittest import mock
+from scripts.vsphere_tools import follow
+from tests.helpers import make_update
+
+
+class PropertyFollowerTestCase(unittest.TestCase):
+    """
+        unittests for PropertyFollower
+    """
+
+    def test_wait(self):
+        """
+            Verify the first wait reads everything, truncated updates are
+            read to the end, and later waits carry on from the version
+        """
+        collector = mock.MagicMock()
+        private = collector.CreatePropertyCollector.return_value
+        private.CreateFilter.return_value._moId = 'filter-1'
+        private.WaitForUpdatesEx.side_effect = [
+            make_update('1', [('enter', 'vm-1', [('name', 'assign', 'one')])],
+                        'filter-1', truncated=True),
+            make_update('2', [('enter', 'vm-2', [('name', 'assign', 'two')])],
+                        'filter-1'),
+            make_update('3', [('modify', 'vm-1', [('name', 'remove', None)]),
+                              ('leave', 'vm-2', [])], 'filter-1'),
+            None]
+        follower = follow.PropertyFollower(collector)
+        follower.add_filter('spec', 'dc.cluster')
+        self.assertEqual(follower.wait(), [
+            ('dc.cluster', 'enter', 'vm-1', {'name': 'one'}),
+            ('dc.cluster', 'enter', 'vm-2', {'name': 'two'})])
+        self.assertEqual(follower.wait(5), [
+            ('dc.cluster', 'modify', 'vm-1', {'name': None}),
+            ('dc.cluster', 'leave', 'vm-2', {})])
+        self.assertEqual(follower.wait(5), [])
+        self.assertEqual([call[0][0] for call in
+                          private.WaitForUpdatesEx.call_args_list],
+                         ['', '1', '2', '3'])
+        follower.close()
+        private.DestroyPropertyCollector.assert_called_once()
@@ -0,0 +1,96 @@
+#!/usr/local/bin/python
+"""
+    testing the canary hop records and comparing runs
+"""
+# pylint: disable=no-self-use
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from scripts.vsphere_tools import hops, writers
+
+
+def hop(host, ok=True, **metrics):
+    """
+        A hop record with just the given metrics
+    """
+    return hops.hop_record(host, 'canary', metrics,
+                           error=None if ok else Exception('failed'))
+
+
+class HopsTestCase(unittest.TestCase):
+    """
+        unittests for the hop records
+    """
+
+    def test_hop_record(self):
+        """
+            Verify a record has every column, filled from the timings and
+            monitor stats, and the error as text
+        """
+        stats = mock.MagicMock()
+        stats.longest_outage.return_value = 0.75
+        stats.loss = 0.1
+        record = hops.hop_record('esx1', 'canary1', {'queue_s': 0.5,
+                                                     'run_s': 8.0}, stats)
+        self.assertEqual(sorted(record), sorted(hops.HOP_COLUMNS))
+        self.assertEqual((record['host'], record['canary'], record['ok'],
+                          record['error'], record['queue_s'],
+                          record['run_s'], record['ready_s'],
+                          record['outage_ms'], record['loss']),
+                         ('esx1', 'canary1', True, None, 0.5, 8.0, None,
+                          750.0, 0.1))
+        record = hops.hop_record('esx1', 'canary1',
+                                 error=Exception('Pre-VMotion Ping Failed'))
+        self.assertFalse(record['ok'])
+        self.assertEqual(record['error'], 'Pre-VMotion Ping Failed')
+
+    def test_read_hops(self):
+        """
+            Verify records written as JSON Lines read back the same
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'run.jsonl')
+            records = [hop('esx1', run_s=8.0), hop('esx2', ok=False)]
+            writer = writers.get_writer('jsonl', path, hops.HOP_COLUMNS)
+            for record in records:
+                writer.write(record)
+            writer.close()
+            self.assertEqual(hops.read_hops(path), records)
+
+    def test_summarize(self):
+        """
+            Verify the basic statistics, including for one and no values
+        """
+        self.assertEqual(hops.summarize([1.0, 2.0, 6.0]),
+                         {'n': 3, 'mean': 3.0, 'median': 2.0,
+                          'stdev': 2.6457513110645907, 'min': 1.0,
+                          'max': 6.0})
+        self.assertEqual(hops.summarize([4.0])['stdev'], 0.0)
+        self.assertIsNone(hops.summarize([])['median'])
+
+    def test_compare_hops(self):
+        """
+            Verify hosts are compared metric by metric on their passing
+            hops, with the relative change in the median
+        """
+        old = [hop('esx1', run_s=8.0), hop('esx1', run_s=10.0),
+               hop('esx2', run_s=5.0), hop('esx3', run_s=4.0)]
+        new = [hop('esx1', run_s=12.0, outage_ms=900.0),
+               hop('esx1', ok=False, run_s=50.0), hop('esx2', run_s=5.0),
+               hop('esx4', run_s=4.0)]
+        rows = hops.compare_hops(old, new)
+        self.assertEqual([(host, metric, change)
+                          for host, metric, _, _, change in rows],
+                         [('esx1', 'run_s', 12.0 / 9.0 - 1),
+                          ('esx1', 'outage_ms', None),
+                          ('esx2', 'run_s', 0.0), ('esx3', 'run_s', None),
+                          ('esx4', 'run_s', None)])
+        self.assertEqual((rows[0][2]['n'], rows[0][3]['n']), (2, 1))
+        self.assertEqual(hops.hop_failures(new),
+                         {'esx1': (1, 2), 'esx2': (0, 1), 'esx4': (0, 1)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/local/bin/python
+"""
+    testing the PropertyCollector backed inventory index
+"""
+# pylint: disable=unused-argument
+# pylint: disable=no-self-use
+
+import unittest
+from unittest import mock
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+from scripts.vsphere_tools import inventory
+from scripts.vsphere_tools import get_obj
+
+
+def make_result(objects, token=None):
+    """
+        Build a fake RetrievePropertiesEx result from (obj, {props}) pairs
+    """
+    result = mock.MagicMock()
+    result.token = token
+    result.objects = []
+    for obj, props in objects:
+        obj_content = mock.MagicMock()
+        obj_content.obj = obj
+        obj_content.propSet = []
+        for key, value in props.items():
+            prop = mock.MagicMock()
+            prop.name = key
+            prop.val = value
+            obj_content.propSet.append(prop)
+        result.objects.append(obj_content)
+    return result
+
+
+class InventoryTestCase(unittest.TestCase):
+    """
+        unittests for the inventory index
+    """
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_retrieve_pages(self, mock_pc):
+        """
+            Verify that continuation tokens are followed to the last page
+        """
+        collector = mock.MagicMock()
+        collector.RetrievePropertiesEx.return_value = make_result(
+            [('vm-1', {'name': 'one'})], token='more')
+        collector.ContinueRetrievePropertiesEx.return_value = make_result(
+            [('vm-2', {'name': 'two'})])
+        result = list(inventory.retrieve_properties(collector, []))
+        self.assertEqual(result, [('vm-1', {'name': 'one'}),
+                                  ('vm-2', {'name': 'two'})])
+        collector.RetrievePropertiesEx.assert_called_once()
+        collector.ContinueRetrievePropertiesEx.assert_called_once_with(
+            token='more')
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_index_single_call(self, mock_pc):
+        """
+            Verify the index is built with one retrieve, and the view
+            is cleaned up afterwards
+        """
+        content = mock.MagicMock()
+        content.propertyCollector.RetrievePropertiesEx.return_value = \
+            make_result([('vm-1', {'name': 'one'}),
+                         ('vm-2', {'name': 'two'}),
+                         ('vm-3', {'name': 'two'})])
+        index = inventory.InventoryIndex(content, [vim.VirtualMachine])
+        content.propertyCollector.RetrievePropertiesEx.assert_called_once()
+        content.viewManager.CreateContainerView.return_value.\
+            DestroyView.assert_called_once()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get('one'), 'vm-1')
+        self.assertEqual(index.find('two'), ['vm-2', 'vm-3'])
+        self.assertEqual(index.get(), 'vm-1')
+        self.assertIsNone(index.get('three'))
+        self.assertNotIn('three', index)
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_get_obj(self, mock_pc):
+        """
+            Verify get_obj answers from the index, and returns None when
+            nothing matches
+        """
+        content = mock.MagicMock()
+        content.propertyCollector.RetrievePropertiesEx.return_value = \
+            make_result([('vm-1', {'name': 'one'})])
+        self.assertEqual(get_obj(content, [vim.VirtualMachine], 'one'),
+                         'vm-1')
+        self.assertIsNone(get_obj(content, [vim.VirtualMachine], 'two'))
+
+    @mock.patch.object(vmodl.query, 'PropertyCollector')
+    def test_collect_resource_vms(self, mock_pc):
+        """
+            Verify every VM of a cluster comes from one traversal, starting
+            at the cluster itself
+        """
+        content = mock.MagicMock()
+        content.propertyCollector.RetrievePropertiesEx.return_value = \
+            make_result([('vm-1', {'name': 'one'}),
+                         ('vm-2', {'name': 'two'})])
+        result = list(inventory.collect_resource_vms(content, 'cluster-1',
+                                                     ['name']))
+        self.assertEqual([props['name'] for _, props in result],
+                         ['one', 'two'])
+        content.propertyCollector.RetrievePropertiesEx.assert_called_once()
+        self.assertEqual(mock_pc.ObjectSpec.call_args[1]['obj'], 'cluster-1')
+        self.assertEqual(mock_pc.PropertySpec.call_args[1]['pathSet'],
+                         ['name'])
+        content.viewManager.CreateContainerView.assert_not_called()
@@ -0,0 +1,76 @@
+#!/usr/local/bin/python
+"""
+    Unit tests for the address lookup script
+"""
+# pylint: disable=unused-argument
+
+import io
+import json
+import sys
+import unittest
+from unittest import mock
+from scripts import lookup
+
+
+class LookupTestCase(unittest.TestCase):
+    """
+        unittests for lookup.py
+    """
+
+    def test_get_args(self):
+        """
+            Verify addresses, --from-file or --collisions are needed
+        """
+        args = lookup.get_args(['10.0.0.1', 'web01.example.com'])
+        self.assertEqual(args.address, ['10.0.0.1', 'web01.example.com'])
+        self.assertTrue(lookup.get_args(['--collisions']).collisions)
+        with mock.patch('sys.stderr', io.StringIO()):
+            self.assertRaises(SystemExit, lookup.get_args, [])
+
+    @mock.patch('scripts.lookup.vsphere_tools.AddressIndex')
+    def test_run(self, mock_index):
+        """
+            Verify each address and name is looked up in one index, with a
+            line of JSON each, then the collisions
+        """
+        index = mock_index.return_value
+        index.find_ip.side_effect = lambda address: {
+            '10.0.0.1': ['vm-1', 'vm-2'], '10.0.0.3': []}[address]
+        index.find_name.return_value = ['vm-1']
+        index.name_of.side_effect = {'vm-1': 'web01', 'vm-2': 'web02'}.get
+        index.collisions.return_value = {'10.0.0.1': ['vm-2', 'vm-1']}
+        args = lookup.get_args(['10.0.0.1', 'web01.example.com',
+                                '--from-file', '-', '--collisions'])
+        args.stdin = io.StringIO("10.0.0.3  # from an alert\n\n")
+        output = io.StringIO()
+        with mock.patch.object(sys, 'stdout', output):
+            lookup.run(args, mock.MagicMock())
+        self.assertEqual([json.loads(line) for line in
+                          output.getvalue().splitlines()], [
+                              {'query': '10.0.0.1',
+                               'matches': ['web01', 'web02'],
+                               'collision': True},
+                              {'query': 'web01.example.com',
+                               'matches': ['web01'], 'collision': False},
+                              {'query': '10.0.0.3', 'matches': [],
+                               'collision': False},
+                              {'ip': '10.0.0.1',
+                               'vms': ['web01', 'web02']}])
+        mock_index.assert_called_once()
+        index.close.assert_called_once()
+
+    def test_run_daemon(self):
+        """
+            Verify the daemon's warm index is used, and left open
+        """
+        target = mock.MagicMock()
+        index = target.addresses.return_value
+        index.find_ip.return_value = []
+        with mock.patch.object(sys, 'stdout', io.StringIO()):
+            lookup.run(lookup.get_args(['10.0.0.9']), None, target)
+        index.find_ip.assert_called_once_with('10.0.0.9')
+        index.close.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
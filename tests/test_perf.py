@@ -0,0 +1,130 @@
+#!/usr/local/bin/python
+"""
+    testing the batched performance counter collector
+"""
+# pylint: disable=no-self-use
+
+import tempfile
+import unittest
+from unittest import mock
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+from scripts.vsphere_tools import perf
+
+
+def make_counter(key, group, name, rollup):
+    """
+        Build a fake PerfCounterInfo
+    """
+    counter = mock.MagicMock()
+    counter.key = key
+    counter.groupInfo.key = group
+    counter.nameInfo.key = name
+    counter.rollupType = rollup
+    return counter
+
+
+def make_content():
+    """
+        A fake ServiceContent whose perfManager has cpu, mem and net
+        counters, and answers QueryPerf with one sample per metric asked
+        for - except net, which only vm-0 has, as QueryAvailablePerfMetric
+        says
+    """
+    content = mock.MagicMock()
+    content.about.instanceUuid = 'vc-uuid'
+    perf_manager = content.perfManager
+    perf_manager.perfCounter = [make_counter(2, 'cpu', 'usage', 'average'),
+                                make_counter(24, 'mem', 'active', 'average'),
+                                make_counter(99, 'net', 'usage', 'average')]
+    def query_perf(querySpec):  # pylint: disable=invalid-name
+        results = []
+        for spec in querySpec:
+            entity_metric = mock.MagicMock()
+            entity_metric.entity = spec.entity
+            entity_metric.value = []
+            for metric_id in spec.metricId:
+                if metric_id.counterId == 99 and \
+                        spec.entity._moId != 'vm-0':
+                    continue
+                series = mock.MagicMock()
+                series.id.counterId = metric_id.counterId
+                series.value = [metric_id.counterId * 100]
+                entity_metric.value.append(series)
+            results.append(entity_metric)
+        return results
+
+    def query_available(entity, intervalId):  # pylint: disable=C0103
+        return [mock.MagicMock(counterId=counter_id)
+                for counter_id in (2, 24, 99)
+                if counter_id != 99 or entity._moId == 'vm-0']
+
+    perf_manager.QueryPerf.side_effect = query_perf
+    perf_manager.QueryAvailablePerfMetric.side_effect = query_available
+    return content
+
+
+class PerfCollectorTestCase(unittest.TestCase):
+    """
+        unittests for PerfCollector
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_query_batches(self):
+        """
+            Verify entities are only asked for the counters they have, and
+            batched within the metrics limit
+        """
+        content = make_content()
+        collector = perf.PerfCollector(content, interval=300,
+                                       cache_dir=self.tmpdir.name)
+        self.assertEqual(collector.max_metrics, perf.MAX_QUERY_METRICS)
+        collector.max_metrics = 6
+        vms = [vim.VirtualMachine('vm-%d' % i) for i in range(6)]
+        result = collector.query(vms, ['cpu.usage.average',
+                                       'mem.active.average',
+                                       'net.usage.average'])
+        self.assertEqual(result[vms[5]], {'cpu.usage.average': [200],
+                                          'mem.active.average': [2400]})
+        self.assertEqual(result[vms[0]]['net.usage.average'], [9900])
+        self.assertEqual(len(result), 6)
+        self.assertEqual(
+            [len(call[1]['querySpec']) for call in
+             content.perfManager.QueryPerf.call_args_list], [2, 3, 1])
+        self.assertEqual(
+            content.perfManager.QueryAvailablePerfMetric.call_count, 6)
+        spec = content.perfManager.QueryPerf.call_args[1]['querySpec'][0]
+        self.assertEqual([metric.counterId for metric in spec.metricId],
+                         [2, 24])
+        self.assertEqual(spec.intervalId, 300)
+        self.assertEqual(spec.maxSample, 1)
+
+    def test_cache(self):
+        """
+            Verify counter IDs and available counters come from the cache
+            file on the next run until they expire, and unknown counters are
+            refused
+        """
+        collector = perf.PerfCollector(make_content(),
+                                       cache_dir=self.tmpdir.name)
+        vms = [vim.VirtualMachine('vm-1')]
+        collector.query(vms, ['cpu.usage.average'])
+        content = make_content()
+        type(content.perfManager).perfCounter = mock.PropertyMock(
+            side_effect=AssertionError('perfCounter fetched'))
+        collector = perf.PerfCollector(content, cache_dir=self.tmpdir.name)
+        self.assertEqual(collector.max_metrics, perf.REALTIME_QUERY_METRICS)
+        result = collector.query(vms, ['cpu.usage.average'])
+        self.assertEqual(result[vms[0]], {'cpu.usage.average': [200]})
+        content.perfManager.QueryAvailablePerfMetric.assert_not_called()
+        collector.available['20/vm-1'][0] -= perf.AVAILABLE_TTL + 1
+        collector.query(vms, ['cpu.usage.average'])
+        content.perfManager.QueryAvailablePerfMetric.assert_called_once_with(
+            entity=vms[0], intervalId=20)
+        type(content.perfManager).perfCounter = mock.PropertyMock(
+            return_value=[])
+        self.assertRaises(Exception, collector.query, vms, ['no.such.one'])
@@ -6,6 +6,9 @@
 # pylint: disable=unused-argument
 # pylint: disable=too-many-arguments
 
+import io
+import json
+import tempfile
 import unittest
 from unittest import mock
 import sys
@@ -74,8 +77,8 @@ class PowerScriptTestCase(unittest.TestCase):
     @mock.patch('scripts.power.vsphere_tools.vm_poweron')
     @mock.patch('scripts.power.vsphere_tools.vm_poweroff')
     @mock.patch('scripts.power.vsphere_tools.vm_reboot')
-    @mock.patch('scripts.power.vsphere_tools.get_obj')
-    def test_main_gentle(self, mock_go, mock_reboot,
+    @mock.patch('scripts.power.vsphere_tools.resolve_vms')
+    def test_main_gentle(self, mock_resolve, mock_reboot,
                          mock_poweroff, mock_poweron, mock_vm, mock_si):
         """
             Testing on/off/reboot with forced option not set
@@ -83,7 +86,7 @@ class PowerScriptTestCase(unittest.TestCase):
         testvm = vim.VirtualMachine()
         testvm.name = 'ThisIsATest'
         testvm.runtime.powerState.return_value = True
-        mock_go.return_value = testvm
+        mock_resolve.return_value = ({'vmname': testvm}, [])
         test_args = ["prog", "-s", "vc1", "-p", "password",
                      "-u", "username", "-q", "on", "vmname"]
         with mock.patch.object(sys, 'argv', test_args):
@@ -111,8 +114,8 @@ class PowerScriptTestCase(unittest.TestCase):
     @mock.patch('scripts.power.vsphere_tools.vm_poweron')
     @mock.patch('scripts.power.vsphere_tools.vm_poweroff')
     @mock.patch('scripts.power.vsphere_tools.vm_reboot')
-    @mock.patch('scripts.power.vsphere_tools.get_obj')
-    def test_main_force(self, mock_go, mock_reboot, mock_poweroff,
+    @mock.patch('scripts.power.vsphere_tools.resolve_vms')
+    def test_main_force(self, mock_resolve, mock_reboot, mock_poweroff,
                         mock_poweron, mock_vm, mock_si):
         """
             Testing on/off/reboot with forced option set
@@ -120,7 +123,7 @@ class PowerScriptTestCase(unittest.TestCase):
         testvm = vim.VirtualMachine()
         testvm.name = 'ThisIsATest'
         testvm.runtime.powerState.return_value = True
-        mock_go.return_value = testvm
+        mock_resolve.return_value = ({'vmname': testvm}, [])
         test_args = ["prog", "-s", "vc1", "-p", "password",
                      "-u", "username", "-q", "off", "vmname", "--force"]
         with mock.patch.object(sys, 'argv', test_args):
@@ -137,3 +140,125 @@ class PowerScriptTestCase(unittest.TestCase):
             self.assertNotEqual(repr(mock_reboot.call_args_list).find(
                 "True, False"), -1,
                                 "Reboot not called with forceful options")
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.power.vsphere_tools.vm_poweron')
+    @mock.patch('scripts.power.vsphere_tools.resolve_vms')
+    def test_main_missing(self, mock_resolve, mock_poweron, mock_si):
+        """
+            All VMs are resolved in one go, and a missing one stops things
+            before any of them are powered on
+        """
+        mock_resolve.return_value = ({'vm1': mock.MagicMock()}, ['vm2'])
+        test_args = ["prog", "-s", "vc1", "-p", "password",
+                     "-u", "username", "-q", "on", "vm1", "vm2"]
+        with mock.patch.object(sys, 'argv', test_args):
+            with self.assertRaises(Exception):
+                main()
+        mock_resolve.assert_called_once()
+        self.assertEqual(mock_resolve.call_args[0][1], ['vm1', 'vm2'])
+        mock_poweron.assert_not_called()
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.power.vsphere_tools.run_tasks')
+    @mock.patch('scripts.power.vsphere_tools.resolve_vms')
+    def test_main_parallel(self, mock_resolve, mock_run, mock_si):
+        """
+            With --parallel, power tasks are started for every VM and
+            waited on together, and failures are raised at the end
+        """
+        vms = dict(('vm%d' % i, mock.MagicMock()) for i in range(4))
+        mock_resolve.return_value = (vms, [])
+        mock_run.return_value = {'vm0': None, 'vm1': Exception('failed'),
+                                 'vm2': None, 'vm3': None}
+        test_args = ["prog", "-s", "vc1", "-p", "password", "-u", "username",
+                     "-q", "--parallel", "3", "on"] + list(vms)
+        with mock.patch.object(sys, 'argv', test_args):
+            with self.assertRaises(Exception) as context:
+                main()
+        start, items, parallel, _ = mock_run.call_args[0]
+        self.assertEqual(parallel, 3)
+        self.assertEqual([name for name, _ in items], list(vms))
+        self.assertIn('vm1', str(context.exception))
+        self.assertNotIn('vm2', str(context.exception))
+        start(vms['vm2'])
+        vms['vm2'].PowerOnVM_Task.assert_called_once()
+
+    @mock.patch('scripts.power.bootstrap.connect')
+    @mock.patch('scripts.power.bootstrap.forward')
+    def test_main_daemon(self, mock_forward, mock_connect):
+        """
+            With --daemon, the command line goes to the daemon instead
+        """
+        mock_forward.return_value = 3
+        test_args = ["prog", "--daemon", "-q", "on", "vm1"]
+        with mock.patch.object(sys, 'argv', test_args):
+            with self.assertRaises(SystemExit) as context:
+                main()
+        self.assertEqual(context.exception.code, 3)
+        mock_forward.assert_called_once_with('power', test_args[1:],
+                                             stdin=None)
+        mock_connect.assert_not_called()
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.power.vsphere_tools.collect_object_properties')
+    @mock.patch('scripts.power.vsphere_tools.run_tasks')
+    @mock.patch('scripts.power.vsphere_tools.resolve_vms')
+    def test_main_from_file(self, mock_resolve, mock_run, mock_collect,
+                            mock_si):
+        """
+            With --from-file, every VM is resolved at once, per-VM settings
+            are used, and a line of JSON comes back for each VM
+        """
+        vms = dict((name, mock.MagicMock()) for name in
+                   ['vm1', 'vm 2', 'vm3'])
+        mock_resolve.return_value = (vms, ['vm4'])
+        mock_collect.return_value = [(vms['vm3'],
+                                      {'runtime.powerState': 'poweredOn'})]
+
+        def run_tasks(start, items, parallel, report):
+            for name, _ in items:
+                report(name, None)
+            return dict((name, None) for name, _ in items)
+        mock_run.side_effect = run_tasks
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as vm_list:
+            vm_list.write("vm1\n'vm 2' operation=off force=yes\n"
+                          "vm3 operation=query\nvm4\n")
+            vm_list.flush()
+            test_args = ["prog", "-s", "vc1", "-p", "password",
+                         "-u", "username", "--from-file", vm_list.name, "on"]
+            with mock.patch.object(sys, 'argv', test_args), \
+                    mock.patch('sys.stdout', new_callable=io.StringIO) \
+                    as stdout:
+                with self.assertRaises(Exception) as context:
+                    main()
+        self.assertIn('vm4', str(context.exception))
+        mock_resolve.assert_called_once()
+        self.assertEqual(mock_resolve.call_args[0][1],
+                         ['vm1', 'vm 2', 'vm3', 'vm4'])
+        results = [json.loads(line) for line in
+                   stdout.getvalue().splitlines()]
+        self.assertEqual(results, [
+            {'vm': 'vm4', 'status': 'missing'},
+            {'vm': 'vm3', 'operation': 'query', 'status': 'ok',
+             'power_state': 'poweredOn'},
+            {'vm': 'vm1', 'operation': 'on', 'status': 'ok'},
+            {'vm': 'vm 2', 'operation': 'off', 'status': 'ok'}])
+        start = mock_run.call_args[0][0]
+        start(vms['vm 2'])
+        vms['vm 2'].PowerOffVM_Task.assert_called_once()
+        start(vms['vm1'])
+        vms['vm1'].PowerOnVM_Task.assert_called_once()
+
+    def test_get_args_from_file(self):
+        """
+            Either VM names or --from-file are needed, not both
+        """
+        for test_args in [["prog", "on"],
+                          ["prog", "--from-file", "-", "on", "vm1"]]:
+            with mock.patch.object(sys, 'argv', test_args), \
+                    mock.patch('sys.stderr', new_callable=io.StringIO):
+                self.assertRaises(SystemExit, get_args)
+        result = get_args(["--from-file", "-", "on"])
+        self.assertEqual((result.from_file, result.vmname, result.verbose),
+                         ('-', [], False))
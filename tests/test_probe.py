@@ -0,0 +1,203 @@
+#!/usr/local/bin/python
+"""
+    testing the reachability prober, against loopback
+"""
+
+import asyncio
+import socket
+import time
+import unittest
+from unittest import mock
+from scripts.vsphere_tools import probe
+
+
+def icmp_allowed():
+    """
+        True if this user can send ICMP echo at all
+    """
+    try:
+        sock, _ = probe.open_icmp_socket()
+    except OSError:
+        return False
+    sock.close()
+    return True
+
+
+class ProbeTestCase(unittest.TestCase):
+    """
+        unittests for vsphere_tools.probe
+    """
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_tcp(self):
+        """
+            Verify TCP probes time connects, and refusals count only when
+            asked to
+        """
+        result = probe.probe_hosts(['127.0.0.1'], method='tcp',
+                                   port=self.port, interval=0)['127.0.0.1']
+        self.assertEqual((result.method, result.sent, result.received),
+                         ('tcp', 3, 3))
+        self.assertTrue(result.ok)
+        self.assertEqual(result.loss, 0.0)
+        low, mean, high = result.rtt_stats()
+        self.assertTrue(0 <= low <= mean <= high < 1)
+        self.assertIn('3/3 replies', str(result))
+
+        results = probe.probe_hosts(['127.0.0.1'], method='tcp', count=2,
+                                    port=self.closed_port, interval=0)
+        self.assertTrue(results['127.0.0.1'].ok)
+        result = probe.probe_hosts(['127.0.0.1'], method='tcp', count=2,
+                                   port=self.closed_port, interval=0,
+                                   refused_ok=False)['127.0.0.1']
+        self.assertFalse(result.ok)
+        self.assertEqual((result.loss, result.rtt_stats()), (1.0, None))
+
+    @unittest.skipUnless(icmp_allowed(), "ICMP sockets aren't allowed here")
+    def test_icmp(self):
+        """
+            Verify ICMP echo to several loopback addresses at once
+        """
+        hosts = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+        results = probe.probe_hosts(hosts, method='icmp', count=2,
+                                    interval=0.01)
+        self.assertEqual(list(results), hosts)
+        for result in results.values():
+            self.assertEqual((result.method, result.received), ('icmp', 2))
+
+    def test_auto_and_errors(self):
+        """
+            Verify auto falls back to TCP if need be, and unknown names and
+            methods are failures
+        """
+        result = probe.probe_hosts(['127.0.0.1'], port=self.port,
+                                   count=1)['127.0.0.1']
+        self.assertEqual(result.method, 'icmp' if icmp_allowed() else 'tcp')
+        self.assertTrue(result.ok)
+        result = probe.probe_hosts(['no.such.host.invalid'])[
+            'no.such.host.invalid']
+        self.assertFalse(result.ok)
+        self.assertIsNotNone(result.error)
+        self.assertRaises(Exception, probe.probe_hosts, ['127.0.0.1'],
+                          method='carrier-pigeon')
+
+    def test_probe_many(self):
+        """
+            Verify probe_many works from inside a running event loop, with
+            a result for every target
+        """
+        hosts = ['localhost', '127.0.0.1']
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(probe.probe_many(
+                hosts, concurrency=1, method='tcp', port=self.port,
+                count=1))
+        finally:
+            loop.close()
+        self.assertEqual(list(results), hosts)
+        self.assertTrue(all(result.ok for result in results.values()))
+
+    def test_monitor_stats(self):
+        """
+            Verify the longest outage and RTT percentiles from a known run
+        """
+        stats = probe.MonitorStats('vm', 'icmp', 0.1)
+        rtts = [0.001, None, None, 0.002, None, None, None, 0.004, 0.003,
+                None]
+        stats.samples = [(index * 0.1, rtt) for index, rtt in
+                         enumerate(rtts)]
+        self.assertEqual((stats.sent, stats.received), (10, 4))
+        self.assertAlmostEqual(stats.loss, 0.6)
+        # 0.4 to 0.7, beating the 0.1 to 0.3 gap and the trailing loss
+        self.assertAlmostEqual(stats.longest_outage(), 0.3)
+        self.assertEqual(stats.rtt_percentiles((50,)),
+                         {0: 0.001, 50: 0.002, 100: 0.004})
+        self.assertIn('longest outage 300 ms', str(stats))
+        stats.samples = [(0.0, None), (0.1, None)]
+        self.assertAlmostEqual(stats.longest_outage(), 0.2)
+        self.assertEqual(stats.rtt_percentiles()[50], None)
+
+    def test_monitor_outage(self):
+        """
+            Verify a monitor sees a port go away and come back
+        """
+        monitor = probe.ProbeMonitor('127.0.0.1', interval=0.01,
+                                     timeout=0.2, method='tcp',
+                                     port=self.port, refused_ok=False)
+        with monitor:
+            time.sleep(0.2)
+            self.listener.close()
+            time.sleep(0.3)
+            self.listener = socket.socket()
+            self.listener.setsockopt(socket.SOL_SOCKET,
+                                     socket.SO_REUSEADDR, 1)
+            self.listener.bind(('127.0.0.1', self.port))
+            self.listener.listen(64)
+            time.sleep(0.2)
+        stats = monitor.stats
+        self.assertEqual(stats.method, 'tcp')
+        self.assertTrue(0 < stats.loss < 1)
+        self.assertTrue(0.2 <= stats.longest_outage() < 0.6,
+                        stats.longest_outage())
+        self.assertTrue(stats.samples[-1][1] is not None)
+
+    @unittest.skipUnless(icmp_allowed(), "ICMP sockets aren't allowed here")
+    def test_monitor_icmp(self):
+        """
+            Verify an ICMP monitor of loopback sees no outage
+        """
+        with probe.ProbeMonitor('127.0.0.1', interval=0.01) as monitor:
+            time.sleep(0.2)
+        self.assertEqual(monitor.stats.method, 'icmp')
+        self.assertTrue(monitor.stats.sent > 5)
+        self.assertEqual(monitor.stats.loss, 0.0)
+        self.assertEqual(monitor.stats.longest_outage(), 0.0)
+
+    @unittest.skipUnless(icmp_allowed(), "ICMP sockets aren't allowed here")
+    def test_monitor_receive_errors(self):
+        """
+            Verify a socket that keeps failing to read is counted, and
+            backed off from rather than spun on
+        """
+        with mock.patch.object(asyncio.selector_events.BaseSelectorEventLoop,
+                               'sock_recv', side_effect=OSError('refused')):
+            start = time.perf_counter()
+            with probe.ProbeMonitor('127.0.0.1', interval=0.05) as monitor:
+                time.sleep(0.3)
+            # including waiting out the timeout for the last replies
+            elapsed = time.perf_counter() - start
+        self.assertEqual(monitor.stats.received, 0)
+        self.assertTrue(0 < monitor.stats.receive_errors <=
+                        elapsed / 0.05 + 2, monitor.stats.receive_errors)
+        self.assertIn('receive errors', str(monitor.stats))
+
+    def test_packets(self):
+        """
+            Verify echo requests are checksummed, and replies parsed with or
+            without an IP header
+        """
+        request = probe.echo_request(socket.AF_INET, 0x1234, 7, b'data')
+        self.assertEqual(probe.checksum(request), 0)
+        reply = b'\0' + request[1:]
+        header = bytes([0x45]) + bytes(19)
+        for data in (reply, header + reply):
+            self.assertEqual(probe.parse_echo_reply(socket.AF_INET, data),
+                             (0x1234, 7, b'data'))
+        self.assertIsNone(probe.parse_echo_reply(socket.AF_INET, request))
+        self.assertIsNone(probe.parse_echo_reply(socket.AF_INET, b'\0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/local/bin/python
+"""
+    testing session reuse
+"""
+# pylint: disable=unused-argument
+# pylint: disable=protected-access
+
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+from scripts.vsphere_tools import session
+
+
+def make_si(session_id, logged_in=True):
+    """
+        A fake connection with the given session cookie
+    """
+    si_obj = mock.MagicMock()
+    si_obj._stub.cookie = 'vmware_soap_session="%s"; Path=/; HttpOnly; ' \
+        'Secure;' % session_id
+    if not logged_in:
+        si_obj.RetrieveContent.return_value.sessionManager.currentSession = \
+            None
+    return si_obj
+
+
+class SessionTestCase(unittest.TestCase):
+    """
+        unittests for session reuse
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = session.SessionStore('vc1', 'me', 443,
+                                          session_dir=self.tmpdir.name,
+                                          use_keyring=False)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_store(self):
+        """
+            Verify the session file is only readable by its owner, and
+            can be cleared
+        """
+        self.assertIsNone(self.store.load())
+        self.store.save('abc123')
+        self.assertEqual(self.store.load(), 'abc123')
+        self.assertEqual(stat.S_IMODE(os.stat(self.store.path).st_mode),
+                         0o600)
+        self.store.clear()
+        self.assertIsNone(self.store.load())
+
+    @mock.patch('scripts.vsphere_tools.session.atexit.register')
+    @mock.patch('scripts.vsphere_tools.session.getpass.getpass')
+    @mock.patch.object(session.connect, 'Connect')
+    def test_reuse(self, mock_connect, mock_getpass, mock_register):
+        """
+            Verify a live saved session is used without logging in, and
+            isn't logged out at exit
+        """
+        self.store.save('abc123')
+        mock_connect.return_value = make_si('abc123')
+        si_obj = session.connect_vc('vc1', 'me', reuse=True,
+                                    store=self.store)
+        self.assertEqual(si_obj, mock_connect.return_value)
+        mock_connect.assert_called_once()
+        self.assertEqual(mock_connect.call_args[1]['sessionId'], 'abc123')
+        mock_getpass.assert_not_called()
+        mock_register.assert_not_called()
+
+    @mock.patch('scripts.vsphere_tools.session.atexit.register')
+    @mock.patch('scripts.vsphere_tools.session.getpass.getpass')
+    @mock.patch.object(session.connect, 'Connect')
+    def test_expired(self, mock_connect, mock_getpass, mock_register):
+        """
+            Verify an expired session means a login, with the password
+            prompted for, and the new session is saved
+        """
+        self.store.save('old')
+        mock_getpass.return_value = 'secret'
+        mock_connect.side_effect = [make_si('old', logged_in=False),
+                                    make_si('new')]
+        session.connect_vc('vc1', 'me', reuse=True, store=self.store)
+        self.assertEqual(mock_connect.call_args[1]['pwd'], 'secret')
+        self.assertEqual(self.store.load(), 'new')
+        mock_register.assert_not_called()
+
+    @mock.patch('scripts.vsphere_tools.session.atexit.register')
+    @mock.patch.object(session.connect, 'Connect')
+    def test_no_reuse(self, mock_connect, mock_register):
+        """
+            Verify without reuse it's a plain login, logged out at exit
+        """
+        mock_connect.return_value = make_si('abc123')
+        session.connect_vc('vc1', 'me', 'secret', 4443)
+        mock_connect.assert_called_once()
+        self.assertEqual(mock_connect.call_args[1]['port'], 4443)
+        mock_register.assert_called_once()
@@ -7,6 +7,8 @@
 # pylint: disable=too-many-arguments
 # pylint: disable=no-self-use
 
+import io
+import json
 import sys
 import os
 from pathlib import Path
@@ -77,18 +79,21 @@ class SnapshotScriptTestCase(unittest.TestCase):
 
     @mock.patch.object(vim, 'ServiceInstance')
     @mock.patch.object(vim, 'VirtualMachine')
-    @mock.patch('scripts.snapshots.vsphere_tools.list_snapshots')
+    @mock.patch('scripts.snapshots.vsphere_tools.fetch_snapshot_trees')
     @mock.patch('scripts.snapshots.vsphere_tools.create_snapshot')
     @mock.patch('scripts.snapshots.vsphere_tools.revert_snapshot')
     @mock.patch('scripts.snapshots.vsphere_tools.delete_snapshot')
-    @mock.patch('scripts.snapshots.vsphere_tools.get_obj')
-    def test_snapshot_main(self, mock_go, mock_deletesnap, mock_revertsnap,
-                           mock_createsnap, mock_listsnap, mock_vm, mock_si):
+    @mock.patch('scripts.snapshots.vsphere_tools.resolve_vms')
+    def test_snapshot_main(self, mock_resolve, mock_deletesnap,
+                           mock_revertsnap, mock_createsnap, mock_fetch,
+                           mock_vm, mock_si):
         """
             Given the various paths in, verify the right sub function is called
         """
         testvm = vim.VirtualMachine()
         testvm.name = "thisisavm"
+        mock_resolve.return_value = ({'testvm1': testvm}, [])
+        mock_fetch.return_value = [('testvm1', [])]
         test_args = ["prog", "-s", "vc1", "-u", "testuser",
                      "-p", "password", "create", "testvm1",
                      "--snapname", "testsnap", "-q"]
@@ -111,4 +116,131 @@ class SnapshotScriptTestCase(unittest.TestCase):
                      "-p", "password", "list", "testvm1", "-q"]
         with mock.patch.object(sys, 'argv', test_args):
             main()
-            mock_listsnap.assert_called_once()
+            # delete and revert fetch the trees too
+            self.assertEqual(mock_fetch.call_count, 3)
+            self.assertEqual(mock_fetch.call_args[0][1], [testvm])
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.snapshots.vsphere_tools.create_snapshot')
+    @mock.patch('scripts.snapshots.vsphere_tools.resolve_vms')
+    def test_snapshot_main_missing(self, mock_resolve, mock_createsnap,
+                                   mock_si):
+        """
+            A missing VM stops things before any snapshot is taken
+        """
+        mock_resolve.return_value = ({'testvm1': mock.MagicMock()},
+                                     ['testvm2'])
+        test_args = ["prog", "-s", "vc1", "-u", "testuser",
+                     "-p", "password", "create", "testvm1", "testvm2",
+                     "--snapname", "testsnap", "-q"]
+        with mock.patch.object(sys, 'argv', test_args):
+            with self.assertRaises(SystemExit):
+                main()
+        mock_resolve.assert_called_once()
+        mock_createsnap.assert_not_called()
+
+    @mock.patch('scripts.snapshots.vsphere_tools.fetch_snapshot_trees')
+    def test_list_snapshots_order(self, mock_fetch):
+        """
+            Verify VMs are listed in the order given, whatever order the
+            VC sends their trees in
+        """
+        snap = mock.MagicMock(childSnapshotList=[], createTime='yesterday',
+                              description='before')
+        snap.name = 'pre-patch'
+        mock_fetch.return_value = [('vm3', None), ('vm1', [snap]),
+                                   ('vm2', None)]
+        vms = dict((name, mock.MagicMock()) for name in ['vm3', 'vm1', 'vm2'])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            list_snapshots(mock.MagicMock(), vms, ['vm1', 'vm2', 'vm3'])
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('vm1', lines[0])
+        self.assertIn('pre-patch', lines[0])
+        self.assertEqual(lines[1:], ["VM: vm2; No Snapshots exist",
+                                     "VM: vm3; No Snapshots exist"])
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.snapshots.vsphere_tools.run_tasks')
+    @mock.patch('scripts.snapshots.vsphere_tools.vm_placement')
+    @mock.patch('scripts.snapshots.vsphere_tools.resolve_vms')
+    def test_snapshot_main_parallel(self, mock_resolve, mock_placement,
+                                    mock_run, mock_si):
+        """
+            With --parallel, missing VMs are reported along with the rest,
+            and tasks are throttled by datastore and host
+        """
+        testvm = mock.MagicMock()
+        mock_resolve.return_value = ({'testvm1': testvm}, ['testvm2'])
+        mock_placement.return_value = {testvm: [('host', 'host-1'),
+                                                ('datastore', 'ds-1')]}
+        test_args = ["prog", "-s", "vc1", "-u", "testuser",
+                     "-p", "password", "create", "testvm1", "testvm2",
+                     "--snapname", "testsnap", "-q", "--parallel", "4",
+                     "--per-datastore", "1"]
+        with mock.patch.object(sys, 'argv', test_args):
+            with self.assertRaises(Exception) as context:
+                main()
+        self.assertIn('testvm2', str(context.exception))
+        self.assertNotIn('testvm1', str(context.exception))
+        _, items, parallel, _ = mock_run.call_args[0]
+        throttle = mock_run.call_args[1]['throttle']
+        self.assertEqual(items, [('testvm1', testvm)])
+        self.assertEqual(parallel, 4)
+        self.assertEqual(throttle.limits, {'datastore': 1, 'host': 4,
+                                           'vm': 1})
+        self.assertEqual(throttle.keys['testvm1'], [('host', 'host-1'),
+                                                    ('datastore', 'ds-1')])
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    @mock.patch('scripts.snapshots.snapshot_trees')
+    @mock.patch('scripts.snapshots.vsphere_tools.run_tasks')
+    @mock.patch('scripts.snapshots.vsphere_tools.vm_placement')
+    @mock.patch('scripts.snapshots.vsphere_tools.resolve_vms')
+    def test_snapshot_main_from_file(self, mock_resolve, mock_placement,
+                                     mock_run, mock_trees, mock_si):
+        """
+            With --from-file -, VMs come from stdin with their own snapshot
+            names and operations, and each result is a line of JSON
+        """
+        vms = dict((name, mock.MagicMock()) for name in ['vm1', 'vm2', 'vm3'])
+        mock_resolve.return_value = (vms, [])
+        mock_placement.return_value = {}
+        snap = mock.MagicMock(childSnapshotList=[], createTime='yesterday',
+                              description='before')
+        snap.name = 'pre-patch'
+        mock_trees.side_effect = lambda si_obj, vm_objs: dict(
+            (name, vsphere_tools.SnapshotTree([snap], name))
+            for name in vm_objs)
+
+        def run_tasks(start, items, parallel, report, throttle=None):
+            for name, _ in items:
+                report(name, Exception('busy') if name == 'vm3' else None)
+        mock_run.side_effect = run_tasks
+        vm_list = io.StringIO("vm1\nvm2 operation=list\n"
+                              "vm3 operation=revert snapname=pre-patch\n")
+        test_args = ["prog", "-s", "vc1", "-u", "testuser", "-p", "password",
+                     "--from-file", "-", "--snapname", "nightly", "create"]
+        with mock.patch.object(sys, 'argv', test_args), \
+                mock.patch('sys.stdin', vm_list), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(Exception) as context:
+                main()
+        self.assertIn('vm3', str(context.exception))
+        self.assertEqual(mock_resolve.call_args[0][1], ['vm1', 'vm2', 'vm3'])
+        results = [json.loads(line) for line in
+                   stdout.getvalue().splitlines()]
+        self.assertEqual(results, [
+            {'vm': 'vm2', 'operation': 'list', 'status': 'ok',
+             'snapshots': [{'name': 'pre-patch', 'description': 'before',
+                            'created': 'yesterday', 'parent': None}]},
+            {'vm': 'vm1', 'operation': 'create', 'snapshot': 'nightly',
+             'status': 'ok'},
+            {'vm': 'vm3', 'operation': 'revert', 'snapshot': 'pre-patch',
+             'status': 'failed', 'error': 'busy'}])
+        start = mock_run.call_args[0][0]
+        start(vms['vm1'])
+        vms['vm1'].CreateSnapshot_Task.assert_called_once_with(
+            'nightly', '', True, True)
+        start(vms['vm3'])
+        snap.snapshot.RevertToSnapshot_Task.assert_called_once()
@@ -0,0 +1,93 @@
+#!/usr/local/bin/python
+"""
+    testing the snapshot tree model
+"""
+# pylint: disable=no-self-use
+
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from scripts.vsphere_tools.snaptree import SnapshotTree
+
+
+def snap(name, day, children=None):
+    """
+        A fake vim.vm.SnapshotTree created on the given day of Jan 2020
+    """
+    snapshot = mock.MagicMock()
+    snapshot.name = name
+    snapshot.createTime = datetime(2020, 1, day, tzinfo=timezone.utc)
+    snapshot.childSnapshotList = children or []
+    return snapshot
+
+
+class SnapshotTreeTestCase(unittest.TestCase):
+    """
+        unittests for SnapshotTree
+    """
+
+    def setUp(self):
+        self.tree = SnapshotTree([
+            snap('base', 1, [snap('patch', 2, [snap('dup', 3)]),
+                             snap('dup', 4)]),
+            snap('other', 5)], 'vm1')
+
+    def test_structure(self):
+        """
+            Verify depth first order, parents and depths
+        """
+        self.assertEqual([node.name for node in self.tree.walk()],
+                         ['base', 'patch', 'dup', 'dup', 'other'])
+        self.assertEqual([node.depth for node in self.tree.walk()],
+                         [0, 1, 2, 1, 0])
+        patch = self.tree.find_one('patch')
+        self.assertEqual(patch.parent.name, 'base')
+        self.assertEqual([node.name for node in patch.children], ['dup'])
+        self.assertEqual([node.name for node in self.tree.roots],
+                         ['base', 'other'])
+        self.assertEqual(len(self.tree), 5)
+
+    def test_lookups(self):
+        """
+            Verify name lookups, and that ambiguous or missing names raise
+        """
+        self.assertEqual(len(self.tree.find('dup')), 2)
+        self.assertEqual(self.tree.find('nope'), [])
+        with self.assertRaises(Exception):
+            self.tree.find_one('dup')
+        with self.assertRaises(Exception):
+            self.tree.find_one('nope')
+
+    def test_nested_duplicates(self):
+        """
+            Verify a snapshot under another of the same name isn't found by
+            name, as with the old recursive search, so the outer one is
+            still the only match
+        """
+        tree = SnapshotTree([
+            snap('nightly', 1, [snap('nightly', 2, [snap('nightly', 3)])]),
+            snap('other', 4, [snap('nightly', 5)])], 'vm1')
+        self.assertEqual([node.create_time.day for node in
+                          tree.find('nightly')], [1, 5])
+        tree = SnapshotTree([snap('nightly', 1, [snap('nightly', 2)])])
+        self.assertEqual(tree.find_one('nightly').create_time.day, 1)
+        self.assertEqual(len(tree), 2)
+
+    def test_older_than(self):
+        """
+            Verify the snapshots before a cutoff come back oldest first
+        """
+        old = self.tree.older_than(datetime(2020, 1, 4, tzinfo=timezone.utc))
+        self.assertEqual([(node.name, node.create_time.day) for node in old],
+                         [('base', 1), ('patch', 2), ('dup', 3)])
+
+    def test_from_vm(self):
+        """
+            Verify a VM without snapshots gives an empty tree
+        """
+        vm_obj = mock.MagicMock()
+        vm_obj.snapshot = None
+        self.assertEqual(len(SnapshotTree.from_vm(vm_obj)), 0)
+        vm_obj.snapshot = mock.MagicMock()
+        vm_obj.snapshot.rootSnapshotList = [snap('one', 1)]
+        self.assertEqual(len(SnapshotTree.from_vm(vm_obj)), 1)
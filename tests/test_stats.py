@@ -0,0 +1,90 @@
+#!/usr/local/bin/python
+"""
+    testing the columnar allocation stats
+"""
+# pylint: disable=no-self-use
+
+import math
+import unittest
+import numpy
+from scripts.vsphere_tools import stats
+
+
+class AllocationTableTestCase(unittest.TestCase):
+    """
+        unittests for AllocationTable
+    """
+
+    def setUp(self):
+        self.table = stats.AllocationTable()
+        self.table.add_group('dc.one', 8, 16384)
+        self.table.add_group('dc.two')
+        self.table.add_group('dc.empty', 4, 8192)
+        for cpu, memory in [(2, 4096), (4, 8192), (1, 1024), (8, 2048)]:
+            self.table.add('dc.one', cpu, memory, True)
+        self.table.add('dc.one', 16, 65536, False)
+        self.table.add('dc.two', 2, 2048, True)
+        self.table.add('dc.three', 1, 512, False)
+
+    def test_allocation(self):
+        """
+            Verify powered on and off totals are worked out per group,
+            including groups only seen through their VMs
+        """
+        result = self.table.allocation()
+        self.assertEqual(len(self.table), 7)
+        self.assertEqual(result['dc.one'], {
+            'onCPU': 15, 'onMB': 15360, 'onTotal': 4,
+            'offCPU': 16, 'offMB': 65536, 'offTotal': 1})
+        self.assertEqual(result['dc.three']['offTotal'], 1)
+        self.assertEqual(result['dc.empty']['onTotal'], 0)
+
+    def test_overcommit(self):
+        """
+            Verify ratios are against capacity, nan where it isn't known
+        """
+        result = self.table.overcommit()
+        self.assertAlmostEqual(result['dc.one']['cpu'], 15 / 8.0)
+        self.assertAlmostEqual(result['dc.one']['memory'], 15360 / 16384.0)
+        self.assertEqual(result['dc.empty']['cpu'], 0)
+        self.assertTrue(math.isnan(result['dc.two']['cpu']))
+
+    def test_percentiles(self):
+        """
+            Verify the grouped percentiles match numpy.percentile on each
+            group's powered on VMs
+        """
+        result = self.table.percentiles((0, 50, 95, 100))
+        for percentile in (0, 50, 95, 100):
+            self.assertAlmostEqual(
+                result['dc.one']['mbP%d' % percentile],
+                numpy.percentile([4096, 8192, 1024, 2048], percentile))
+            self.assertAlmostEqual(
+                result['dc.one']['cpuP%d' % percentile],
+                numpy.percentile([2, 4, 1, 8], percentile))
+        self.assertEqual(result['dc.two']['cpuP50'], 2)
+        self.assertTrue(math.isnan(result['dc.three']['cpuP50']))
+        self.assertTrue(numpy.isnan(stats.group_percentile(
+            numpy.array([], dtype=int), numpy.array([]), 2, 50)).all())
+
+    def test_keyed_rows(self):
+        """
+            Verify a keyed VM is replaced when added again, and can be
+            taken out without disturbing the others
+        """
+        table = stats.AllocationTable()
+        table.add('dc.one', 2, 1024, True, 'vm-1')
+        table.add('dc.one', 4, 2048, True, 'vm-2')
+        table.add('dc.two', 8, 4096, False, 'vm-3')
+        table.add('dc.one', 2, 1024, False, 'vm-1')
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.allocation()['dc.one']['offTotal'], 1)
+        table.remove('vm-1')
+        table.remove('vm-1')
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.group_of('vm-3'), 'dc.two')
+        self.assertIsNone(table.group_of('vm-1'))
+        table.add('dc.one', 16, 4096, True, 'vm-3')
+        result = table.allocation()
+        self.assertEqual(result['dc.one']['onCPU'], 20)
+        self.assertEqual(result['dc.two']['offTotal'], 0)
@@ -0,0 +1,199 @@
+#!/usr/local/bin/python
+"""
+    testing the task waiter
+"""
+# pylint: disable=unused-argument
+# pylint: disable=no-self-use
+# pylint: disable=protected-access
+
+import unittest
+from unittest import mock
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+from scripts import vsphere_tools
+from scripts.vsphere_tools import tasks
+from tests.helpers import make_update
+
+
+def make_polled_task(moid, states):
+    """
+        A task whose info.state goes through states, one per read of info
+    """
+    task = mock.MagicMock()
+    task._moId = moid
+    infos = []
+    for state in states:
+        info = mock.MagicMock()
+        info.state = state
+        info.error = None
+        infos.append(info)
+    type(task).info = mock.PropertyMock(side_effect=infos)
+    return task
+
+
+class FakeWaiter(object):
+    """
+        Stand in for TaskWaiter that finishes tasks in the order added,
+        keeping track of how many were pending at once
+    """
+    most_pending = 0
+
+    def __init__(self, collector, progress=None):
+        self.pending = {}
+
+    def add(self, task, key=None):
+        """
+            track a task
+        """
+        self.pending[task] = key
+        FakeWaiter.most_pending = max(FakeWaiter.most_pending,
+                                      len(self.pending))
+
+    def wait(self):
+        """
+            finish the oldest task, failing any called 'bad'
+        """
+        task = next(iter(self.pending))
+        key = self.pending.pop(task)
+        return [(key, Exception('bad task') if task == 'bad' else None)]
+
+    def close(self):
+        """
+            nothing to clean up
+        """
+
+
+class TaskWaiterTestCase(unittest.TestCase):
+    """
+        unittests for waiting on tasks
+    """
+
+    def test_wait_for_updates(self):
+        """
+            Verify tasks are finished from collector updates, with no
+            polling of task.info
+        """
+        collector = mock.MagicMock()
+        private = collector.CreatePropertyCollector.return_value
+        task1 = vim.Task('task-1')
+        task2 = vim.Task('task-2')
+        error = vmodl.fault.SystemError(msg='broken')
+        private.WaitForUpdatesEx.side_effect = [
+            make_update('1', [
+                ('enter', task1, [('info.state', 'assign', 'running')]),
+                ('enter', task2, [('info.state', 'assign', 'running')])]),
+            None,
+            make_update('2', [
+                ('modify', task1, [('info.state', 'assign', 'success')])]),
+            make_update('3', [
+                ('modify', task2, [('info.state', 'assign', 'error'),
+                                   ('info.error', 'assign', error)])])]
+        progress = mock.MagicMock()
+        result = tasks.wait_for_tasks([task1, task2], progress, collector)
+        self.assertEqual(result, [None, error])
+        self.assertEqual(private.WaitForUpdatesEx.call_count, 4)
+        self.assertEqual(private.WaitForUpdatesEx.call_args[0][0], '2')
+        self.assertEqual(private.CreateFilter.call_count, 2)
+        # only task-1's, task-2's going with the collector
+        private.CreateFilter.return_value.DestroyPropertyFilter.\
+            assert_called_once()
+        private.DestroyPropertyCollector.assert_called_once()
+        self.assertEqual(progress.call_count, 4)
+
+    @mock.patch('scripts.vsphere_tools.wait_for_tasks')
+    def test_wait_for_task(self, mock_wait):
+        """
+            Verify a task that's already finished is one read of its info,
+            and one that isn't is waited on
+        """
+        task = make_polled_task('task-1', ['success', 'error', 'running'])
+        self.assertTrue(vsphere_tools.wait_for_task(task))
+        self.assertFalse(vsphere_tools.wait_for_task(task))
+        mock_wait.assert_not_called()
+        mock_wait.return_value = [None]
+        self.assertTrue(vsphere_tools.wait_for_task(task))
+        mock_wait.assert_called_once_with([task], None)
+
+    @mock.patch.object(vim, 'ServiceInstance')
+    def test_task_collector(self, mock_si):
+        """
+            Verify the connection's collector is only looked up once
+        """
+        task = vim.Task('task-1', mock.MagicMock())
+        collector = tasks.task_collector(task)
+        self.assertEqual(tasks.task_collector(vim.Task('task-2', task._stub)),
+                         collector)
+        mock_si.return_value.RetrieveContent.assert_called_once()
+        self.assertIsNot(tasks.task_collector(
+            vim.Task('task-3', mock.MagicMock())), None)
+        self.assertEqual(mock_si.return_value.RetrieveContent.call_count, 2)
+
+    @mock.patch('scripts.vsphere_tools.tasks.time.sleep')
+    def test_poll_fallback(self, mock_sleep):
+        """
+            Without a usable collector, task.info is polled with a backoff
+        """
+        collector = mock.MagicMock()
+        collector.CreatePropertyCollector.side_effect = \
+            vmodl.fault.NotSupported()
+        task = make_polled_task('task-1', ['queued', 'running', 'running',
+                                           'success'])
+        self.assertEqual(tasks.wait_for_tasks([task], None, collector),
+                         [None])
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list],
+                         [0.1, 0.2, 0.4])
+
+    @mock.patch('scripts.vsphere_tools.tasks.TaskWaiter', FakeWaiter)
+    def test_run_tasks(self):
+        """
+            No more than parallel tasks are running at once, and a failure
+            to start or a failed task doesn't stop the rest
+        """
+        FakeWaiter.most_pending = 0
+
+        def start(obj):
+            if obj == 'unstartable':
+                raise Exception('could not start')
+            if obj == 'nothing':
+                return None
+            return obj
+
+        items = [('vm%d' % i, 'task%d' % i) for i in range(6)] + \
+            [('vm6', 'bad'), ('vm7', 'unstartable'), ('vm8', 'nothing')]
+        reports = []
+        results = tasks.run_tasks(start, items, 2,
+                                  lambda name, error: reports.append(name),
+                                  mock.MagicMock())
+        self.assertEqual(FakeWaiter.most_pending, 2)
+        self.assertEqual(list(results), [name for name, _ in items])
+        self.assertEqual(str(results['vm6']), 'bad task')
+        self.assertEqual(str(results['vm7']), 'could not start')
+        self.assertIsNone(results['vm8'])
+        self.assertIsNone(results['vm0'])
+        self.assertEqual(sorted(reports), sorted(results))
+
+    @mock.patch('scripts.vsphere_tools.tasks.TaskWaiter', FakeWaiter)
+    def test_run_tasks_throttled(self):
+        """
+            Tasks sharing a throttled datastore don't run at the same time,
+            and others get started around them
+        """
+        FakeWaiter.most_pending = 0
+        started = []
+
+        def start(obj):
+            started.append(obj)
+            return obj
+
+        throttle = tasks.Throttle({'datastore': 1, 'host': 0})
+        throttle.set_keys('vm0', [('datastore', 'ds-1'), ('host', 'h-1')])
+        throttle.set_keys('vm1', [('datastore', 'ds-1'), ('host', 'h-1')])
+        throttle.set_keys('vm2', [('datastore', 'ds-2'), ('host', 'h-1')])
+        self.assertEqual(throttle.keys['vm0'], [('datastore', 'ds-1')])
+        results = tasks.run_tasks(start, [('vm0', 't0'), ('vm1', 't1'),
+                                          ('vm2', 't2')], 3,
+                                  collector=mock.MagicMock(),
+                                  throttle=throttle)
+        self.assertEqual(started, ['t0', 't2', 't1'])
+        self.assertEqual(FakeWaiter.most_pending, 2)
+        self.assertEqual(list(results.values()), [None, None, None])
+        self.assertEqual(throttle.running[('datastore', 'ds-1')], 0)
@@ -0,0 +1,124 @@
+#!/usr/local/bin/python
+"""
+    testing the SOAP call tracing
+"""
+# pylint: disable=no-self-use
+
+import http.server
+import threading
+import unittest
+from pyVmomi import vim, SoapStubAdapter  # pylint: disable=no-name-in-module
+from pyVmomi import SoapAdapter
+from scripts import vsphere_tools
+from scripts.vsphere_tools import trace
+
+ENVELOPE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+ xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+ xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<soapenv:Body>%s</soapenv:Body></soapenv:Envelope>"""
+# the canned response to each method
+RESPONSES = {
+    b'CurrentTime': b'<CurrentTimeResponse xmlns="urn:vim25"><returnval>'
+                    b'2026-10-17T10:00:00Z</returnval></CurrentTimeResponse>',
+    b'Fetch': b'<FetchResponse xmlns="urn:vim25"></FetchResponse>',
+}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+        A vCenter that only knows CurrentTime and Fetch
+    """
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+            Answer a SOAP call
+        """
+        request = self.rfile.read(int(self.headers['Content-Length']))
+        body = ENVELOPE % [response for method, response in
+                           RESPONSES.items() if b'<' + method in request][0]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class CallTracerTestCase(unittest.TestCase):
+    """
+        unittests for CallTracer
+    """
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.server_close)
+        # a negative port is plain http
+        self.stub = SoapStubAdapter(host='127.0.0.1',
+                                    port=-self.server.server_port,
+                                    version='vim.version.version9')
+        self.addCleanup(self.stub.DropConnections)
+
+    def test_trace(self):
+        """
+            Verify calls, including hidden property fetches, are counted by
+            method, type and caller with their sizes, and pyVmomi is put
+            back when the last tracer stops
+        """
+        original = SoapAdapter.SoapStubAdapter.InvokeMethod
+        service = vim.ServiceInstance('ServiceInstance', self.stub)
+        with trace.CallTracer() as tracer, trace.CallTracer() as inner:
+            service.CurrentTime()
+            inner.stop()
+            vm_obj = vim.VirtualMachine('vm-1', self.stub)
+            self.assertRaises(AttributeError, vsphere_tools.find_snapshot,
+                              vm_obj, 'snap')
+        self.assertEqual(SoapAdapter.SoapStubAdapter.InvokeMethod, original)
+        service.CurrentTime()
+        self.assertEqual(inner.total.calls, 1)
+        self.assertEqual(tracer.total.calls, 2)
+        self.assertEqual(sorted(tracer.by_method),
+                         ['CurrentTime', 'Fetch(snapshot)'])
+        self.assertEqual(sorted(tracer.by_type),
+                         ['vim.ServiceInstance', 'vim.VirtualMachine'])
+        self.assertEqual(sorted(tracer.by_caller),
+                         ['test_trace.test_trace',
+                          'vsphere_tools.find_snapshot'])
+        fetch = tracer.by_method['Fetch(snapshot)']
+        self.assertGreater(fetch.sent, 0)
+        self.assertEqual(fetch.received,
+                         len(ENVELOPE % RESPONSES[b'Fetch']))
+
+    def test_summary(self):
+        """
+            Verify each table lists the slowest first, up to top
+        """
+        tracer = trace.CallTracer()
+        tracer.record(('Fetch(runtime)', 'vim.VirtualMachine', 'power.run'),
+                      0.5, 400, 1200)
+        tracer.record(('Fetch(runtime)', 'vim.VirtualMachine', 'power.run'),
+                      0.25, 400, 1200)
+        tracer.record(('RetrievePropertiesEx', 'vmodl.query.PropertyCollector',
+                       'vsphere_tools.inventory.collect_properties'),
+                      1.0, 900, 50000)
+        lines = tracer.summary(top=1)
+        self.assertEqual(lines[0], "3 SOAP calls in 1.750s of 0.000s, "
+                                   "1700 bytes sent, 52400 received")
+        self.assertEqual(lines[1:4], [
+            '', 'by method' + ' ' * 40 + ' calls   total s     max s       '
+            'sent   received', 'RetrievePropertiesEx' + ' ' * 28 +
+            '      1     1.000     1.000        900      50000'])
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(len(tracer.summary()), 13)
+        self.assertEqual((tracer.by_caller['power.run'].calls,
+                          tracer.by_caller['power.run'].max_seconds),
+                         (2, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
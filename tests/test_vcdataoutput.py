@@ -0,0 +1,383 @@
+#!/usr/local/bin/python
+"""
+    testing the vc data output script
+"""
+# pylint: disable=unused-argument
+# pylint: disable=no-self-use
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+from scripts import vcdataoutput
+
+INI = """
+[DC-ONE]
+SERVER=vc1.example.com
+USERNAME=one@example.com
+
+[DC-TWO]
+SERVER=vc1.example.com
+USERNAME=one@example.com
+
+[DC-THREE]
+SERVER=vc2.example.com
+USERNAME=three@example.com
+
+[OTHER]
+SERVER=vc3.example.com
+"""
+
+
+class VCDataOutputTestCase(unittest.TestCase):
+    """
+        unittests for vcdataoutput
+    """
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.collect_resource_vms')
+    def test_collect_vms(self, mock_collect):
+        """
+            Verify a row is written for each collected VM, from the
+            collected properties only
+        """
+        mock_collect.return_value = [
+            ('vm-1', {'name': 'one', 'config.hardware.numCPU': 2,
+                      'config.hardware.memoryMB': 4096,
+                      'runtime.powerState': 'poweredOn'}),
+            ('vm-2', {'name': 'two', 'runtime.powerState': 'poweredOff'})]
+        vm_data = mock.MagicMock()
+        writer = mock.MagicMock()
+        vcdataoutput.collect_vms('content', 'cluster', vm_data, 'dc.c',
+                                 writer)
+        self.assertEqual(writer.write.call_args_list, [
+            mock.call({'cluster': 'dc.c', 'name': 'one', 'num_cpu': 2,
+                       'memory_gb': 4, 'power_state': 'poweredOn'}),
+            mock.call({'cluster': 'dc.c', 'name': 'two', 'num_cpu': 0,
+                       'memory_gb': 0, 'power_state': 'poweredOff'})])
+        self.assertEqual(vm_data.add.call_args_list,
+                         [mock.call('dc.c', 2, 4096, True, None),
+                          mock.call('dc.c', 0, 0, False, None)])
+        mock_collect.assert_called_once_with(
+            'content', 'cluster', vcdataoutput.VM_PROPERTIES)
+
+    def test_summarize(self):
+        """
+            Verify the table's stats end up in result_data per cluster, and
+            ones that couldn't be worked out aren't printed
+        """
+        vm_data = vcdataoutput.AllocationTable()
+        vm_data.add_group('dc.c', 4, 8192)
+        vm_data.add_group('dc.h')
+        vm_data.add('dc.c', 2, 4096, True)
+        vm_data.add('dc.h', 2, 4096, False)
+        result_data = vcdataoutput.summarize(vm_data, {})
+        self.assertEqual(result_data['dc.c.virtualmachines.allocated']
+                         ['onCPU'], 2)
+        self.assertEqual(result_data['dc.c.virtualmachines.overcommit']
+                         ['memory'], 0.5)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as output:
+            vcdataoutput.print_results(result_data, 100)
+        lines = output.getvalue().splitlines()
+        self.assertIn('dc.c.virtualmachines.overcommit.cpu 0.5 100', lines)
+        self.assertIn('dc.h.virtualmachines.allocated.offMB 4096 100', lines)
+        self.assertFalse([line for line in lines if 'nan' in line])
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.resource_vm_filter')
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.PropertyFollower')
+    def test_follow_vms(self, mock_follower, mock_filter):
+        """
+            Verify follow mode keeps the stats current from the updates,
+            printing only what changed, until interrupted
+        """
+        vm1 = mock.MagicMock(_moId='vm-1')
+        vm2 = mock.MagicMock(_moId='vm-2')
+        props = {'name': 'one', 'config.hardware.numCPU': 2,
+                 'config.hardware.memoryMB': 4096,
+                 'runtime.powerState': 'poweredOn'}
+        follower = mock_follower.return_value
+        follower.wait.side_effect = [
+            [('dc.a', 'enter', vm1, props),
+             ('dc.a', 'enter', vm2, dict(props, name='two'))],
+            [('dc.b', 'enter', vm1, props), ('dc.a', 'leave', vm1, {}),
+             ('dc.a', 'modify', vm2,
+              {'runtime.powerState': 'poweredOff'})],
+            KeyboardInterrupt()]
+        vm_data = vcdataoutput.AllocationTable()
+        vm_data.add_group('dc.a')
+        vm_data.add_group('dc.b')
+        writer = mock.MagicMock()
+        output = io.StringIO()
+        result = vcdataoutput.follow_vms(
+            mock.MagicMock(), [('dc.a', 'a'), ('dc.b', 'b')], vm_data, {},
+            3600, writer, output)
+        self.assertEqual(follower.add_filter.call_count, 2)
+        follower.close.assert_called_once()
+        self.assertEqual(writer.write.call_count, 4)
+        self.assertEqual(writer.flush.call_count, 2)
+        self.assertEqual(result['dc.a.virtualmachines.allocated'],
+                         {'onCPU': 0, 'onMB': 0, 'onTotal': 0,
+                          'offCPU': 2, 'offMB': 4096, 'offTotal': 1})
+        self.assertEqual(result['dc.b.virtualmachines.allocated']['onCPU'],
+                         2)
+        lines = [line.rsplit(' ', 1)[0] for line in
+                 output.getvalue().splitlines()]
+        self.assertEqual(lines.count(
+            'dc.a.virtualmachines.allocated.onCPU 4'), 1)
+        self.assertEqual(lines.count(
+            'dc.b.virtualmachines.allocated.onCPU 0'), 1)
+        self.assertEqual(lines.count(
+            'dc.b.virtualmachines.allocated.offTotal 0'), 1)
+        self.assertIn('dc.b.virtualmachines.allocated.onCPU 2', lines)
+
+    def test_get_args(self):
+        """
+            Verify -f is the config file, as in the other scripts, and
+            --follow has no short form
+        """
+        args = vcdataoutput.get_args(['-f', 'other.ini', '--follow'])
+        self.assertEqual((args.configfile, args.follow), ('other.ini', True))
+        self.assertFalse(vcdataoutput.get_args([]).follow)
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertRaises(SystemExit, vcdataoutput.get_args,
+                              ['--stats-output', '-'])
+
+    def test_stats_stream(self):
+        """
+            Verify the stats go to stdout unless the VMs are, or to their
+            own file
+        """
+        args = vcdataoutput.get_args([])
+        self.assertIs(vcdataoutput.stats_stream(args), sys.stderr)
+        args = vcdataoutput.get_args(['-w', 'vms.csv'])
+        self.assertIs(vcdataoutput.stats_stream(args), sys.stdout)
+        args = vcdataoutput.get_args(['-w', 'vms.csv', '--stats-output', '-'])
+        self.assertIs(vcdataoutput.stats_stream(args), sys.stdout)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'stats.txt')
+            stream = vcdataoutput.stats_stream(vcdataoutput.get_args(
+                ['--stats-output', path]))
+            vcdataoutput.print_results({'dc.c.hardware': {'totalCPU': 4}},
+                                       100, stream=stream)
+            stream.close()
+            with open(path) as stats_file:
+                self.assertEqual(stats_file.read(),
+                                 'dc.c.hardware.totalCPU 4 100\n')
+
+    def test_get_targets(self):
+        """
+            Verify DC sections are turned into one target per vCenter
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            configfile = os.path.join(tmpdir, 'vsphere-tools.ini')
+            with open(configfile, 'w') as ini_file:
+                ini_file.write(INI)
+            args = argparse.Namespace(configfile=configfile, host=None,
+                                      user=None, dc=['one', 'TWO'],
+                                      all_dcs=False)
+            self.assertEqual(vcdataoutput.get_targets(args),
+                             [('vc1.example.com', 'one@example.com')])
+            args.all_dcs = True
+            self.assertEqual(vcdataoutput.get_targets(args),
+                             [('vc1.example.com', 'one@example.com'),
+                              ('vc2.example.com', 'three@example.com')])
+            args = argparse.Namespace(configfile=configfile,
+                                      host='vc9.example.com', user='me',
+                                      dc=['three'], all_dcs=False)
+            self.assertEqual(vcdataoutput.get_targets(args),
+                             [('vc9.example.com', 'me'),
+                              ('vc2.example.com', 'me')])
+            args.dc = ['four']
+            self.assertRaises(Exception, vcdataoutput.get_targets, args)
+            args.dc = None
+            args.host = None
+            self.assertRaises(Exception, vcdataoutput.get_targets, args)
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.collect_properties')
+    def test_find_clusters(self, mock_collect):
+        """
+            Verify clusters are found in every datacenter, with hardware
+            only for real clusters
+        """
+        cluster = vim.ClusterComputeResource('domain-c1')
+        host = vim.ComputeResource('domain-s2')
+        mock_collect.side_effect = [
+            [('dc-1', {'name': 'dc1', 'hostFolder': 'f1'}),
+             ('dc-2', {'name': 'dc2', 'hostFolder': 'f2'})],
+            [(cluster, {'name': 'c1', 'summary.effectiveMemory': 8192,
+                        'summary.numCpuThreads': 16})],
+            [(host, {'name': 'h1'})]]
+        vm_data = vcdataoutput.AllocationTable()
+        result_data = {}
+        clusters = vcdataoutput.find_clusters('content', vm_data,
+                                              result_data, 'vc1')
+        self.assertEqual(clusters, [('vc1.dc1.c1', cluster),
+                                    ('vc1.dc2.h1', host)])
+        self.assertEqual(result_data, {'vc1.dc1.c1.hardware':
+                                       {'totalMB': 8192, 'totalCPU': 16}})
+        self.assertEqual(vm_data.groups, ['vc1.dc1.c1', 'vc1.dc2.h1'])
+        self.assertEqual(mock_collect.call_args[1]['container'], 'f2')
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.get_writer')
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.run_parallel')
+    @mock.patch('scripts.vcdataoutput.collect_vcenter')
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.connect_vc')
+    @mock.patch('scripts.vcdataoutput.get_targets')
+    @mock.patch('scripts.vcdataoutput.get_args')
+    def test_main(self, mock_args, mock_targets, mock_connect, mock_collect,
+                  mock_parallel, mock_writer):
+        """
+            Verify every vCenter is logged in to as the other scripts do,
+            collected from at once, and the results merged, with the stats
+            on stderr as the VMs are going to stdout
+        """
+        mock_args.return_value = argparse.Namespace(
+            password='secret', follow=False, debug=False, format='jsonl',
+            output='-', port=443, reuse_session=True)
+        mock_targets.return_value = [('vc1', 'me'), ('vc2', 'me')]
+        mock_connect.side_effect = ['si1', 'si2']
+        mock_collect.side_effect = [
+            {'dc1.c1.hardware': {'totalCPU': 4}},
+            {'dc2.c1.hardware': {'totalCPU': 8}}]
+
+        def run_parallel(operation, items, parallel):
+            self.assertEqual(parallel, 2)
+            for _, item in items:
+                operation(item)
+            return {'vc1': None, 'vc2': None}
+
+        mock_parallel.side_effect = run_parallel
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as output, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(vcdataoutput.main(), 0)
+        self.assertEqual(stdout.getvalue(), '')
+        lines = [line.rsplit(' ', 1)[0] for line in
+                 output.getvalue().splitlines()]
+        self.assertEqual(lines, ['dc1.c1.hardware.totalCPU 4',
+                                 'dc2.c1.hardware.totalCPU 8'])
+        mock_connect.assert_called_with('vc2', 'me', 'secret', 443, True)
+        self.assertEqual(mock_collect.call_args[0][:2], ('vc2', 'si2'))
+        self.assertEqual(mock_collect.call_args[0][3],
+                         mock_writer.return_value)
+        mock_writer.assert_called_once_with(
+            'jsonl', '-', vcdataoutput.VM_COLUMNS, vcdataoutput.VM_TYPES)
+        mock_writer.return_value.close.assert_called_once()
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.get_writer')
+    @mock.patch('scripts.vcdataoutput.collect_vcenter')
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.connect_vc')
+    @mock.patch('scripts.vcdataoutput.get_targets')
+    @mock.patch('scripts.vcdataoutput.get_args')
+    def test_main_follow(self, mock_args, mock_targets, mock_connect,
+                         mock_collect, mock_writer):
+        """
+            Verify each vCenter is logged in to in turn, and one that
+            can't be, or whose following fails, is reported and fails the
+            run while the others carry on
+        """
+        mock_args.return_value = argparse.Namespace(
+            password=None, follow=True, debug=False, format='csv',
+            output='-', port=443, reuse_session=False)
+        mock_targets.return_value = [('vc1', 'me'), ('vc2', 'me'),
+                                     ('vc3', 'you')]
+
+        def connect_vc(server, user, password, port, reuse):
+            if server == 'vc3':
+                raise Exception("bad password")
+            return 'si-' + server
+        mock_connect.side_effect = connect_vc
+
+        def collect_vcenter(server, si_obj, args, writer, stats=None):
+            if si_obj == 'si-vc2':
+                raise Exception("lost the connection")
+        mock_collect.side_effect = collect_vcenter
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as output:
+            self.assertEqual(vcdataoutput.main(), -1)
+        self.assertEqual(sorted(output.getvalue().splitlines()),
+                         ["vc2 : lost the connection", "vc3 : bad password"])
+        self.assertEqual([call[0][:3] for call in
+                          mock_connect.call_args_list],
+                         [('vc1', 'me', None), ('vc2', 'me', None),
+                          ('vc3', 'you', None)])
+        self.assertEqual(sorted(call[0][:2] for call in
+                                mock_collect.call_args_list),
+                         [('vc1', 'si-vc1'), ('vc2', 'si-vc2')])
+        mock_writer.return_value.close.assert_called_once()
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.collect_resource_vms')
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.collect_properties')
+    def test_same_names(self, mock_collect, mock_vms):
+        """
+            Verify two vCenters with the same datacenter and cluster names
+            are kept apart, in the stats and the VM rows
+        """
+        vcenters = {}
+        for server, threads in (('vc1.example.com', 16),
+                                ('vc2.example.com', 32)):
+            content = mock.MagicMock(threads=threads)
+            vcenters[server] = mock.MagicMock()
+            vcenters[server].RetrieveContent.return_value = content
+
+        def collect_properties(content, types, properties, container=None):
+            if types == [vim.Datacenter]:
+                return [('dc', {'name': 'Datacenter',
+                                'hostFolder': 'folder'})]
+            return [(vim.ClusterComputeResource('domain-c1'),
+                     {'name': 'Cluster', 'summary.effectiveMemory': 8192,
+                      'summary.numCpuThreads': content.threads})]
+        mock_collect.side_effect = collect_properties
+        mock_vms.side_effect = lambda content, cluster, properties: [
+            ('vm-1', {'name': 'vm%d' % content.threads,
+                      'config.hardware.numCPU': content.threads,
+                      'config.hardware.memoryMB': 1024,
+                      'runtime.powerState': 'poweredOn'})]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'vms.csv')
+            args = argparse.Namespace(follow=False, perf=False, debug=False,
+                                      format='csv', output=path)
+            stats = io.StringIO()
+            self.assertEqual(vcdataoutput.collect_to(vcenters, {}, args,
+                                                     stats, 0), 0)
+            with open(path) as vms_file:
+                rows = sorted(vms_file.read().splitlines()[1:])
+        self.assertEqual([row.split(',')[:3] for row in rows],
+                         [['vc1_example_com.Datacenter.Cluster', 'vm16',
+                           '16'],
+                          ['vc2_example_com.Datacenter.Cluster', 'vm32',
+                           '32']])
+        lines = [line.rsplit(' ', 1)[0] for line in
+                 stats.getvalue().splitlines()]
+        for server, threads in (('vc1_example_com', 16),
+                                ('vc2_example_com', 32)):
+            group = server + '.Datacenter.Cluster'
+            self.assertIn('%s.hardware.totalCPU %d' % (group, threads),
+                          lines)
+            self.assertIn('%s.virtualmachines.allocated.onCPU %d' %
+                          (group, threads), lines)
+
+    @mock.patch('scripts.vcdataoutput.vsphere_tools.PerfCollector')
+    def test_collect_usage(self, mock_perf):
+        """
+            Verify usage is sampled for every running VM at once, and
+            summed up per cluster
+        """
+        mock_perf.return_value.query.return_value = {
+            'vm-1': {'cpu.usage.average': [1000, 2000],
+                     'mem.active.average': [2048]},
+            'vm-2': {'cpu.usage.average': [4000],
+                     'disk.maxTotalLatency.latest': [7]},
+            'vm-3': {'cpu.usage.average': [500],
+                     'mem.active.average': [1024]}}
+        result = vcdataoutput.collect_usage(
+            'content', [('dc.a', 'vm-1'), ('dc.a', 'vm-2'),
+                        ('dc.b', 'vm-3'), ('dc.b', 'vm-4')], {})
+        self.assertEqual(mock_perf.return_value.query.call_args[0][0],
+                         ['vm-1', 'vm-2', 'vm-3', 'vm-4'])
+        self.assertEqual(result['dc.a.virtualmachines.usage'],
+                         {'cpuUsagePct': 30.0, 'memActiveMB': 2.0,
+                          'diskLatencyMaxMS': 7.0})
+        self.assertEqual(result['dc.b.virtualmachines.usage'],
+                         {'cpuUsagePct': 5.0, 'memActiveMB': 1.0})
@@ -7,12 +7,26 @@
 # pylint: disable=too-many-arguments
 # pylint: disable=no-self-use
 
+import datetime
+import itertools
+import socket
 import unittest
 from unittest import mock
 from pyVmomi import vim  # pylint: disable=no-name-in-module
 from scripts.vsphere_tools import *  # pylint: disable=unused-wildcard-import
 
 
+def probed(answered, rtt=0.001):
+    """
+        A ProbeResult of one probe, answered in rtt seconds or not at all
+    """
+    result = ProbeResult('127.0.0.1', 'icmp')
+    result.sent = 1
+    if answered:
+        result.rtts.append(rtt)
+    return result
+
+
 class PowerTestCase(unittest.TestCase):
     """
         Unittests for vsphere-tools power functions
@@ -129,6 +143,79 @@ class SnapshotTestCase(unittest.TestCase):
         mysnap.snapshot.RevertToSnapshot_Task.assert_called_once()
 
 
+    @mock.patch.object(vim, 'VirtualMachine')
+    @mock.patch.object(vim, 'VirtualMachineSnapshot')
+    @mock.patch('scripts.vsphere_tools.get_snapshot')
+    def test_start_snapshot_task(self, mock_getsnap, mock_snap, mock_vm):
+        """
+            Verify snapshot tasks are started, and not waited on
+        """
+        mysnap = vim.VirtualMachineSnapshot()
+        mock_getsnap.return_value = [mysnap]
+        testvm = vim.VirtualMachine()
+        self.assertEqual(start_snapshot_task(testvm, 'create', 'snap'),
+                         testvm.CreateSnapshot_Task.return_value)
+        self.assertEqual(start_snapshot_task(testvm, 'delete', 'snap'),
+                         mysnap.snapshot.RemoveSnapshot_Task.return_value)
+        self.assertEqual(start_snapshot_task(testvm, 'revert', 'snap'),
+                         mysnap.snapshot.RevertToSnapshot_Task.return_value)
+        mock_getsnap.return_value = [mysnap, mysnap]
+        with self.assertRaises(Exception):
+            start_snapshot_task(testvm, 'delete', 'snap')
+        with self.assertRaises(Exception):
+            start_snapshot_task(testvm, 'create', None)
+
+
+    @mock.patch('scripts.vsphere_tools.wait_for_task')
+    def test_delete_old_snapshots(self, mock_wait):
+        """
+            Verify only the snapshots before the cutoff are removed,
+            keeping their children
+        """
+        tree = mock.MagicMock()
+        old = [mock.MagicMock(), mock.MagicMock()]
+        old[0].name = 'a'
+        old[1].name = 'b'
+        tree.older_than.return_value = old
+        self.assertEqual(delete_old_snapshots(tree, 'cutoff'), ['a', 'b'])
+        tree.older_than.assert_called_once_with('cutoff')
+        old[0].snapshot.RemoveSnapshot_Task.assert_called_once_with(False)
+        old[1].snapshot.RemoveSnapshot_Task.assert_called_once_with(False)
+
+    def test_iter_snapshots(self):
+        """
+            Verify the tree is walked depth first, in order, without
+            looking up the VM name on every snapshot
+        """
+        def snap(name, children=None):
+            snapshot = mock.MagicMock()
+            snapshot.name = name
+            snapshot.childSnapshotList = children or []
+            return snapshot
+
+        tree = [snap('a', [snap('a1', [snap('a1x')]), snap('a2')]),
+                snap('b')]
+        result = list(iter_snapshots(tree, 'vm1'))
+        self.assertEqual([line.split('; ')[1] for line in result],
+                         ['Name: a', 'Name: a1', 'Name: a1x', 'Name: a2',
+                          'Name: b'])
+        self.assertTrue(result[0].startswith('VM: vm1; '))
+        self.assertEqual(list_snapshots(tree, 'vm1'), result)
+
+    @mock.patch('scripts.vsphere_tools.collect_object_properties')
+    def test_fetch_snapshot_trees(self, mock_cop):
+        """
+            Verify all the trees come from one property collection
+        """
+        mock_cop.return_value = [
+            ('vm-1', {'name': 'one', 'snapshot.rootSnapshotList': ['x']}),
+            ('vm-2', {'name': 'two'})]
+        self.assertEqual(list(fetch_snapshot_trees('content',
+                                                   ['vm-1', 'vm-2'])),
+                         [('one', ['x']), ('two', None)])
+        mock_cop.assert_called_once()
+
+
 class OtherTestCase(unittest.TestCase):
     """
         unittest for vsphere-tools support functions
@@ -138,23 +225,40 @@ class OtherTestCase(unittest.TestCase):
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'VirtualMachineRelocateSpec')
     @mock.patch('scripts.vsphere_tools.wait_for_task')
-    @mock.patch('scripts.vsphere_tools.ping')
+    @mock.patch('scripts.vsphere_tools.ping_result')
     @mock.patch('scripts.vsphere_tools.time.sleep')
-    def test_do_a_vmotion(self, mock_sleep, mock_ping, mock_wait,
-                          mock_spec, mock_host, mock_vm):
+    @mock.patch('scripts.vsphere_tools.time.monotonic',
+                side_effect=itertools.count())
+    def test_do_a_vmotion(self, mock_clock, mock_sleep, mock_ping,
+                          mock_wait, mock_spec, mock_host, mock_vm):
         """
-            Verify that proper mocked functions are called on vmotion call
+            Verify that proper mocked functions are called on vmotion call,
+            and the hop's timings are recorded
         """
         testvm = vim.VirtualMachine()
         testhost = vim.HostSystem()
-        do_a_vmotion(testvm, testhost, '127.0.0.1')
+        testvm.runtime.host = testhost
+        task = testvm.RelocateVM_Task.return_value
+        task.info.queueTime = datetime.datetime(2024, 1, 1, 12, 0, 0)
+        task.info.startTime = datetime.datetime(2024, 1, 1, 12, 0, 1)
+        task.info.completeTime = datetime.datetime(2024, 1, 1, 12, 0, 9)
+        mock_ping.side_effect = [probed(True, 0.004), probed(True, 0.001),
+                                 probed(True, 0.002), probed(True, 0.003)]
+        timings = {}
+        do_a_vmotion(testvm, testhost, '127.0.0.1', timings=timings)
         testvm.RelocateVM_Task.assert_called_once()
+        # the ping before, then one a second until 2 seconds of replies
+        self.assertEqual(mock_ping.call_count, 4)
+        mock_ping.assert_called_with('127.0.0.1', count=1)
+        self.assertEqual(timings, {'pre_rtt_ms': 4.0, 'queue_s': 1.0,
+                                   'run_s': 8.0, 'ready_s': 3,
+                                   'post_rtt_ms': 2.0})
 
     @mock.patch.object(vim, 'VirtualMachine')
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'VirtualMachineRelocateSpec')
     @mock.patch('scripts.vsphere_tools.wait_for_task')
-    @mock.patch('scripts.vsphere_tools.ping')
+    @mock.patch('scripts.vsphere_tools.ping_result')
     @mock.patch('scripts.vsphere_tools.time.sleep')
     def test_fail_a_prevmotion(self, mock_sleep, mock_ping, mock_wait,
                                mock_spec, mock_host, mock_vm):
@@ -164,32 +268,139 @@ class OtherTestCase(unittest.TestCase):
         """
         testvm = vim.VirtualMachine()
         testhost = vim.HostSystem()
-        mock_ping.return_value = False
+        mock_ping.return_value = probed(False)
+        timings = {}
         with self.assertRaises(Exception,
                                msg="Exception not raised when ping fails"):
-            do_a_vmotion(testvm, testhost, '127.0.0.1')
+            do_a_vmotion(testvm, testhost, '127.0.0.1', timings=timings)
         testvm.RelocateVM_Task.assert_not_called()
+        self.assertEqual(timings, {'pre_rtt_ms': None})
 
     @mock.patch.object(vim, 'VirtualMachine')
     @mock.patch.object(vim, 'HostSystem')
     @mock.patch.object(vim, 'VirtualMachineRelocateSpec')
     @mock.patch('scripts.vsphere_tools.wait_for_task')
-    @mock.patch('scripts.vsphere_tools.ping')
+    @mock.patch('scripts.vsphere_tools.ping_result')
     @mock.patch('scripts.vsphere_tools.time.sleep')
-    def test_fail_a_postvmotion(self, mock_sleep, mock_ping, mock_wait,
-                                mock_spec, mock_host, mock_vm):
+    @mock.patch('scripts.vsphere_tools.time.monotonic',
+                side_effect=itertools.count())
+    def test_fail_a_postvmotion(self, mock_clock, mock_sleep, mock_ping,
+                                mock_wait, mock_spec, mock_host, mock_vm):
         """
             Verify that proper mocked functions are called
             post-vmotion ping fail
         """
         testvm = vim.VirtualMachine()
         testhost = vim.HostSystem()
-        mock_ping.side_effect = [True, False]
-        with self.assertRaises(Exception,
-                               msg="Exception not raised when ping fails"):
-            do_a_vmotion(testvm, testhost, '127.0.0.1')
+        testvm.runtime.host = testhost
+        mock_ping.side_effect = lambda *args, **options: probed(
+            'count' not in options)
+        with self.assertRaisesRegex(Exception, 'Post-VMotion Ping Failed',
+                                    msg="Exception not raised when ping "
+                                    "fails"):
+            do_a_vmotion(testvm, testhost, '127.0.0.1',
+                         ready={'timeout': 10})
         testvm.RelocateVM_Task.assert_called_once()
 
+    @mock.patch.object(vim, 'VirtualMachine')
+    @mock.patch.object(vim, 'HostSystem')
+    @mock.patch.object(vim, 'VirtualMachineRelocateSpec')
+    @mock.patch('scripts.vsphere_tools.ProbeMonitor')
+    @mock.patch('scripts.vsphere_tools.wait_for_task')
+    @mock.patch('scripts.vsphere_tools.ping_result')
+    @mock.patch('scripts.vsphere_tools.time.sleep')
+    @mock.patch('scripts.vsphere_tools.time.monotonic',
+                side_effect=itertools.count())
+    def test_monitor_a_vmotion(self, mock_clock, mock_sleep, mock_ping,
+                               mock_wait, mock_monitor, mock_spec, mock_host,
+                               mock_vm):
+        """
+            Verify the canary is watched through the vmotion, and the
+            watching stops even when the vmotion fails
+        """
+        testvm = vim.VirtualMachine()
+        testhost = vim.HostSystem()
+        testvm.runtime.host = testhost
+        mock_ping.return_value = probed(True)
+        watcher = mock_monitor.return_value.start.return_value
+        result = do_a_vmotion(testvm, testhost, '127.0.0.1',
+                              probe_options={'method': 'tcp', 'count': 1},
+                              monitor={'interval': 0.02})
+        mock_monitor.assert_called_once_with('127.0.0.1', method='tcp',
+                                             interval=0.02)
+        watcher.stop.assert_called_once()
+        self.assertEqual(result, watcher.stats)
+        mock_wait.return_value = False
+        with self.assertRaises(Exception):
+            do_a_vmotion(testvm, testhost, '127.0.0.1', monitor={})
+        self.assertEqual(watcher.stop.call_count, 2)
+
+    @mock.patch('scripts.vsphere_tools.ping_result')
+    @mock.patch('scripts.vsphere_tools.time.sleep')
+    @mock.patch('scripts.vsphere_tools.time.monotonic',
+                side_effect=itertools.count())
+    def test_wait_until_ready(self, mock_clock, mock_sleep, mock_ping):
+        """
+            Verify the wait is for the VM to reach the host, then for an
+            unbroken run of replies, and gives up at the timeout
+        """
+        vm_obj = mock.MagicMock()
+        host = mock.MagicMock()
+        host.name = 'esx1'
+        vm_obj.runtime.host = host
+        mock_ping.side_effect = [probed(answered) for answered in
+                                 [True, False, True, True, True, True]]
+        self.assertEqual(wait_until_ready(vm_obj, host, 'canary', {
+            'method': 'tcp', 'count': 3}, settle=3), 6)
+        mock_ping.assert_called_with('canary', method='tcp', count=1)
+        self.assertEqual(mock_ping.call_count, 6)
+        mock_ping.side_effect = None
+        mock_ping.return_value = probed(True)
+        self.assertEqual(wait_until_ready(vm_obj, host, 'canary',
+                                          settle=0), 1)
+        vm_obj.runtime.host = mock.MagicMock()
+        with self.assertRaisesRegex(Exception, 'not running on esx1'):
+            wait_until_ready(vm_obj, host, 'canary', timeout=5)
+
+    @mock.patch('scripts.vsphere_tools.find_host')
+    @mock.patch('scripts.vsphere_tools.collect_properties')
+    def test_find_hosts(self, mock_collect, mock_find):
+        """
+            Verify hosts are found with one inventory pass, falling back to
+            DNS for names that aren't in it
+        """
+        test_si = mock.MagicMock()
+        mock_collect.return_value = [('host-1', {'name': 'ESX1.example.com'}),
+                                     ('host-2', {'name': 'esx2.example.com'})]
+        mock_find.return_value = 'host-3'
+        self.assertEqual(find_hosts(test_si, ['esx2.example.com',
+                                              'esx1.example.com', 'esx3']),
+                         ['host-2', 'host-1', 'host-3'])
+        mock_collect.assert_called_once_with(test_si.content,
+                                             [vim.HostSystem], ['name'])
+        mock_find.assert_called_once_with(test_si, 'esx3')
+
+    def test_find_with_index(self):
+        """
+            Verify an AddressIndex answers the lookups instead of the VC,
+            and an IP on more than one VM is an error
+        """
+        test_si = mock.MagicMock()
+        index = mock.MagicMock()
+        index.find_ip.side_effect = [['vm-1'], ['vm-1', 'vm-2']]
+        index.find_name.return_value = ['host-1']
+        index.name_of.side_effect = {'vm-1': 'web01', 'vm-2': 'web02'}.get
+        self.assertEqual(find_vm_byip(test_si, '10.0.0.1', index), 'vm-1')
+        with self.assertRaisesRegex(Exception, 'web01, web02'):
+            find_vm_byip(test_si, '10.0.0.2', index)
+        self.assertEqual(find_host(test_si, 'esx1', index), 'host-1')
+        index.find_name.assert_called_once_with('esx1', [vim.HostSystem])
+        index.find_name.return_value = []
+        with self.assertRaises(Exception):
+            find_vm_bydns(test_si, 'web03', index)
+        test_si.content.searchIndex.FindAllByIp.assert_not_called()
+        test_si.content.searchIndex.FindAllByDnsName.assert_not_called()
+
     @mock.patch.object(vim, 'ServiceInstance')
     def test_find_a_host(self, mock_si):
         """
@@ -224,7 +435,15 @@ class OtherTestCase(unittest.TestCase):
     # @unittest.skip("skipping to avoid 5s wait - enable before shipping out.")
     def test_ping_failing(self):
         """
-            ping invalid host, and verify that fails
+            ping something that won't answer, and verify that fails.  Every
+            loopback address answers ICMP, so probe a closed port instead.
         """
-        self.assertFalse(ping('127.0.0.2'),
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.assertFalse(ping('127.0.0.1', method='tcp', port=port,
+                              refused_ok=False, timeout=0.5),
                          msg="Ping succeeded when it shouldn't")
+        self.assertFalse(ping('no.such.host.invalid'),
+                         msg="Ping of an unknown name succeeded")
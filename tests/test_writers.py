@@ -0,0 +1,89 @@
+#!/usr/local/bin/python
+"""
+    testing the buffered row writers
+"""
+# pylint: disable=no-self-use
+
+import csv
+import json
+import os
+import tempfile
+import unittest
+from scripts.vsphere_tools import writers
+
+COLUMNS = ['name', 'num_cpu', 'power_state']
+ROWS = [{'name': 'one', 'num_cpu': 2, 'power_state': 'poweredOn'},
+        {'name': 'two', 'power_state': 'poweredOff'},
+        {'name': 'three', 'num_cpu': 4, 'power_state': 'poweredOn'}]
+
+
+class WritersTestCase(unittest.TestCase):
+    """
+        unittests for the writers
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'out')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, output_format, **kwargs):
+        """
+            write ROWS out in output_format, two rows to a batch
+        """
+        writer = writers.get_writer(output_format, self.path, COLUMNS,
+                                    batch_size=2, **kwargs)
+        for row in ROWS:
+            writer.write(row)
+        self.assertEqual(len(writer.rows), 1)
+        writer.close()
+
+    def test_csv(self):
+        """
+            Verify CSV has a header, and the rows in order
+        """
+        self.write('csv')
+        with open(self.path, newline='') as out_file:
+            rows = list(csv.reader(out_file))
+        self.assertEqual(rows, [COLUMNS, ['one', '2', 'poweredOn'],
+                                ['two', '', 'poweredOff'],
+                                ['three', '4', 'poweredOn']])
+
+    def test_jsonl(self):
+        """
+            Verify one JSON object per row, with every column
+        """
+        self.write('jsonl')
+        with open(self.path) as out_file:
+            rows = [json.loads(line) for line in out_file]
+        self.assertEqual(rows[1], {'name': 'two', 'num_cpu': None,
+                                   'power_state': 'poweredOff'})
+        self.assertEqual(len(rows), 3)
+
+    def test_parquet(self):
+        """
+            Verify Parquet gets a row group per batch with the given types
+        """
+        try:
+            import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        self.write('parquet', types={'num_cpu': 'int64'})
+        parquet_file = pyarrow.parquet.ParquetFile(self.path)
+        self.assertEqual(parquet_file.num_row_groups, 2)
+        table = parquet_file.read()
+        self.assertEqual(table.column('num_cpu').to_pylist(), [2, None, 4])
+        self.assertEqual(str(table.schema.field('num_cpu').type), 'int64')
+        self.assertRaises(Exception, writers.get_writer, 'parquet', '-',
+                          COLUMNS)
+
+    def test_unknown(self):
+        """
+            Verify an unknown format is refused, as is a writer with no
+            format
+        """
+        self.assertRaises(Exception, writers.get_writer, 'xml', self.path,
+                          COLUMNS)
+        self.assertRaises(TypeError, writers.RowWriter, self.path, COLUMNS)